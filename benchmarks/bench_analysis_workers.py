@@ -0,0 +1,76 @@
+"""
+Benchmark shot analysis throughput against the number of worker processes.
+
+Shots are analyzed with the in-process analyzer, as the thread backend does,
+and with ProcessPoolAnalyzer for each worker count, submitting one shot per
+worker at a time as the scheduler does. For the process backend, the
+history is put in shared memory from the analyzer, as XPSProcessor does.
+
+    python benchmarks/bench_analysis_workers.py --shots 32 --rows 2000
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import typer
+
+from tr_ap_xps.pipeline.analysis import ProcessPoolAnalyzer, analyze_arrays
+
+app = typer.Typer()
+
+
+def make_shot(rng: np.random.Generator, rows: int, columns: int):
+    x = np.arange(columns)
+    line = sum(
+        height * np.exp(-0.5 * ((x - center) / 8) ** 2)
+        for center, height in ((columns * 0.3, 50), (columns * 0.6, 80))
+    )
+    integrated_frames = line + rng.normal(0, 2, (rows, columns))
+    return integrated_frames[0].copy(), integrated_frames
+
+
+def shared_shots(analyzer: ProcessPoolAnalyzer, shots: list) -> list:
+    shared = []
+    for line, integrated_frames in shots:
+        history = analyzer.allocate(integrated_frames.shape, integrated_frames.dtype)
+        history[:] = integrated_frames
+        shared.append((line, history))
+    return shared
+
+
+def shots_per_second(analyzer, shots: list, concurrency: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(lambda shot: analyzer(*shot), shots))
+    return len(shots) / (time.perf_counter() - start)
+
+
+@app.command()
+def main(shots: int = 32, rows: int = 2000, columns: int = 1131):
+    rng = np.random.default_rng(0)
+    shot_data = [make_shot(rng, rows, columns) for _ in range(shots)]
+    print(f"{os.cpu_count()} cpus")
+    print(f"{'backend':>10} {'workers':>8} {'shots/s':>8}")
+
+    rate = shots_per_second(analyze_arrays, shot_data, 1)
+    print(f"{'thread':>10} {1:>8} {rate:>8.2f}")
+
+    for workers in (1, 2, 4, 8):
+        if workers > (os.cpu_count() or 1):
+            break
+        analyzer = ProcessPoolAnalyzer(workers)
+        try:
+            shared = shared_shots(analyzer, shot_data)
+            # start the workers and import the analysis modules in them
+            shots_per_second(analyzer, shared[:workers], workers)
+            rate = shots_per_second(analyzer, shared, workers)
+            del shared
+        finally:
+            analyzer.shutdown()
+        print(f"{'process':>10} {workers:>8} {rate:>8.2f}")
+
+
+if __name__ == "__main__":
+    app()
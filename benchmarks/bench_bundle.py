@@ -0,0 +1,110 @@
+"""
+Benchmark the websocket result bundle made by pack_images.
+
+Compares the layout before versioned bundles, where the peaks table was
+renamed in place, turned into records and JSON and the images were bare
+bytes, against the typed layout, where peaks are float32 columns and every
+array carries its dtype and shape.
+
+    python benchmarks/bench_bundle.py
+"""
+
+import json
+import timeit
+
+import msgpack
+import numpy as np
+import pandas as pd
+import typer
+
+from tr_ap_xps.schemas import DataFrameModel, NumpyArrayModel, XPSResult
+from tr_ap_xps.websockets import convert_to_uint8, pack_images, pack_peaks
+
+app = typer.Typer()
+
+
+def reference_pack_images(message: XPSResult) -> bytes:
+    # pack_images with the previous layout
+    waterfall = message.integrated_frames.array
+    peaks = message.detected_peaks.df.copy()  # the old code renamed in place
+    peaks.columns = ["x", "h", "fwhm"]
+    return msgpack.packb(
+        {
+            "kind": "snapshot",
+            "seq": 1,
+            "raw_start": 0,
+            "raw_rows": np.ascontiguousarray(waterfall[::-1], dtype="<f4").tobytes(),
+            "vfft": convert_to_uint8(message.vfft.array),
+            "ifft": convert_to_uint8(message.ifft.array),
+            "width": waterfall.shape[0],
+            "height": waterfall.shape[1],
+            "fft_width": message.vfft.array.shape[0],
+            "fitted": json.dumps(peaks.to_dict(orient="records")),
+            "shot_num": message.shot_num,
+            "shot_recent": convert_to_uint8(message.shot_recent.array),
+            "shot_mean": convert_to_uint8(message.shot_mean.array),
+            "shot_std": convert_to_uint8(message.shot_std.array),
+        }
+    )
+
+
+def reference_pack_peaks(peaks: pd.DataFrame) -> bytes:
+    peaks = peaks.copy()
+    peaks.columns = ["x", "h", "fwhm"]
+    return msgpack.packb(json.dumps(peaks.to_dict(orient="records")))
+
+
+def make_result(rows: int, width: int, num_peaks: int) -> XPSResult:
+    rng = np.random.default_rng(0)
+    return XPSResult(
+        frame_number=rows,
+        integrated_frames=NumpyArrayModel(array=rng.random((rows, width))),
+        detected_peaks=DataFrameModel(
+            df=pd.DataFrame(
+                {
+                    "index": rng.integers(0, width, num_peaks),
+                    "amplitude": rng.random(num_peaks) * 1e3,
+                    "FWHM": rng.random(num_peaks) * 10,
+                }
+            )
+        ),
+        vfft=NumpyArrayModel(array=rng.random((rows, width))),
+        ifft=NumpyArrayModel(array=rng.random((rows, width))),
+        shot_num=rows // 4,
+        shot_recent=NumpyArrayModel(array=rng.random((4, width))),
+        shot_mean=NumpyArrayModel(array=rng.random((4, width))),
+        shot_std=NumpyArrayModel(array=rng.random((4, width))),
+    )
+
+
+def best(function, number: int, repeat: int) -> float:
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+@app.command()
+def main(width: int = 1131, number: int = 20, repeat: int = 5):
+    print(f"{'peaks':>6} {'before (us, B)':>18} {'after (us, B)':>18}")
+    for num_peaks in (3, 30, 300):
+        peaks = make_result(4, width, num_peaks).detected_peaks.df
+        before = best(lambda: reference_pack_peaks(peaks), number * 10, repeat)
+        after = best(lambda: msgpack.packb(pack_peaks(peaks)), number * 10, repeat)
+        print(
+            f"{num_peaks:>6} {before * 1e6:>10.1f} "
+            f"{len(reference_pack_peaks(peaks)):>7} "
+            f"{after * 1e6:>10.1f} {len(msgpack.packb(pack_peaks(peaks))):>7}"
+        )
+    print()
+    print(f"{'bundle':>12} {'before (ms, B)':>20} {'after (ms, B)':>20}")
+    for rows in (20, 200, 2000):
+        message = make_result(rows, width, 30)
+        before = best(lambda: reference_pack_images(message), number, repeat)
+        after = best(lambda: pack_images(message), number, repeat)
+        print(
+            f"{rows:>5}x{width:<6} {before * 1e3:>8.2f} "
+            f"{len(reference_pack_images(message)):>11} "
+            f"{after * 1e3:>8.2f} {len(pack_images(message)):>11}"
+        )
+
+
+if __name__ == "__main__":
+    app()
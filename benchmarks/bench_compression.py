@@ -0,0 +1,101 @@
+"""
+Benchmark compressing websocket bundles with each codec.
+
+For bundles made by pack_images from a smooth, noisy waterfall, reports the
+time to compress and decompress, the size, and the latency to get a bundle
+to a client over links of a few speeds: compress, send, decompress. The
+permessage-deflate row uses the websockets library's default extension
+settings, which it applies per client.
+
+    python benchmarks/bench_compression.py
+"""
+
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+import typer
+
+from tr_ap_xps.compression import CODECS, compress, decompress
+from tr_ap_xps.schemas import DataFrameModel, NumpyArrayModel, XPSResult
+from tr_ap_xps.websockets import pack_images
+
+app = typer.Typer()
+
+LINKS = {"10 Mbit/s": 10e6, "100 Mbit/s": 100e6, "1 Gbit/s": 1e9}
+
+
+def make_result(rows: int, width: int) -> XPSResult:
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 20, width)
+    t = np.arange(rows)[:, None]
+    waterfall = np.exp(-((x - 10) ** 2)) * (1 + 0.1 * np.sin(t / 5))
+    waterfall += 0.01 * rng.standard_normal((rows, width))
+    vfft = np.abs(np.fft.rfft(waterfall, axis=0))
+    return XPSResult(
+        frame_number=rows,
+        integrated_frames=NumpyArrayModel(array=waterfall),
+        detected_peaks=DataFrameModel(
+            df=pd.DataFrame({"index": [500], "amplitude": [1.0], "FWHM": [3.0]})
+        ),
+        vfft=NumpyArrayModel(array=vfft),
+        ifft=NumpyArrayModel(array=waterfall),
+        shot_num=rows // 4,
+        shot_recent=NumpyArrayModel(array=waterfall[:4]),
+        shot_mean=NumpyArrayModel(array=waterfall[:4]),
+        shot_std=NumpyArrayModel(array=waterfall[:4]),
+    )
+
+
+def permessage_deflate(data: bytes) -> bytes:
+    compressor = zlib.compressobj(wbits=-12, memLevel=5)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def timed(function, data: bytes, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(data)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+@app.command()
+def main(width: int = 1131, repeat: int = 3):
+    codecs = {"none": (lambda data: data, lambda data: data)}
+    codecs.update(
+        {
+            codec: (
+                lambda data, codec=codec: compress(data, codec),
+                lambda data, codec=codec: decompress(data, codec),
+            )
+            for codec in CODECS
+        }
+    )
+    codecs["permessage-deflate"] = (
+        permessage_deflate,
+        lambda data: zlib.decompressobj(wbits=-12).decompress(data),
+    )
+    links = "".join(f"{name:>16}" for name in LINKS)
+    for rows in (200, 2000):
+        bundle = pack_images(make_result(rows, width))
+        print(f"{rows} rows, {len(bundle) / 1e6:.1f} MB bundle")
+        print(f"{'codec':>20} {'ratio':>6} {'comp ms':>8} {'decomp ms':>10}{links}")
+        for name, (encode, decode) in codecs.items():
+            compressed, encode_time = timed(encode, bundle, repeat)
+            _, decode_time = timed(decode, compressed, repeat)
+            latencies = "".join(
+                f"{(encode_time + len(compressed) * 8 / bits + decode_time) * 1e3:>13.1f} ms"
+                for bits in LINKS.values()
+            )
+            print(
+                f"{name:>20} {len(compressed) / len(bundle):>6.2f} "
+                f"{encode_time * 1e3:>8.1f} {decode_time * 1e3:>10.1f}{latencies}"
+            )
+        print()
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,60 @@
+"""
+Benchmark the uint8 log stretch applied to every image sent to websocket
+clients.
+
+Compares the float64 conversion that convert_to_uint8 used to do, which
+allocated a full size temporary at each step, against LogStretch, at
+waterfall sizes reached over a run.
+
+    python benchmarks/bench_display_stretch.py
+"""
+
+import timeit
+
+import numpy as np
+import typer
+
+from tr_ap_xps.websockets import LogStretch
+
+app = typer.Typer()
+
+
+def reference_stretch(image: np.ndarray) -> bytes:
+    # convert_to_uint8 as it was
+    image_normalized = (image - image.min()) / (image.max() - image.min())
+    log_stretched = np.log1p(image_normalized)
+    log_stretched_normalized = (log_stretched - log_stretched.min()) / (
+        log_stretched.max() - log_stretched.min()
+    )
+    return (log_stretched_normalized * 255).astype(np.uint8).tobytes()
+
+
+@app.command()
+def main(width: int = 1131, number: int = 20, repeat: int = 5):
+    rng = np.random.default_rng(0)
+    stretch = LogStretch()
+    print(f"{'image':>22} {'before (ms)':>12} {'after (ms)':>11} {'speedup':>8}")
+    for rows in (100, 1000, 5000):
+        images = {
+            f"float64 {rows}x{width}": rng.random((rows, width)) * 1e4,
+            f"uint16 {rows}x{width}": rng.integers(
+                0, 4096, (rows, width), dtype=np.uint16
+            ),
+        }
+        for label, image in images.items():
+            before = min(
+                timeit.repeat(
+                    lambda: reference_stretch(image), number=number, repeat=repeat
+                )
+            )
+            after = min(
+                timeit.repeat(lambda: stretch(image), number=number, repeat=repeat)
+            )
+            print(
+                f"{label:>22} {before / number * 1e3:>12.2f} "
+                f"{after / number * 1e3:>11.2f} {before / after:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    app()
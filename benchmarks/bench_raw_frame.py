@@ -0,0 +1,66 @@
+"""
+Benchmark the per-frame message built by the LabVIEW listener.
+
+Compares the XPSRawEvent pydantic model that used to be built for every
+frame, with its nested NumpyArrayModel and a re-validated XPSImageInfo,
+against the XPSRawFrame dataclass, whose geometry is validated once per run.
+
+    python benchmarks/bench_raw_frame.py
+"""
+
+import timeit
+from typing import Literal
+
+import numpy as np
+import typer
+
+from arroyo.schemas import Event, NumpyArrayModel
+from tr_ap_xps.schemas import XPSImageInfo, XPSMessage, XPSRawFrame
+
+app = typer.Typer()
+
+
+class XPSRawEvent(Event, XPSMessage):
+    # The per-frame message as it was defined in schemas
+    msg_type: str = Literal["event"]
+    image: NumpyArrayModel
+    image_info: XPSImageInfo
+
+
+def build_raw_event(header: dict, image: np.ndarray, image_info: XPSImageInfo):
+    image_info.frame_number = header.get("Frame Number")
+    return XPSRawEvent(image=NumpyArrayModel(array=image), image_info=image_info)
+
+
+def build_raw_frame(header: dict, image: np.ndarray):
+    return XPSRawFrame(header.get("Frame Number"), image)
+
+
+@app.command()
+def main(number: int = 100_000, repeat: int = 5):
+    image = np.zeros((269, 1131), dtype=np.uint8)
+    image_info = XPSImageInfo(
+        frame_number=0, width=image.shape[1], height=image.shape[0], data_type="U8"
+    )
+    header = {"msg_type": "event", "Frame Number": 1}
+
+    event_time = min(
+        timeit.repeat(
+            lambda: build_raw_event(header, image, image_info),
+            number=number,
+            repeat=repeat,
+        )
+    )
+    frame_time = min(
+        timeit.repeat(
+            lambda: build_raw_frame(header, image), number=number, repeat=repeat
+        )
+    )
+    print(f"{'message':>12} {'per frame (us)':>15}")
+    print(f"{'XPSRawEvent':>12} {event_time / number * 1e6:>15.2f}")
+    print(f"{'XPSRawFrame':>12} {frame_time / number * 1e6:>15.2f}")
+    print(f"speedup {event_time / frame_time:.1f}x")
+
+
+if __name__ == "__main__":
+    app()
@@ -41,6 +41,10 @@ export default function App() {
     shotNumber,
     shotMeanArray,
     shotStdArray,
+    harmonicAmplitudeArray,
+    harmonicPhaseArray,
+    phaseFoldedArray,
+    pumpedDifference,
   } = useAPXPS({});
 
   //Automatically start the websocket connection on page load
@@ -96,6 +100,20 @@ export default function App() {
               <Widget title='Cumulative Fitted Peaks' width='w-full' maxWidth='max-w-[1000px]' defaultHeight='h-1/4' maxHeight='max-h-96'>
                   <PlotlyScatterMultiple data={allPeakData} title='Cumulative Fitted Peaks' xAxisTitle='x' yAxisTitle='y'/>
               </Widget>
+              {harmonicAmplitudeArray.length > 0 ?
+                <Widget title={`Lock-in - Current Shot #${shotNumber}`} width='w-full' maxWidth='max-w-[1000px]' defaultHeight='h-1/4' maxHeight='max-h-96' contentStyles='flex-col space-y-1 pb-2'>
+                  <PlotlyHeatMap array={harmonicAmplitudeArray} title='Harmonic Amplitude' fixPlotHeightToParent={true} height="h-1/2" width='w-full' verticalScaleFactor={1} showTicks={false}/>
+                  <PlotlyHeatMap array={harmonicPhaseArray} title='Harmonic Phase' fixPlotHeightToParent={true} height="h-1/2" width='w-full' verticalScaleFactor={1} showTicks={false}/>
+                </Widget>
+              : ''}
+              {phaseFoldedArray.length > 0 ?
+                <Widget title={`Phase Folding - Current Shot #${shotNumber}`} width='w-full' maxWidth='max-w-[1000px]' defaultHeight='h-1/2' maxHeight='max-h-[1000px]' contentStyles='flex-col space-y-1 pb-2'>
+                  <PlotlyHeatMap array={phaseFoldedArray} title='Phase Folded' fixPlotHeightToParent={true} height="h-1/2" width='w-full' verticalScaleFactor={1} showTicks={false}/>
+                  <div className="h-1/2 w-full">
+                    <PlotlyScatterSingle dataX={pumpedDifference.map((_, i) => i)} dataY={pumpedDifference} title='Pumped - Unpumped' xAxisTitle='x' yAxisTitle='difference'/>
+                  </div>
+                </Widget>
+              : ''}
             </div>
           </Main>
         </div>
@@ -6,6 +6,9 @@ import { getWsUrl } from '../utils/connectionHelper';
 import dayjs from 'dayjs';
 
 
+//layout of the result bundles from pack_images on the server
+const BUNDLE_VERSION = 2;
+
 export const useAPXPS = ({}) => {
 
     const [ messages, setMessages ] = useState([]);
@@ -17,6 +20,12 @@ export const useAPXPS = ({}) => {
     const [ shotRecentArray, setShotRecentArray ] = useState([]);
     const [ shotMeanArray, setShotMeanArray ] = useState([]);
     const [ shotStdArray, setShotStdArray ] = useState([]);
+    //lock-in amplitude and phase at the cycle harmonics, one row per harmonic
+    const [ harmonicAmplitudeArray, setHarmonicAmplitudeArray ] = useState([]);
+    const [ harmonicPhaseArray, setHarmonicPhaseArray ] = useState([]);
+    //mean line at each phase of the cycle, and mean pumped minus unpumped line
+    const [ phaseFoldedArray, setPhaseFoldedArray ] = useState([]);
+    const [ pumpedDifference, setPumpedDifference ] = useState([]);
     const [ shotNumber, setShotNumber ] = useState(0);
     const [ shotInfo, setShotInfo ] = useState({}); //TO DO: put state into here to track shots to frames and use for tick marks
 
@@ -63,6 +72,16 @@ export const useAPXPS = ({}) => {
 
     const frameNumber = useRef(null);
 
+    //waterfall assembled from snapshots and deltas, rows are Float32Arrays oldest first,
+    //at the level of detail the server picked for our viewport
+    const waterfallRows = useRef([]);
+    const waterfallSeq = useRef(0);
+    const resyncPending = useRef(false);
+    //messages are handled one at a time in the order they arrived; decoding a
+    //blob or decompressing is async, so a small delta could otherwise be
+    //applied before the large snapshot sent ahead of it
+    const messageQueue = useRef(Promise.resolve());
+
     const isUserClosed = useRef(null);
 
 
@@ -98,6 +117,9 @@ export const useAPXPS = ({}) => {
                 //console.log('got JSON:')
                 //console.log({newMessage});
             }
+            if ('codec' in newMessage) {
+                newMessage = msgpack.decode(await decompress(newMessage.payload, newMessage.codec));
+            }
             //log keys
             //console.log({newMessage})
             var keyList = '';
@@ -112,31 +134,36 @@ export const useAPXPS = ({}) => {
                 frameNumber.current = newMessage.frame_number;
             }
 
+            if ('version' in newMessage && newMessage.version !== BUNDLE_VERSION) {
+                console.warn(`Expected bundle version ${BUNDLE_VERSION}, got ${newMessage.version}`);
+            }
+
             //handle fitted data parameters for line plots
-            if ('fitted' in newMessage) {
-                const fittedData = JSON.parse(newMessage.fitted);
+            if ('peaks' in newMessage) {
+                const fittedData = unpackPeaks(newMessage.peaks);
                 //console.log({fittedData})
                 processPeakData(fittedData, setSinglePeakData, updateCumulativePlot)
             }
 
             //handle heatmap data
-            if ('raw' in newMessage) {
-                //console.log({newMessage})
+            if ('raw_rows' in newMessage) {
                 //send in height as width and vice versa until height/width issues fixed
-                //processArrayData(newMessage.raw,  newMessage.height, newMessage.width, setRawArray);
-                processAndDownsampleArrayData(newMessage.raw,  newMessage.height, newMessage.width, 2, setRawArray);
+                const waterfall = assembleWaterfall(newMessage);
+                if (waterfall !== null) {
+                    processAndDownsampleArrayData(waterfall, newMessage.height, waterfallRows.current.length, 2, setRawArray);
+                }
             }
             if ('vfft' in newMessage) {
                 //console.log({newMessage})
                 //send in height as width and vice versa until height/width issues fixed
-                //processArrayData(newMessage.vfft, newMessage.height,  newMessage.width, setVfftArray);
-                processAndDownsampleArrayData(newMessage.vfft,  newMessage.height, newMessage.width, 2, setVfftArray);
+                const [rows, columns] = newMessage.vfft.shape;
+                processAndDownsampleArrayData(unpackArray(newMessage.vfft), columns, rows, 2, setVfftArray);
             }
             if ('ifft' in newMessage) {
                 //console.log({newMessage})
                 //send in height as width and vice versa until height/width issues fixed
-                //processArrayData(newMessage.ifft, newMessage.height, newMessage.width, setIfftArray);
-                processAndDownsampleArrayData(newMessage.ifft,  newMessage.height, newMessage.width, 2, setIfftArray);
+                const [rows, columns] = newMessage.ifft.shape;
+                processAndDownsampleArrayData(unpackArray(newMessage.ifft), columns, rows, 2, setIfftArray);
             }
 
             if ('msg_type' in newMessage) {
@@ -145,17 +172,31 @@ export const useAPXPS = ({}) => {
                 handleStartDocument(newMessage);
             }
             if ('shot_recent' in newMessage) {
-                //technically metadata won't have f_reset due to stale state at time of function initilization, need to put it into a ref
-                var shotHeight = ("f_reset" in metadata) ? metadata.f_reset : (newMessage.shot_recent.length / newMessage.height)
-                processArrayData(newMessage.shot_recent, newMessage.height, shotHeight, setShotRecentArray)
+                const [shotHeight, shotWidth] = newMessage.shot_recent.shape;
+                processArrayData(unpackArray(newMessage.shot_recent), shotWidth, shotHeight, setShotRecentArray)
             }
             if ('shot_mean' in newMessage) {
-                var shotHeight = ("f_reset" in metadata) ? metadata.f_reset : (newMessage.shot_mean.length / newMessage.height)
-                processArrayData(newMessage.shot_mean, newMessage.height, shotHeight, setShotStdArray)
+                const [shotHeight, shotWidth] = newMessage.shot_mean.shape;
+                processArrayData(unpackArray(newMessage.shot_mean), shotWidth, shotHeight, setShotStdArray)
             }
             if ('shot_std' in newMessage) {
-                var shotHeight = ("f_reset" in metadata) ? metadata.f_reset : (newMessage.shot_std.length / newMessage.height)
-                processArrayData(newMessage.shot_std, newMessage.height, shotHeight, setShotMeanArray)
+                const [shotHeight, shotWidth] = newMessage.shot_std.shape;
+                processArrayData(unpackArray(newMessage.shot_std), shotWidth, shotHeight, setShotMeanArray)
+            }
+            if ('harmonic_amplitude' in newMessage) {
+                const [harmonics, columns] = newMessage.harmonic_amplitude.shape;
+                processArrayData(unpackArray(newMessage.harmonic_amplitude), columns, harmonics, setHarmonicAmplitudeArray)
+            }
+            if ('harmonic_phase' in newMessage) {
+                const [harmonics, columns] = newMessage.harmonic_phase.shape;
+                processArrayData(unpackArray(newMessage.harmonic_phase), columns, harmonics, setHarmonicPhaseArray)
+            }
+            if ('phase_folded' in newMessage) {
+                const [phases, columns] = newMessage.phase_folded.shape;
+                processArrayData(unpackArray(newMessage.phase_folded), columns, phases, setPhaseFoldedArray)
+            }
+            if ('pumped_difference' in newMessage) {
+                setPumpedDifference(Array.from(unpackArray(newMessage.pumped_difference)));
             }
             if ('shot_num' in newMessage) {
                 setShotNumber(newMessage.shot_num);
@@ -166,9 +207,105 @@ export const useAPXPS = ({}) => {
         }
     };
 
+    const requestResync = () => {
+        if (resyncPending.current || !ws.current || ws.current.readyState !== WebSocket.OPEN) return;
+        resyncPending.current = true;
+        ws.current.send(JSON.stringify({type: 'resync'}));
+    };
+
+    const toFloat32Array = (bytes) => {
+        //copy, as the decoded bytes may not be aligned for a Float32Array view
+        const buffer = bytes.buffer.slice(bytes.byteOffset, bytes.byteOffset + bytes.byteLength);
+        return new Float32Array(buffer);
+    };
+
+    //Typed array of an array packed by pack_array on the server, {dtype, shape, data}
+    const unpackArray = (packed) => {
+        switch (packed.dtype) {
+            case '|u1':
+                return packed.data;
+            case '<f4':
+                return toFloat32Array(packed.data);
+            default:
+                throw new Error(`Unsupported array dtype ${packed.dtype}`);
+        }
+    };
+
+    //Peaks packed as one array per column, as a list of {x, h, fwhm}
+    const unpackPeaks = (peaks) => {
+        const x = unpackArray(peaks.x);
+        const h = unpackArray(peaks.h);
+        const fwhm = unpackArray(peaks.fwhm);
+        return Array.from(x, (value, i) => ({x: value, h: h[i], fwhm: fwhm[i]}));
+    };
+
+    //Ask for bundles to be compressed with a codec the browser can decompress
+    const sendCodecs = () => {
+        if (!ws.current || ws.current.readyState !== WebSocket.OPEN) return;
+        if (typeof DecompressionStream === 'undefined') return;
+        ws.current.send(JSON.stringify({type: 'codecs', accept: ['deflate']}));
+    };
+
+    const decompress = async (payload, codec) => {
+        if (codec !== 'deflate') throw new Error(`Unsupported codec ${codec}`);
+        const stream = new Blob([payload]).stream().pipeThrough(new DecompressionStream('deflate'));
+        return new Uint8Array(await new Response(stream).arrayBuffer());
+    };
+
+    //Subscribe to every product, with about as many waterfall rows as the screen can show
+    const sendSubscription = () => {
+        if (!ws.current || ws.current.readyState !== WebSocket.OPEN) return;
+        const rows = Math.round(window.screen.height * (window.devicePixelRatio || 1));
+        ws.current.send(JSON.stringify({type: 'subscribe', rows: rows}));
+    };
+
+    //Apply a waterfall snapshot or delta and return the uint8 display image,
+    //newest row first, or null if the delta does not follow what we have.
+    const assembleWaterfall = (msg) => {
+        const columns = msg.raw_rows.shape[1];
+        if (msg.kind === 'snapshot') {
+            waterfallRows.current = [];
+            resyncPending.current = false;
+        } else if (msg.base_seq !== waterfallSeq.current || msg.raw_start > waterfallRows.current.length) {
+            //missed an update, ask for the full waterfall
+            requestResync();
+            return null;
+        }
+        //the newest row may have been partial, the delta resends it
+        waterfallRows.current.length = msg.raw_start;
+        const values = unpackArray(msg.raw_rows);
+        for (let start = 0; start < values.length; start += columns) {
+            waterfallRows.current.push(values.subarray(start, start + columns));
+        }
+        waterfallSeq.current = msg.seq;
+
+        //same log stretch as convert_to_uint8 on the server
+        const rows = waterfallRows.current;
+        const range = {min: Infinity, max: -Infinity};
+        for (const row of rows) {
+            for (let i = 0; i < row.length; i++) {
+                if (row[i] < range.min) range.min = row[i];
+                if (row[i] > range.max) range.max = row[i];
+            }
+        }
+        const image = new Uint8Array(rows.length * columns);
+        const span = range.max - range.min;
+        if (span > 0) {
+            for (let r = 0; r < rows.length; r++) {
+                const row = rows[rows.length - 1 - r];
+                for (let i = 0; i < columns; i++) {
+                    image[r * columns + i] = Math.trunc(255 * Math.log1p((row[i] - range.min) / span) / Math.LN2);
+                }
+            }
+        }
+        return image;
+    };
+
     const handleStartDocument = (msg) => {
         if (msg.msg_type === 'start') {
             setAllPeakData([]); //clear out cumulative peak data which was from a previous scan
+            waterfallRows.current = [];
+            waterfallSeq.current = 0;
         }
         setMetadata(msg);
     };
@@ -261,6 +398,8 @@ export const useAPXPS = ({}) => {
             setSocketStatus('Open');
             setStatus((oldState) => ({...oldState, ['websocket']: 'connected'}));
             isUserClosed.current = false;
+            sendCodecs();
+            sendSubscription();
         }
 
         ws.current.onerror = (error) => {
@@ -271,7 +410,7 @@ export const useAPXPS = ({}) => {
         }
 
         ws.current.onmessage = (event) => {
-            handleNewWebsocketMessages(event);
+            messageQueue.current = messageQueue.current.then(() => handleNewWebsocketMessages(event));
         };
 
         ws.current.onclose = (event) => {
@@ -389,6 +528,10 @@ export const useAPXPS = ({}) => {
         shotNumber,
         shotRecentArray,
         shotMeanArray,
-        shotStdArray
+        shotStdArray,
+        harmonicAmplitudeArray,
+        harmonicPhaseArray,
+        phaseFoldedArray,
+        pumpedDifference
     }
 }
@@ -0,0 +1,97 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from tr_ap_xps.pipeline.analysis import (
+    ProcessPoolAnalyzer,
+    SharedArrays,
+    analyze_arrays,
+    build_analyzer,
+)
+from tr_ap_xps.pipeline.waterfall import WaterfallBuffer
+
+
+def test_shared_arrays_round_trip():
+    shared = SharedArrays.allocate(
+        {"line": ((3,), np.uint8), "frames": ((2, 3), np.float64)}
+    )
+    try:
+        shared.arrays["line"][:] = [1, 2, 3]
+        shared.arrays["frames"][:] = 0.5
+        attached = SharedArrays.attach(shared.name, shared.layout)
+        assert attached.arrays["line"].tolist() == [1, 2, 3]
+        assert attached.arrays["frames"].ctypes.data % 8 == 0
+        assert (attached.arrays["frames"] == 0.5).all()
+        attached.close()
+    finally:
+        shared.unlink()
+
+
+def test_shared_arrays_not_closed_under_views():
+    shared = SharedArrays.allocate({"frames": ((2, 3), np.float64)})
+    view = shared.arrays["frames"][::-1]
+    view[:] = 1.0
+    shared.shm.unlink()
+    with pytest.raises(BufferError):
+        shared.close()
+    assert view.sum() == 6.0
+    del view
+    shared.close()
+
+
+def test_process_pool_reads_shared_history():
+    rng = np.random.default_rng(0)
+    rows = rng.random((300, 64)) + np.sin(np.arange(64))
+    analyzer = ProcessPoolAnalyzer(workers=1)
+    try:
+        # grows twice, so several blocks are given out during the run
+        waterfall = WaterfallBuffer(64, capacity=100, allocate=analyzer.allocate)
+        for row in rows[:150]:
+            waterfall.append(row)
+        first = analyzer(rows[149], waterfall.newest_first(), 100, np.float32)
+        for row in rows[150:]:
+            waterfall.append(row)
+        history = waterfall.newest_first()
+        pooled = analyzer(rows[-1], history, None, np.float32)
+        names = [shared.name for shared in analyzer._history]
+        analyzer.end_run()
+        for name in names:
+            with pytest.raises(FileNotFoundError):
+                shared_memory.SharedMemory(name=name)
+        # still mapped while the history is referenced
+        np.testing.assert_array_equal(history, rows[::-1])
+    finally:
+        analyzer.shutdown()
+    expected = analyze_arrays(rows[149], rows[:150][::-1], 100, np.float32)
+    np.testing.assert_allclose(first.vfft, expected.vfft)
+    expected = analyze_arrays(rows[-1], rows[::-1], None, np.float32)
+    assert pooled.vfft.shape == (300, 64)
+    np.testing.assert_allclose(pooled.vfft, expected.vfft)
+    np.testing.assert_allclose(pooled.ifft, expected.ifft)
+    del history, waterfall
+    analyzer.end_run()
+    assert analyzer._retired == []
+
+
+def test_process_pool_matches_in_process():
+    rng = np.random.default_rng(0)
+    integrated_frames = rng.random((200, 64)) + np.sin(np.arange(64))
+    line = integrated_frames[0]
+    analyzer = ProcessPoolAnalyzer(workers=1)
+    try:
+        pooled = analyzer(line, integrated_frames, 100, np.float32)
+    finally:
+        analyzer.shutdown()
+    expected = analyze_arrays(line, integrated_frames, 100, np.float32)
+
+    assert pooled.vfft.shape == (100, 64)
+    assert pooled.vfft.dtype == np.float32
+    np.testing.assert_allclose(pooled.vfft, expected.vfft)
+    np.testing.assert_allclose(pooled.ifft, expected.ifft)
+    assert pooled.detected_peaks.equals(expected.detected_peaks)
+
+
+def test_build_analyzer_defaults_to_thread():
+    assert build_analyzer({}) == (analyze_arrays, 1)
+    assert build_analyzer({"backend": "unknown"}) == (analyze_arrays, 1)
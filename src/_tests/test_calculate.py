@@ -4,7 +4,7 @@ import numpy as np
 import pandas as pd
 import pytest
 
-from tr_ap_xps.pipeline.fft import calculate_fft_items
+from tr_ap_xps.pipeline.fft import calculate_fft_items, comb_filter
 from tr_ap_xps.pipeline.peak_fitting import get_peaks, peak_fit
 
 
@@ -65,3 +65,49 @@ def test_fft_items(test_array):
     assert vfft.shape == test_array.shape, "vfft shape mismatch"
     assert len(sum.shape) == 1, "sum should be a 1D array"
     assert ifft.shape == test_array.shape, "ifft shape mismatch"
+
+
+@pytest.mark.parametrize("n_rows", [300, 301])
+def test_fft_items_match_complex_fft(test_array, n_rows):
+    """The shared real-input pass matches the full complex fft products."""
+    array = test_array[:n_rows, :]
+    if n_rows > test_array.shape[0]:
+        array = np.vstack((test_array, test_array[: n_rows - test_array.shape[0]]))
+    vfft, ifft = calculate_fft_items(array, repeat_factor=20, width=1)
+
+    fcarray = np.fft.fft(array, axis=0)
+    expected_vfft = np.abs(np.log(np.abs(fcarray) + 1e-5))
+    step = int(n_rows / 20)
+    filtered = np.zeros(fcarray.shape, dtype=complex)
+    for i in range(0, n_rows, step):
+        filtered[max(0, i - 1) : i + 2] = fcarray[max(0, i - 1) : i + 2]
+    expected_ifft = np.abs(np.fft.ifft(filtered, axis=0))
+
+    np.testing.assert_allclose(vfft, expected_vfft, atol=1e-9)
+    np.testing.assert_allclose(ifft, expected_ifft, atol=1e-9)
+
+
+def test_fft_items_float32(test_array):
+    vfft, ifft = calculate_fft_items(test_array, dtype=np.float32)
+    assert vfft.dtype == np.float32
+    assert ifft.dtype == np.float32
+    assert ifft.shape == test_array.shape
+
+
+def test_comb_filter_cached():
+    comb_filter.cache_clear()
+    comb = comb_filter(301, 20, 1, np.dtype(np.float64))
+    assert comb_filter(301, 20, 1, np.dtype(np.float64)) is comb
+    assert comb_filter.cache_info().hits == 1
+    assert not comb.symmetric.flags.writeable
+    # 301 rows do not divide into the comb evenly, so it is not symmetric
+    assert len(comb.antisymmetric_rows) > 0
+    assert len(comb_filter(300, 20, 0, np.dtype(np.float64)).antisymmetric_rows) == 0
+
+
+def test_fft_items_window(test_array):
+    vfft, ifft = calculate_fft_items(test_array, window=100)
+    expected_vfft, expected_ifft = calculate_fft_items(test_array[:100])
+    assert vfft.shape == (100, test_array.shape[1])
+    np.testing.assert_allclose(vfft, expected_vfft)
+    np.testing.assert_allclose(ifft, expected_ifft)
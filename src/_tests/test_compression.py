@@ -0,0 +1,17 @@
+import pytest
+
+from tr_ap_xps.compression import CODECS, choose_codec, compress, decompress
+
+
+def test_choose_codec():
+    assert choose_codec(["brotli", "deflate"]) == "deflate"
+    assert choose_codec(["deflate"], allowed=["zstd"]) is None
+    assert choose_codec(None) is None
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+def test_round_trip(codec):
+    data = bytes(range(256)) * 100
+    compressed = compress(data, codec)
+    assert len(compressed) < len(data)
+    assert decompress(compressed, codec) == data
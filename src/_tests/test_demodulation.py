@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from tr_ap_xps.pipeline.demodulation import HarmonicDemodulator
+
+
+def test_demodulator_matches_fft():
+    """Over whole cycles, the lock-in matches the column fft at the harmonics."""
+    frames_per_cycle, width, cycles = 8, 5, 6
+    rng = np.random.default_rng(0)
+    waterfall = rng.random((frames_per_cycle * cycles, width))
+
+    demodulator = HarmonicDemodulator(frames_per_cycle, width, harmonics=[0, 1, 3, 4])
+    for frame_number, line in enumerate(waterfall):
+        demodulator.update(frame_number, line)
+
+    spectrum = np.fft.fft(waterfall, axis=0)[[0, cycles, 3 * cycles, 4 * cycles]]
+    n_rows = waterfall.shape[0]
+    expected_amplitude = np.abs(spectrum) / n_rows * np.array([1, 2, 2, 1])[:, None]
+    np.testing.assert_allclose(demodulator.amplitude(), expected_amplitude)
+    np.testing.assert_allclose(
+        np.cos(demodulator.phase()), np.cos(np.angle(spectrum)), atol=1e-9
+    )
+
+
+def test_demodulator_recovers_modulation():
+    frames_per_cycle, width = 10, 3
+    demodulator = HarmonicDemodulator(frames_per_cycle, width, harmonics=[1])
+    for frame_number in range(frames_per_cycle * 4):
+        phase = 2 * np.pi * frame_number / frames_per_cycle
+        demodulator.update(frame_number, 5 + 2 * np.cos(phase) * np.ones(width))
+    np.testing.assert_allclose(demodulator.amplitude(), 2 * np.ones((1, width)))
+
+
+def test_demodulator_rejects_harmonics_above_nyquist():
+    with pytest.raises(ValueError):
+        HarmonicDemodulator(4, 3, harmonics=[3])
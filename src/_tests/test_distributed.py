@@ -0,0 +1,234 @@
+import asyncio
+import threading
+
+import msgpack
+import numpy as np
+import pandas as pd
+import pytest
+import zmq
+import zmq.asyncio
+
+from tr_ap_xps.pipeline.distributed import (
+    ShotDispatcher,
+    decode_result,
+    decode_task,
+    encode_result,
+    encode_task,
+    run_worker,
+)
+from tr_ap_xps.pipeline.statistics import RunningStatistics
+from tr_ap_xps.pipeline.xps_processor import ShotSnapshot, XPSProcessor
+from tr_ap_xps.schemas import (
+    DataFrameModel,
+    NumpyArrayModel,
+    XPSRawFrame,
+    XPSResult,
+    XPSStart,
+)
+from tr_ap_xps.simulator.simulator import start_example
+
+
+def make_start() -> XPSStart:
+    message = dict(start_example)
+    message["scan_name"] = "test"
+    message.update({"F_Reset": 4, "F_Trigger": 1, "F_Un-Trigger": 2, "F_Dead": 3})
+    message["Rectangle"] = {
+        "Left": 0,
+        "Top": 0,
+        "Right": 64,
+        "Bottom": 8,
+        "Rotation": 0,
+    }
+    return XPSStart(**message)
+
+
+def test_results_in_order_with_merged_statistics():
+    start = make_start()
+    rng = np.random.default_rng(0)
+    frames = [XPSRawFrame(i, rng.random((8, 64))) for i in range(25)]
+    published = []
+
+    async def publish(result):
+        published.append(result)
+
+    async def run():
+        dispatcher = ShotDispatcher("tcp://127.0.0.1:*", "tcp://127.0.0.1:*")
+        dispatch_address = dispatcher.tasks.getsockopt_string(zmq.LAST_ENDPOINT)
+        collect_address = dispatcher.results.getsockopt_string(zmq.LAST_ENDPOINT)
+        stop = threading.Event()
+        workers = [
+            threading.Thread(
+                target=run_worker, args=(dispatch_address, collect_address, stop)
+            )
+            for _ in range(2)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            await asyncio.sleep(0.2)  # let the workers connect
+            processor = XPSProcessor(start, shot_statistics=False)
+            dispatcher.start_run(publish, (4, 64))
+            for frame in frames:
+                shot = processor.process_frame(frame)
+                if shot is not None:
+                    dispatcher.submit(shot)
+            await dispatcher.drain()
+            return dispatcher.counters()
+        finally:
+            stop.set()
+            for worker in workers:
+                await asyncio.to_thread(worker.join)
+            dispatcher.close()
+
+    counters = asyncio.run(run())
+    assert counters["submitted"] == 6
+    assert counters["completed"] == 6
+    assert [result.shot_num for result in published] == [1, 2, 3, 4, 5, 6]
+
+    # statistics match those kept by a single processor
+    reference = XPSProcessor(start)
+    expected = [reference.process_frame(frame) for frame in frames]
+    expected = [shot for shot in expected if shot is not None]
+    for result, shot in zip(published, expected):
+        np.testing.assert_allclose(result.shot_mean.array, shot.shot_mean)
+        np.testing.assert_allclose(result.shot_std.array, shot.shot_std)
+        assert result.integrated_frames.array.shape == shot.integrated_frames.shape
+
+
+def test_messages_round_trip_without_pickle():
+    rng = np.random.default_rng(0)
+    history = rng.random((12, 8))
+    shot = ShotSnapshot(
+        frame_number=12,
+        shot_num=3,
+        line=history[0],
+        integrated_frames=history[::-1],
+        shot_recent=history[:4],
+        shot_mean=None,
+        shot_std=None,
+        products={"pumped_difference": NumpyArrayModel(array=history[1])},
+    )
+    run_id, shape, fft_window, fft_dtype, decoded = decode_task(
+        [zmq.Frame(frame) for frame in encode_task("run", (4, 8), 8, "<f4", shot)]
+    )
+    assert (run_id, shape, fft_window, fft_dtype) == ("run", (4, 8), 8, np.float32)
+    np.testing.assert_array_equal(decoded.integrated_frames, history[::-1])
+    assert decoded.shot_mean is None
+    np.testing.assert_array_equal(
+        decoded.products["pumped_difference"].array, history[1]
+    )
+
+    statistics = RunningStatistics((4, 8))
+    statistics.update(history[:4])
+    statistics.update(history[4:8])
+    peaks = pd.DataFrame({"index": [2, 5], "amplitude": [1.5, 2.5]})
+    result = XPSResult(
+        frame_number=12,
+        integrated_frames=NumpyArrayModel(array=history[:0]),
+        detected_peaks=DataFrameModel(df=peaks),
+        vfft=NumpyArrayModel(array=history),
+        ifft=NumpyArrayModel(array=history),
+        shot_num=3,
+        shot_recent=NumpyArrayModel(array=history[:4]),
+        shot_mean=NumpyArrayModel(array=statistics.mean),
+        shot_std=NumpyArrayModel(array=statistics.std()),
+    )
+    frames = encode_result("run", "worker", 3, result, statistics)
+    _, worker_id, shot_num, decoded, merged = decode_result(
+        [zmq.Frame(frame) for frame in frames]
+    )
+    assert (worker_id, shot_num) == ("worker", 3)
+    assert decoded.detected_peaks.df.equals(peaks)
+    np.testing.assert_array_equal(decoded.vfft.array, history)
+    assert decoded.harmonic_phase is None
+    assert merged.count == 2
+    np.testing.assert_array_equal(merged.variance(), statistics.variance())
+
+
+def test_object_arrays_are_refused():
+    header = {
+        "run_id": "run",
+        "worker_id": "worker",
+        "shot_num": 1,
+        "result": None,
+        "statistics": {
+            "alpha": None,
+            "count": 1,
+            "mean": {"dtype": "|O", "shape": [1], "frame": 1},
+            "m2": {"dtype": "<f8", "shape": [1], "frame": 2},
+        },
+    }
+    frames = [msgpack.packb(header), b"\0" * 8, b"\0" * 8]
+    with pytest.raises(TypeError):
+        decode_result(frames)
+
+
+def test_result_after_shot_given_up_is_dropped():
+    shape = (4, 8)
+    statistics = RunningStatistics(shape)
+
+    async def run():
+        dispatcher = ShotDispatcher(
+            "tcp://127.0.0.1:*", "tcp://127.0.0.1:*", max_reorder=2
+        )
+        context = zmq.asyncio.Context.instance()
+        # stands in for the workers
+        tasks = context.socket(zmq.PULL)
+        tasks.connect(dispatcher.tasks.getsockopt_string(zmq.LAST_ENDPOINT))
+        results = context.socket(zmq.PUSH)
+        results.connect(dispatcher.results.getsockopt_string(zmq.LAST_ENDPOINT))
+
+        async def publish(result):
+            pass
+
+        async def deliver(shot_num):
+            # a failed shot, so nothing needs to be published
+            await results.send_multipart(
+                encode_result(dispatcher.run_id, "worker", shot_num, None, statistics)
+            )
+
+        async def settled(**counters):
+            while any(dispatcher.counters()[k] != v for k, v in counters.items()):
+                await asyncio.sleep(0.01)
+
+        def submit(shot_num):
+            history = np.zeros((shot_num * 4, 8))
+            dispatcher.submit(
+                ShotSnapshot(
+                    shot_num * 4,
+                    shot_num,
+                    history[0],
+                    history,
+                    history[:4],
+                    None,
+                    None,
+                    {},
+                )
+            )
+
+        await asyncio.sleep(0.1)  # let the sockets connect
+        try:
+            dispatcher.start_run(publish, shape, fft_window=8)
+            for shot_num in (1, 2, 3):
+                submit(shot_num)
+            await deliver(2)
+            await deliver(3)  # two results behind shot 1, so it is given up
+            await asyncio.wait_for(settled(skipped=1, failed=2), 5)
+            await deliver(1)  # too late
+            for shot_num in (4, 5):
+                submit(shot_num)
+            await deliver(5)
+            await asyncio.sleep(0.1)
+            assert dispatcher.counters()["skipped"] == 1  # shot 4 still awaited
+            await deliver(4)
+            await asyncio.wait_for(dispatcher.drain(), 5)
+            return dispatcher.counters()
+        finally:
+            tasks.close(linger=0)
+            results.close(linger=0)
+            dispatcher.close()
+
+    counters = asyncio.run(run())
+    assert counters["submitted"] == 5
+    assert counters["skipped"] == 1
+    assert counters["failed"] == 4
@@ -0,0 +1,87 @@
+import asyncio
+import multiprocessing
+
+import numpy as np
+
+from tr_ap_xps.frame_ring import RingChannel, RingConsumer, SharedMemoryForwarder
+from tr_ap_xps.schemas import XPSRawFrame, XPSStart, XPSStop
+from tr_ap_xps.simulator.simulator import start_example
+
+
+def make_start() -> XPSStart:
+    message = dict(start_example)
+    message["scan_name"] = "test"
+    message["data_type"] = "U16"
+    message["Rectangle"] = {"Left": 0, "Top": 0, "Right": 4, "Bottom": 3, "Rotation": 0}
+    return XPSStart(**message)
+
+
+class SummingOperator:
+    """Records the sum of each frame, as the frame is only valid until process returns"""
+
+    def __init__(self, results):
+        self.results = results
+
+    async def process(self, message):
+        if isinstance(message, XPSRawFrame):
+            self.results.put((message.frame_number, int(message.image.sum())))
+        elif isinstance(message, XPSStop):
+            self.results.put(("stop", message.ingest_counters))
+        else:
+            self.results.put(type(message).__name__)
+
+
+def run_consumer(channel: RingChannel, results):
+    asyncio.run(RingConsumer(channel, SummingOperator(results)).start())
+
+
+async def forward(forwarder: SharedMemoryForwarder, num_frames: int):
+    await forwarder.process(make_start())
+    for i in range(num_frames):
+        image = np.full((3, 4), i, dtype=np.uint16)
+        await forwarder.process(XPSRawFrame(i, image))
+    await forwarder.process(XPSStop(ingest_counters={"received": num_frames}))
+
+
+def test_frames_cross_process_boundary():
+    context = multiprocessing.get_context("spawn")
+    channel = RingChannel.create(context)
+    results = context.Queue()
+    consumer = context.Process(target=run_consumer, args=(channel, results))
+    consumer.start()
+    try:
+        # fewer slots than frames, so slots are reused
+        forwarder = SharedMemoryForwarder(channel, slots=2)
+        asyncio.run(forward(forwarder, num_frames=10))
+        received = [results.get(timeout=30) for _ in range(12)]
+    finally:
+        channel.control.put(None)
+        consumer.join(timeout=30)
+
+    assert received[0] == "XPSStart"
+    assert received[1:11] == [(i, 12 * i) for i in range(10)]
+    stop, counters = received[11]
+    assert stop == "stop"
+    assert counters["received"] == 10
+    assert "ring_waits" in counters
+    assert forwarder.ring is None
+
+
+def test_forwarder_waits_for_free_slots():
+    channel = RingChannel.create()
+    results = multiprocessing.get_context("spawn").Queue()
+    consumer = RingConsumer(channel, SummingOperator(results))
+
+    async def run():
+        consumer_task = asyncio.create_task(consumer.start())
+        forwarder = SharedMemoryForwarder(channel, slots=1)
+        await forward(forwarder, num_frames=3)
+        consumer.stop()
+        await consumer_task
+        return forwarder
+
+    forwarder = asyncio.run(run())
+    received = [results.get(timeout=5) for _ in range(5)]
+    assert received[1:4] == [(0, 0), (1, 12), (2, 24)]
+    assert forwarder.waits >= 1
+    assert received[4][1]["ring_waits"] == forwarder.waits
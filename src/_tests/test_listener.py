@@ -1,13 +1,22 @@
 import asyncio
 import contextlib
+import json
 import threading
 from unittest.mock import AsyncMock
 
+import numpy as np
 import pytest
 
-from tr_ap_xps.labview import XPSLabviewZMQListener, setup_zmq
-from tr_ap_xps.schemas import XPSRawEvent, XPSStart, XPSStop
-from tr_ap_xps.simulator.simulator import start
+from tr_ap_xps.labview import (
+    DATATYPE_MAP,
+    FramePool,
+    LabviewFramer,
+    XPSLabviewZMQListener,
+    parse_header,
+    setup_zmq,
+)
+from tr_ap_xps.schemas import XPSRawFrame, XPSStart, XPSStop
+from tr_ap_xps.simulator.simulator import start, start_example
 
 
 @contextlib.asynccontextmanager
@@ -58,8 +67,63 @@ async def test_listen_zmq_interface(mock_operator):
             call_args[0][0][0], XPSStart
         ), f"First argument is not an instance of XPSStart: {call_args[0][0][0]}"
         assert isinstance(
-            call_args[1][0][0], XPSRawEvent
-        ), f"Second argument is not an instance of XPSRawEvent: {call_args[1][0][0]}"
+            call_args[1][0][0], XPSRawFrame
+        ), f"Second argument is not an instance of XPSRawFrame: {call_args[1][0][0]}"
         assert isinstance(
             call_args[2][0][0], XPSStop
         ), f"Second argument is not an instance of XPSStop: {call_args[2][0][0]}"
+
+
+def test_frame_pool_byte_swaps_once():
+    expected = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    buffer = memoryview(expected.astype(">u2").tobytes())
+    pool = FramePool((3, 4), DATATYPE_MAP["U16"], size=2)
+
+    first = pool.to_native(buffer)
+    assert first.dtype.isnative
+    np.testing.assert_array_equal(first, expected)
+    second = pool.to_native(buffer)
+    assert second is not first
+    assert pool.to_native(buffer) is first  # buffers are reused round robin
+
+
+def test_frame_pool_single_byte_is_zero_copy():
+    buffer = bytearray(range(12))
+    pool = FramePool((3, 4), DATATYPE_MAP["U8"])
+    frame = pool.to_native(memoryview(buffer))
+    buffer[0] = 42
+    assert frame[0, 0] == 42
+
+
+def test_parse_header_rejects_payloads():
+    assert parse_header(b'{"msg_type": "stop"}') == {"msg_type": "stop"}
+    assert parse_header(b"{not json") is None
+    assert parse_header(b"{" + b"x" * 10000) is None
+    assert parse_header(bytes(range(256))) is None
+
+
+def test_framer_pairs_headers_and_payloads():
+    framer = LabviewFramer()
+    start_message = framer.feed([json.dumps(start_example).encode()])
+    assert start_message.msg_type == "start"
+
+    rectangle = start_example["Rectangle"]
+    size = (rectangle["Bottom"] - rectangle["Top"]) * (
+        rectangle["Right"] - rectangle["Left"]
+    )
+    # A payload that happens to look like JSON is still taken as the image
+    payload = b"{" + bytes(size - 1)
+    assert framer.feed([b'{"msg_type": "event", "Frame Number": 1}']) is None
+    event = framer.feed([payload])
+    assert event.msg_type == "event"
+    assert event.header["Frame Number"] == 1
+    assert event.payload == payload
+
+    # Out of step: an image without a header is dropped
+    assert framer.feed([bytes(size)]) is None
+
+    # Multipart events carry the header and image together
+    event = framer.feed([b'{"msg_type": "event", "Frame Number": 2}', payload])
+    assert event.header["Frame Number"] == 2
+
+    assert framer.feed([b'{"msg_type": "stop"}']).msg_type == "stop"
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from tr_ap_xps.pipeline import xps_processor
+from tr_ap_xps.pipeline.phase_folding import PhaseFoldedAccumulator
+from tr_ap_xps.schemas import XPSStart
+from tr_ap_xps.simulator.simulator import start_example
+
+
+def test_phase_folding():
+    frames_per_cycle, width = 6, 4
+    accumulator = PhaseFoldedAccumulator(
+        frames_per_cycle, width, f_trigger=2, f_untrigger=4, f_dead=5
+    )
+    rng = np.random.default_rng(0)
+    waterfall = rng.random((frames_per_cycle * 3 + 2, width))
+    for frame_number, line in enumerate(waterfall):
+        accumulator.update(frame_number, line)
+
+    phases = np.arange(len(waterfall)) % frames_per_cycle
+    for phase in range(frames_per_cycle):
+        np.testing.assert_allclose(
+            accumulator.folded_mean()[phase], waterfall[phases == phase].mean(axis=0)
+        )
+    pumped = waterfall[(phases >= 2) & (phases < 4)].mean(axis=0)
+    unpumped = waterfall[phases < 2].mean(axis=0)
+    np.testing.assert_allclose(accumulator.difference(), pumped - unpumped)
+
+
+def test_phase_folding_empty():
+    accumulator = PhaseFoldedAccumulator(4, 3, 1, 2, 3)
+    assert not accumulator.folded_mean().any()
+    assert not accumulator.difference().any()
+
+
+def test_phase_folding_rejects_bad_timing():
+    with pytest.raises(ValueError):
+        PhaseFoldedAccumulator(4, 3, f_trigger=3, f_untrigger=2, f_dead=4)
+
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_phase_folding_setting(monkeypatch, enabled):
+    monkeypatch.setattr(
+        xps_processor, "app_settings", {"phase_folding": {"enabled": enabled}}
+    )
+    processor = xps_processor.XPSProcessor(
+        XPSStart(**dict(start_example, scan_name="test"))
+    )
+    assert (processor.phase_folding is not None) == enabled
+    assert ("phase_folded" in processor._phase_folding_products()) == enabled
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from tr_ap_xps.pyramid import WaterfallPyramid, decimate, level_for
+
+WATERFALL = np.random.default_rng(0).random((300, 8)).astype(np.float32)
+
+
+def appended(reduce="mean"):
+    pyramid = WaterfallPyramid(reduce)
+    rng = np.random.default_rng(1)
+    row = 0
+    while row < len(WATERFALL):
+        count = rng.integers(1, 20)
+        pyramid.append(WATERFALL[row : row + count])
+        row += count
+    return pyramid
+
+
+def test_level_for():
+    assert level_for(100) == 0
+    assert level_for(100, 100) == 0
+    assert level_for(101, 100) == 1
+    assert level_for(1000, 100) == 4
+
+
+@pytest.mark.parametrize("reduce", ["mean", "max"])
+@pytest.mark.parametrize("max_rows", [None, 1, 7, 40, 299])
+def test_section_matches_decimated_waterfall(reduce, max_rows):
+    section = appended(reduce).section(max_rows)
+    expected = decimate(WATERFALL, section.level, reduce)
+    assert len(section.rows) <= (max_rows or len(WATERFALL))
+    np.testing.assert_allclose(section.rows, expected, rtol=1e-5)
+    assert section.complete == len(WATERFALL) >> section.level
+
+
+def test_section_of_range():
+    section = appended().section(10, first=100, last=200)
+    assert (section.level, section.first) == (4, 6)
+    np.testing.assert_allclose(section.rows, decimate(WATERFALL[96:208], 4), rtol=1e-5)
+
+
+def test_reduce_must_be_known():
+    with pytest.raises(ValueError):
+        WaterfallPyramid("median")
@@ -0,0 +1,194 @@
+import asyncio
+import threading
+
+import pytest
+
+from arroyo.schemas import Event, Start, Stop
+from tr_ap_xps.queues import (
+    CoalescingPublisher,
+    FrameQueue,
+    OverflowPolicy,
+    QueueClosed,
+    QueuedPublisher,
+)
+
+
+def drain(queue: FrameQueue) -> list:
+    async def get_all():
+        items = []
+        while True:
+            try:
+                items.append(await queue.get())
+            except QueueClosed:
+                return items
+
+    queue.close()
+    return asyncio.run(get_all())
+
+
+def test_drop_newest_keeps_control_items():
+    queue = FrameQueue(maxsize=2, policy=OverflowPolicy.drop_newest)
+    queue.put("start", droppable=False)
+    assert [queue.put(i) for i in range(4)] == [True, True, False, False]
+    queue.put("stop", droppable=False)
+
+    assert queue.counters()["received"] == 4
+    assert queue.counters()["dropped"] == 2
+    assert drain(queue) == ["start", 0, 1, "stop"]
+
+
+def test_drop_oldest():
+    queue = FrameQueue(maxsize=2, policy="drop_oldest")
+    queue.put("start", droppable=False)
+    for i in range(4):
+        queue.put(i)
+
+    counters = queue.counters()
+    assert counters["queued"] == 4
+    assert counters["dropped"] == 2
+    assert drain(queue) == ["start", 2, 3]
+
+
+def test_block_waits_for_consumer():
+    queue = FrameQueue(maxsize=1)
+
+    def produce():
+        for i in range(5):
+            queue.put(i)
+        queue.close()
+
+    async def consume():
+        items = []
+        thread = threading.Thread(target=produce)
+        thread.start()
+        while True:
+            try:
+                items.append(await queue.get())
+            except QueueClosed:
+                break
+        await asyncio.to_thread(thread.join)
+        return items
+
+    assert asyncio.run(consume()) == [0, 1, 2, 3, 4]
+    assert queue.counters()["dropped"] == 0
+
+
+def test_late_items_counted():
+    queue = FrameQueue(late_after=0.0)
+    queue.put(0)
+    assert drain(queue) == [0]
+    assert queue.late == 1
+
+
+def test_invalid_maxsize():
+    with pytest.raises(ValueError):
+        FrameQueue(maxsize=0)
+
+
+class Result(Event):
+    frame_number: int
+
+
+def make_result(frame_number: int) -> Result:
+    return Result(frame_number=frame_number)
+
+
+def make_control_messages():
+    return Start(), Stop()
+
+
+class SlowPublisher:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.published = []
+
+    async def publish(self, message):
+        await asyncio.sleep(self.delay)
+        self.published.append(message)
+
+
+def test_queued_publisher_drops_stale_results():
+    slow = SlowPublisher(delay=0.01)
+    queued = QueuedPublisher(slow, maxsize=1, policy="drop_oldest")
+    start, stop = make_control_messages()
+
+    async def run():
+        await queued.publish(start)
+        for i in range(5):
+            await queued.publish(make_result(i))
+        await queued.publish(stop)
+        await queued.drain()
+        await queued.stop()
+
+    asyncio.run(run())
+    assert slow.published[0] is start
+    assert slow.published[-1] is stop
+    assert slow.published[1].frame_number == 4  # the newest result got through
+    assert queued.counters()["received"] == 0  # reset after the stop message
+
+
+def test_slow_publisher_does_not_delay_others():
+    slow = QueuedPublisher(SlowPublisher(delay=0.5), maxsize=10)
+    fast_publisher = SlowPublisher()
+    fast = QueuedPublisher(fast_publisher, maxsize=10)
+
+    async def run():
+        for publisher in (slow, fast):
+            await publisher.publish(make_result(0))
+        await asyncio.wait_for(fast.drain(), 0.2)
+        await slow.stop()
+        await fast.stop()
+
+    asyncio.run(run())
+    assert len(fast_publisher.published) == 1
+
+
+def test_unbounded_queue_never_holds_up_the_operator(caplog):
+    stuck = SlowPublisher(delay=60)
+    queued = QueuedPublisher(stuck, maxsize=None, warn_depth=4)
+
+    async def run():
+        # would wait for the stuck publisher with any maxsize and block
+        await asyncio.wait_for(
+            asyncio.gather(*(queued.publish(make_result(i)) for i in range(10))),
+            0.5,
+        )
+        counters = queued.counters()
+        await queued.stop()
+        return counters
+
+    with caplog.at_level("WARNING", logger="tr_ap_xps.queues"):
+        counters = asyncio.run(run())
+    assert counters["queued"] == 10
+    assert counters["dropped"] == 0
+    # at depth 4 and 8
+    assert len([r for r in caplog.records if "queue holds" in r.message]) == 2
+
+
+def test_coalescing_publisher_publishes_newest():
+    publisher = SlowPublisher()
+    coalescing = CoalescingPublisher(publisher, max_rate=20)  # one per 50 ms
+    start, stop = make_control_messages()
+
+    async def run():
+        await coalescing.publish(start)
+        for i in range(5):
+            await coalescing.publish(make_result(i))
+            await asyncio.sleep(0)
+        counters = coalescing.counters()
+        await asyncio.sleep(0.1)
+        await coalescing.publish(make_result(5))  # held until the window opens
+        await coalescing.publish(stop)
+        return counters
+
+    counters = asyncio.run(run())
+    assert [getattr(m, "frame_number", None) for m in publisher.published] == [
+        None,
+        0,
+        4,
+        5,
+        None,
+    ]
+    assert publisher.published[-1] is stop
+    assert counters == {"received": 5, "published": 1, "coalesced": 3}
+    assert coalescing.counters()["received"] == 0  # reset after the stop message
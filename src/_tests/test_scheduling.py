@@ -0,0 +1,79 @@
+import asyncio
+import threading
+
+from tr_ap_xps.pipeline.scheduling import LatestWinsScheduler
+
+
+def test_waiting_job_is_superseded():
+    release = threading.Event()
+    published = []
+
+    def analyze(job):
+        if job == 0:
+            release.wait(timeout=5)
+        return job
+
+    async def publish(result):
+        published.append(result)
+
+    async def run():
+        scheduler = LatestWinsScheduler(analyze, publish)
+        scheduler.submit(0)
+        await asyncio.sleep(0.05)  # job 0 is running
+        for job in (1, 2, 3):
+            scheduler.submit(job)
+        release.set()
+        await scheduler.drain()
+        return scheduler.counters()
+
+    counters = asyncio.run(run())
+    assert published == [0, 3]
+    assert counters == {"submitted": 4, "completed": 2, "superseded": 2, "failed": 0}
+
+
+def test_failed_jobs_are_counted():
+    def analyze(job):
+        if job == 1:
+            raise RuntimeError("bad shot")
+        return None if job == 2 else job
+
+    published = []
+
+    async def publish(result):
+        published.append(result)
+
+    async def run():
+        scheduler = LatestWinsScheduler(analyze, publish)
+        for job in (0, 1, 2):
+            scheduler.submit(job)
+            await scheduler.drain()
+        return scheduler.counters()
+
+    counters = asyncio.run(run())
+    assert published == [0]
+    assert counters["failed"] == 2
+    assert counters["completed"] == 1
+
+
+def test_concurrent_jobs_publish_in_order():
+    started = threading.Barrier(2, timeout=5)
+
+    def analyze(job):
+        started.wait()  # both jobs run at once
+        return job
+
+    published = []
+
+    async def publish(result):
+        published.append(result)
+
+    async def run():
+        scheduler = LatestWinsScheduler(analyze, publish, max_concurrency=2)
+        scheduler.submit(0)
+        scheduler.submit(1)
+        await scheduler.drain()
+        return scheduler.counters()
+
+    counters = asyncio.run(run())
+    assert published == [0, 1]
+    assert counters["superseded"] == 0
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from tr_ap_xps.pipeline.statistics import RunningStatistics
+
+
+@pytest.fixture
+def shots():
+    rng = np.random.default_rng(0)
+    return (1e6 + rng.random((20, 4, 3))).astype(np.float32)
+
+
+def test_running_statistics(shots):
+    statistics = RunningStatistics(shots.shape[1:])
+    for shot in shots:
+        statistics.update(shot)
+
+    assert statistics.mean.dtype == np.float64
+    expected = shots.astype(np.float64)
+    np.testing.assert_allclose(statistics.mean, expected.mean(axis=0))
+    np.testing.assert_allclose(statistics.std(), expected.std(axis=0), rtol=1e-6)
+    assert not np.shares_memory(statistics.std(), statistics.variance())
+
+
+def test_running_statistics_merge(shots):
+    combined = RunningStatistics(shots.shape[1:])
+    for shot in shots:
+        combined.update(shot)
+
+    partials = [RunningStatistics(shots.shape[1:]) for _ in range(3)]
+    for i, shot in enumerate(shots):
+        partials[i % 3].update(shot)
+    merged = RunningStatistics(shots.shape[1:])
+    for partial in partials:
+        merged.merge(partial)
+
+    assert merged.count == combined.count
+    np.testing.assert_allclose(merged.mean, combined.mean)
+    np.testing.assert_allclose(merged.variance(), combined.variance(), rtol=1e-6)
+
+
+def test_exponentially_weighted_statistics(shots):
+    alpha = 0.1
+    statistics = RunningStatistics(shots.shape[1:], alpha=alpha)
+    mean = shots[0].astype(np.float64)
+    variance = np.zeros(shots.shape[1:])
+    statistics.update(shots[0])
+    for shot in shots[1:]:
+        statistics.update(shot)
+        delta = shot - mean
+        mean = mean + alpha * delta
+        variance = (1 - alpha) * (variance + alpha * delta**2)
+
+    np.testing.assert_allclose(statistics.mean, mean)
+    np.testing.assert_allclose(statistics.variance(), variance)
+    with pytest.raises(ValueError):
+        statistics.merge(RunningStatistics(shots.shape[1:]))
+
+
+def test_state_round_trip():
+    stats = RunningStatistics((2, 3))
+    stats.update(np.ones((2, 3)))
+    stats.update(np.zeros((2, 3)))
+    restored = RunningStatistics.from_state(stats.state())
+    assert restored.mean is not stats.mean
+    np.testing.assert_array_equal(restored.variance(), stats.variance())
+    restored.update(np.ones((2, 3)))
+    assert restored.count == 3
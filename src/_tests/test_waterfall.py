@@ -0,0 +1,43 @@
+import numpy as np
+
+from tr_ap_xps.pipeline.waterfall import WaterfallBuffer
+
+
+def test_growable_waterfall():
+    waterfall = WaterfallBuffer(width=3, capacity=2)
+    for i in range(5):
+        waterfall.append(np.full(3, i))
+
+    assert waterfall.shape == (5, 3)
+    assert waterfall.capacity >= 5
+    assert waterfall.oldest_first()[:, 0].tolist() == [0, 1, 2, 3, 4]
+    assert waterfall.newest_first()[:, 0].tolist() == [4, 3, 2, 1, 0]
+    assert waterfall.newest(2)[:, 0].tolist() == [4, 3]
+
+
+def test_growable_views_survive_appends():
+    waterfall = WaterfallBuffer(width=2, capacity=2)
+    waterfall.append(np.zeros(2))
+    waterfall.append(np.ones(2))
+    view = waterfall.newest_first()
+    for i in range(10):
+        waterfall.append(np.full(2, i + 2))
+    assert view[:, 0].tolist() == [1, 0]
+
+
+def test_ring_waterfall():
+    waterfall = WaterfallBuffer(width=2, max_rows=3)
+    for i in range(7):
+        waterfall.append(np.full(2, i))
+
+    assert len(waterfall) == 3
+    assert waterfall.total_appended == 7
+    oldest_first = waterfall.oldest_first()
+    assert oldest_first[:, 0].tolist() == [4, 5, 6]
+    assert np.shares_memory(oldest_first, waterfall._storage)
+    assert waterfall.newest_first()[:, 0].tolist() == [6, 5, 4]
+
+    waterfall.clear()
+    assert len(waterfall) == 0
+    waterfall.append(np.full(2, 9))
+    assert waterfall.oldest_first()[:, 0].tolist() == [9]
@@ -0,0 +1,465 @@
+import asyncio
+import json
+
+import msgpack
+import numpy as np
+import pandas as pd
+import websockets
+
+from tr_ap_xps import websockets as ws_module
+from tr_ap_xps.compression import decompress
+from tr_ap_xps.pyramid import decimate
+from tr_ap_xps.schemas import DataFrameModel, NumpyArrayModel, XPSResult, XPSStart
+from tr_ap_xps.simulator.simulator import start_example
+from tr_ap_xps.websockets import ClientSender, LogStretch, XPSWSResultPublisher
+
+WATERFALL = np.random.default_rng(0).random((40, 16))
+
+
+def make_result(shot_num: int = 1) -> XPSResult:
+    rng = np.random.default_rng(shot_num)
+    return XPSResult(
+        frame_number=shot_num * 4,
+        # newest row first, 4 rows per shot
+        integrated_frames=NumpyArrayModel(array=WATERFALL[: shot_num * 4][::-1]),
+        detected_peaks=DataFrameModel(
+            df=pd.DataFrame({"index": [3], "amplitude": [1.0], "FWHM": [2.0]})
+        ),
+        vfft=NumpyArrayModel(array=rng.random((8, 16))),
+        ifft=NumpyArrayModel(array=rng.random((8, 16))),
+        shot_num=shot_num,
+        shot_recent=NumpyArrayModel(array=rng.random((4, 16))),
+        shot_mean=NumpyArrayModel(array=rng.random((4, 16))),
+        shot_std=NumpyArrayModel(array=rng.random((4, 16))),
+    )
+
+
+def unpack_array(packed: dict) -> np.ndarray:
+    return np.frombuffer(packed["data"], dtype=packed["dtype"]).reshape(packed["shape"])
+
+
+async def serve(publisher: XPSWSResultPublisher):
+    server = await websockets.serve(publisher.websocket_handler, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, f"ws://127.0.0.1:{port}/simImages"
+
+
+def test_result_encoded_once_for_all_clients(monkeypatch):
+    calls = []
+    encode_result = ws_module.encode_result
+
+    def counting_encode(message, *args):
+        calls.append(message.shot_num)
+        return encode_result(message, *args)
+
+    monkeypatch.setattr(ws_module, "encode_result", counting_encode)
+
+    async def run():
+        publisher = XPSWSResultPublisher()
+        server, url = await serve(publisher)
+        clients = [await websockets.connect(url) for _ in range(3)]
+        while len(publisher.clients) < 3:
+            await asyncio.sleep(0.01)
+        await publisher.publish(make_result())
+        received = [[await client.recv() for _ in range(2)] for client in clients]
+        for client in clients:
+            await client.close()
+        server.close()
+        await server.wait_closed()
+        return received
+
+    received = asyncio.run(run())
+    assert calls == [1]
+    assert json.loads(received[0][0]) == {"frame_number": 4}
+    assert all(frames == received[0] for frames in received)
+
+
+def test_late_client_gets_latest_result():
+    async def run():
+        publisher = XPSWSResultPublisher()
+        server, url = await serve(publisher)
+        first = await websockets.connect(url)
+        while not publisher.clients:
+            await asyncio.sleep(0.01)
+        await publisher.publish(make_result(1))
+        await publisher.publish(make_result(2))
+        late = await websockets.connect(url)
+        received = [await late.recv() for _ in range(2)]
+        await first.close()
+        await late.close()
+        server.close()
+        await server.wait_closed()
+        return received
+
+    info, bundle = asyncio.run(run())
+    assert json.loads(info) == {"frame_number": 8}
+    assert isinstance(bundle, bytes)
+
+
+def test_deltas_and_resync():
+    async def run():
+        publisher = XPSWSResultPublisher()
+        server, url = await serve(publisher)
+        await publisher.publish(make_result(1))
+        client = await websockets.connect(url)
+        received = [await client.recv() for _ in range(2)]  # snapshot on connect
+        while not publisher.clients:
+            await asyncio.sleep(0.01)
+        await publisher.publish(make_result(2))
+        await publisher.publish(make_result(3))
+        received += [await client.recv() for _ in range(4)]
+        await client.send(json.dumps({"type": "resync"}))
+        received += [await client.recv() for _ in range(2)]
+        await client.close()
+        server.close()
+        await server.wait_closed()
+        return [msgpack.unpackb(bundle) for bundle in received[1::2]]
+
+    snapshot, delta2, delta3, resync = asyncio.run(run())
+
+    def rows(bundle):
+        return unpack_array(bundle["raw_rows"])
+
+    assert (snapshot["kind"], snapshot["seq"], snapshot["raw_start"]) == (
+        "snapshot",
+        1,
+        0,
+    )
+    np.testing.assert_allclose(rows(snapshot), WATERFALL[:4], rtol=1e-6)
+    assert (delta2["kind"], delta2["seq"], delta2["raw_start"]) == ("delta", 2, 4)
+    np.testing.assert_allclose(rows(delta2), WATERFALL[4:8], rtol=1e-6)
+    assert (delta3["seq"], delta3["raw_start"]) == (3, 8)
+    assert (resync["kind"], resync["seq"]) == ("snapshot", 3)
+    np.testing.assert_allclose(rows(resync), WATERFALL[:12], rtol=1e-6)
+
+
+class SlowWebSocket:
+    remote_address = ("127.0.0.1", 1)
+
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+        self.closed = None
+
+    async def send(self, frame):
+        await self.gate.wait()
+        self.sent.append(frame)
+
+    async def close(self, code=1000, reason=""):
+        self.closed = code
+
+
+def test_slow_client_skips_to_latest():
+    async def run():
+        websocket = SlowWebSocket()
+        snapshots = []
+
+        async def snapshot(client):
+            snapshots.append(len(snapshots))
+            return ["info", "snapshot"]
+
+        client = ClientSender(websocket, snapshot, max_queued=2)
+        client.start()
+        client.send_result(["info", "delta1"])
+        await asyncio.sleep(0)  # delta1 is being sent
+        client.send_result(["info", "delta2"])
+        client.send_result(["info", "delta3"])
+        queued = client.counters()["queued_bytes"]
+        client.send_result(["info", "delta4"])  # full, skip to a snapshot
+        client.send_result(["info", "delta5"])
+        counters = client.counters()
+        websocket.gate.set()
+        while client.sent < 2:
+            await asyncio.sleep(0.01)
+        client.send_result(["info", "delta6"])
+        while client.sent < 3:
+            await asyncio.sleep(0.01)
+        client.stop()
+        return websocket.sent, queued, counters, snapshots
+
+    sent, queued, counters, snapshots = asyncio.run(run())
+    assert sent == ["info", "delta1", "info", "snapshot", "info", "delta6"]
+    assert queued == 2 * len("infodelta2")
+    assert counters["dropped"] == 4
+    assert counters["queued_bytes"] == 0
+    assert snapshots == [0]
+
+
+def test_stalled_client_disconnected():
+    async def run():
+        websocket = SlowWebSocket()
+        client = ClientSender(websocket, None, stall_timeout=0.05)
+        client.start()
+        client.send_start("start")
+        await asyncio.wait_for(client._task, 1)
+        return websocket
+
+    websocket = asyncio.run(run())
+    assert websocket.closed == 1013
+    assert websocket.sent == []
+
+
+def reference_stretch(image):
+    # the float64 conversion convert_to_uint8 used to do
+    image_normalized = (image - image.min()) / (image.max() - image.min())
+    log_stretched = np.log1p(image_normalized)
+    log_stretched_normalized = (log_stretched - log_stretched.min()) / (
+        log_stretched.max() - log_stretched.min()
+    )
+    return (log_stretched_normalized * 255).astype(np.uint8)
+
+
+def test_log_stretch():
+    stretch = LogStretch()
+    image = np.random.default_rng(0).random((50, 30)) * 1e4 - 10
+    out = stretch.stretch(image)
+    expected = reference_stretch(image)
+    assert out.dtype == np.uint8 and out.shape == image.shape
+    assert np.abs(out.astype(int) - expected).max() <= 1
+    assert (out.min(), out.max()) == (0, 255)
+
+    counts = np.random.default_rng(1).integers(3, 4000, (20, 30), dtype=np.uint16)
+    assert (
+        np.abs(stretch.stretch(counts).astype(int) - reference_stretch(counts)).max()
+        <= 1
+    )
+
+    assert stretch(np.full((4, 4), 7.0)) == bytes(16)
+
+
+def test_log_stretch_reuses_buffers():
+    stretch = LogStretch()
+    first = stretch.stretch(np.arange(12.0).reshape(3, 4))
+    second = stretch.stretch(np.arange(6.0))
+    assert np.shares_memory(first, second)
+
+
+def test_viewport_gets_level_of_detail():
+    async def run():
+        publisher = XPSWSResultPublisher()
+        server, url = await serve(publisher)
+        client = await websockets.connect(url)
+        await client.send(json.dumps({"type": "subscribe", "rows": 3}))
+        viewport = ws_module.Viewport(max_rows=3)
+        while [c.subscription.viewport for c in publisher.clients.values()] != [
+            viewport
+        ]:
+            await asyncio.sleep(0.01)
+        await publisher.publish(make_result(1))  # 4 rows
+        received = [await client.recv() for _ in range(2)]
+        await publisher.publish(make_result(2))  # 8 rows
+        received += [await client.recv() for _ in range(2)]
+        await client.close()
+        server.close()
+        await server.wait_closed()
+        return [msgpack.unpackb(bundle) for bundle in received[1::2]]
+
+    first, second = asyncio.run(run())
+    assert (first["kind"], first["level"]) == ("snapshot", 1)
+    rows = unpack_array(first["raw_rows"])
+    np.testing.assert_allclose(rows, decimate(WATERFALL[:4], 1), rtol=1e-6)
+    # the waterfall outgrew level 1
+    assert (second["kind"], second["level"]) == ("snapshot", 2)
+    rows = unpack_array(second["raw_rows"])
+    np.testing.assert_allclose(rows, decimate(WATERFALL[:8], 2), rtol=1e-6)
+    assert second["vfft"]["shape"] == [2, 16]
+
+
+def test_bundle_layout():
+    message = make_result(2)
+    peaks = message.detected_peaks.df
+    bundle = msgpack.unpackb(ws_module.pack_images(message))
+    assert bundle["version"] == ws_module.BUNDLE_VERSION
+    assert list(peaks.columns) == ["index", "amplitude", "FWHM"]  # unchanged
+    peak_columns = {
+        name: unpack_array(column) for name, column in bundle["peaks"].items()
+    }
+    assert {name: column.tolist() for name, column in peak_columns.items()} == {
+        "x": [3.0],
+        "h": [1.0],
+        "fwhm": [2.0],
+    }
+    assert peak_columns["x"].dtype == np.dtype("<f4")
+    vfft = unpack_array(bundle["vfft"])
+    assert (vfft.dtype, vfft.shape) == (np.uint8, (8, 16))
+    assert unpack_array(bundle["raw_rows"]).dtype == np.dtype("<f4")
+    assert "harmonic_amplitude" not in bundle  # demodulation was off
+
+
+def test_lock_in_maps_sent():
+    message = make_result(1)
+    amplitude = np.arange(32.0).reshape(2, 16)
+    message.harmonic_amplitude = NumpyArrayModel(array=amplitude)
+    message.harmonic_phase = NumpyArrayModel(array=-amplitude)
+    bundle = msgpack.unpackb(ws_module.pack_images(message))
+    np.testing.assert_array_equal(unpack_array(bundle["harmonic_amplitude"]), amplitude)
+    assert unpack_array(bundle["harmonic_phase"]).dtype == np.dtype("<f4")
+    bundle = msgpack.unpackb(
+        ws_module.pack_images(message, products=frozenset(["harmonic_phase"]))
+    )
+    assert "harmonic_amplitude" not in bundle
+    assert "harmonic_phase" in bundle
+
+
+def test_phase_folding_sent():
+    message = make_result(1)
+    folded = np.arange(64.0).reshape(4, 16)
+    message.phase_folded = NumpyArrayModel(array=folded)
+    message.pumped_difference = NumpyArrayModel(array=folded[1] - folded[0])
+    bundle = msgpack.unpackb(ws_module.pack_images(message))
+    np.testing.assert_array_equal(unpack_array(bundle["phase_folded"]), folded)
+    assert unpack_array(bundle["pumped_difference"]).shape == (16,)
+
+
+def test_compressed_once_per_codec(monkeypatch):
+    calls = []
+    compress_frames = ws_module.compress_frames
+
+    def counting_compress(frames, codec):
+        calls.append(codec)
+        return compress_frames(frames, codec)
+
+    monkeypatch.setattr(ws_module, "compress_frames", counting_compress)
+
+    async def run():
+        publisher = XPSWSResultPublisher()
+        server, url = await serve(publisher)
+        clients = [await websockets.connect(url) for _ in range(3)]
+        await clients[0].send(json.dumps({"type": "codecs", "accept": ["deflate"]}))
+        await clients[1].send(
+            json.dumps({"type": "codecs", "accept": ["brotli", "deflate"]})
+        )
+        while [client.codec for client in publisher.clients.values()].count(
+            "deflate"
+        ) < 2:
+            await asyncio.sleep(0.01)
+        await publisher.publish(make_result())
+        received = [[await client.recv() for _ in range(2)] for client in clients]
+        for client in clients:
+            await client.close()
+        server.close()
+        await server.wait_closed()
+        return received
+
+    received = asyncio.run(run())
+    assert calls == ["deflate"]
+    wrapped = msgpack.unpackb(received[0][1])
+    assert wrapped["codec"] == "deflate"
+    assert decompress(wrapped["payload"], "deflate") == received[2][1]
+    assert received[1] == received[0]
+
+
+def test_subscription_products_and_rate():
+    async def run():
+        publisher = XPSWSResultPublisher()
+        server, url = await serve(publisher)
+        client = await websockets.connect(url)
+        await client.send(
+            json.dumps({"type": "subscribe", "products": ["peaks"], "max_rate": 1})
+        )
+        while [c.subscription.products for c in publisher.clients.values()] != [
+            frozenset(["peaks"])
+        ]:
+            await asyncio.sleep(0.01)
+        await publisher.publish(make_result(1))
+        received = [await client.recv() for _ in range(2)]
+        await publisher.publish(make_result(2))  # within a second, held
+        await publisher.publish(make_result(3))  # replaces 2
+        counters = publisher.client_counters()
+        await client.close()
+        server.close()
+        await server.wait_closed()
+        return msgpack.unpackb(received[1]), counters
+
+    bundle, counters = asyncio.run(run())
+    assert set(bundle) == {
+        "version",
+        "kind",
+        "seq",
+        "width",
+        "height",
+        "shot_num",
+        "peaks",
+    }
+    assert [c["coalesced"] for c in counters.values()] == [1]
+
+
+def test_delta_after_rate_limited_result():
+    async def run():
+        publisher = XPSWSResultPublisher()
+        server, url = await serve(publisher)
+        await publisher.publish(make_result(1))
+        client = await websockets.connect(url)
+        received = [await client.recv() for _ in range(2)]
+        while not publisher.clients:
+            await asyncio.sleep(0.01)
+        sender = next(iter(publisher.clients.values()))
+        sender.subscription = ws_module.Subscription(max_rate=1)
+        sender.last_update = -float("inf")  # as if a second went by
+        await publisher.publish(make_result(2))  # sent
+        await publisher.publish(make_result(3))  # rate limited
+        sender.last_update = -float("inf")  # as if a second went by
+        await publisher.publish(make_result(4))  # sent, applies to 2
+        received += [await client.recv() for _ in range(4)]
+        await client.close()
+        server.close()
+        await server.wait_closed()
+        return [msgpack.unpackb(bundle) for bundle in received[1::2]]
+
+    snapshot, delta2, delta4 = asyncio.run(run())
+    assert (delta2["seq"], delta2["base_seq"], delta2["raw_start"]) == (2, 1, 4)
+    assert (delta4["seq"], delta4["base_seq"], delta4["raw_start"]) == (4, 2, 8)
+    np.testing.assert_allclose(
+        unpack_array(delta4["raw_rows"]), WATERFALL[8:16], rtol=1e-6
+    )
+
+
+def test_client_updated_when_rate_allows():
+    async def run():
+        publisher = XPSWSResultPublisher()
+        server, url = await serve(publisher)
+        client = await websockets.connect(url)
+        await client.send(json.dumps({"type": "subscribe", "max_rate": 10}))
+        while [c.subscription.max_rate for c in publisher.clients.values()] != [10]:
+            await asyncio.sleep(0.01)
+        await publisher.publish(make_result(1))
+        received = [await client.recv() for _ in range(2)]
+        for shot_num in (2, 3, 4):
+            await publisher.publish(make_result(shot_num))
+        # 2 and 3 are coalesced into 4, sent 100 ms after 1
+        received += [await client.recv() for _ in range(2)]
+        counters = publisher.client_counters()
+        await client.close()
+        server.close()
+        await server.wait_closed()
+        return [msgpack.unpackb(bundle) for bundle in received[1::2]], counters
+
+    (first, second), counters = asyncio.run(run())
+    assert (first["kind"], first["seq"]) == ("snapshot", 1)
+    assert (second["kind"], second["seq"], second["base_seq"]) == ("delta", 4, 1)
+    np.testing.assert_allclose(
+        unpack_array(second["raw_rows"]), WATERFALL[4:16], rtol=1e-6
+    )
+    assert [c["coalesced"] for c in counters.values()] == [2]
+
+
+def test_new_run_starts_with_snapshot():
+    async def run():
+        publisher = XPSWSResultPublisher()
+        server, url = await serve(publisher)
+        await publisher.publish(make_result(2))
+        client = await websockets.connect(url)
+        received = [await client.recv() for _ in range(2)]
+        while not publisher.clients:
+            await asyncio.sleep(0.01)
+        start = XPSStart(**dict(start_example, scan_name="test"))
+        await publisher.publish(start)
+        await publisher.publish(make_result(1))
+        received += [await client.recv() for _ in range(3)]
+        await client.close()
+        server.close()
+        await server.wait_closed()
+        return msgpack.unpackb(received[-1])
+
+    bundle = asyncio.run(run())
+    assert (bundle["kind"], bundle["seq"], bundle["raw_start"]) == ("snapshot", 1, 0)
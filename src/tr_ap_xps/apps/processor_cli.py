@@ -10,6 +10,7 @@ from ..config import settings
 from ..labview import XPSLabviewZMQListener, setup_zmq
 from ..log_utils import setup_logger
 from ..pipeline.xps_operator import XPSOperator
+from ..queues import CoalescingPublisher, QueuedPublisher
 from ..tiled import TiledPublisher
 from ..websockets import XPSWSResultPublisher
 
@@ -51,18 +52,51 @@ async def listen() -> None:
         ws_publisher = XPSWSResultPublisher(
             host=app_settings.websockets_publisher.host,
             port=app_settings.websockets_publisher.port,
+            max_queued=app_settings.websockets_publisher.get("client_queue_size", 2),
+            stall_timeout=app_settings.websockets_publisher.get("stall_timeout", 10.0),
+            decimation=app_settings.websockets_publisher.get("decimation", "mean"),
+            codecs=app_settings.websockets_publisher.get("codecs"),
         )
         tiled_pub = TiledPublisher(tiled_runs_container())
 
-        operator.add_publisher(ws_publisher)
-        operator.add_publisher(tiled_pub)
+        # Each publisher gets its own queue, so a slow Tiled write does not
+        # delay websocket updates or the reverse
+        queue_settings = app_settings.get("publisher_queues", {})
+        ws_queue = queue_settings.get("websockets", {})
+        tiled_queue = queue_settings.get("tiled", {})
+        # Viewers can't use results faster than they draw them, so those
+        # coming sooner are coalesced into the newest; Tiled gets every one
+        ws_target = ws_publisher
+        max_rate = app_settings.websockets_publisher.get("max_rate")
+        if max_rate:
+            ws_target = CoalescingPublisher(ws_publisher, max_rate)
+        operator.add_publisher(
+            QueuedPublisher(
+                ws_target,
+                maxsize=ws_queue.get("maxsize", 2),
+                policy=ws_queue.get("overflow_policy", "drop_oldest"),
+            )
+        )
+        # Tiled keeps every result. Its queue is unbounded by default, as a
+        # full queue with the block policy would stall the operator.
+        operator.add_publisher(
+            QueuedPublisher(
+                tiled_pub,
+                maxsize=tiled_queue.get("maxsize"),
+                policy=tiled_queue.get("overflow_policy", "block"),
+                warn_depth=tiled_queue.get("warn_depth", 1000),
+            )
+        )
         # connect to labview zmq
 
         lv_zmq_socket = setup_zmq()
         listener = XPSLabviewZMQListener(operator=operator, zmq_socket=lv_zmq_socket)
 
         # Wait for both tasks to complete
-        await asyncio.gather(listener.start(), ws_publisher.start())
+        try:
+            await asyncio.gather(listener.start(), ws_publisher.start())
+        finally:
+            await operator.stop()
 
         def handle_sigterm(signum, frame):
             logger.info("SIGTERM received, stopping...")
@@ -0,0 +1,29 @@
+import logging
+
+import typer
+
+from ..config import settings
+from ..log_utils import setup_logger
+from ..pipeline.distributed import run_worker
+
+app = typer.Typer()
+logger = logging.getLogger("tr_ap_xps")
+setup_logger(logger)
+
+app_settings = settings.xps
+
+
+@app.command()
+def main(
+    dispatch_address: str = "tcp://localhost:5560",
+    collect_address: str = "tcp://localhost:5561",
+) -> None:
+    """Analyze shots sent by a processor running the distributed analysis backend."""
+    logger.setLevel(app_settings.log_level.upper())
+    logger.info(f"dispatch_address: {dispatch_address}")
+    logger.info(f"collect_address: {collect_address}")
+    run_worker(dispatch_address, collect_address)
+
+
+if __name__ == "__main__":
+    app()
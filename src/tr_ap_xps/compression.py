@@ -0,0 +1,61 @@
+import zlib
+from typing import Callable
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+    Codecs websocket bundles can be compressed with, so each result is
+    compressed once per codec rather than once per client.
+
+    deflate (zlib format) is always available, and browsers can decompress it
+    with DecompressionStream. zstd and lz4 need the zstandard and lz4
+    packages. Levels favor speed: the bundles are mostly float32 waterfall
+    rows and log stretched images, for which higher levels take several
+    times longer for a percent or so less.
+"""
+
+
+def _zstd_compress(data: bytes) -> bytes:
+    # a compressor can't be used from two threads at once, and they are cheap
+    return zstandard.ZstdCompressor(level=1).compress(data)
+
+
+def _zstd_decompress(data: bytes) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# name: (compress, decompress)
+CODECS: dict[str, tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    "deflate": (lambda data: zlib.compress(data, 1), zlib.decompress),
+}
+if zstandard is not None:
+    CODECS["zstd"] = (_zstd_compress, _zstd_decompress)
+if lz4 is not None:
+    CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+
+
+def choose_codec(accepted: list, allowed: list = None) -> str:
+    """
+    The first of the codecs a client accepts that is available and allowed,
+    None if there is none.
+    """
+    for codec in accepted or []:
+        if codec in CODECS and (allowed is None or codec in allowed):
+            return codec
+    return None
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    return CODECS[codec][0](data)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    return CODECS[codec][1](data)
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+from typing import NamedTuple
+
+import numpy as np
+
+from arroyo.operator import Operator
+from arroyo.schemas import Message
+
+from .labview import DATATYPE_MAP
+from .pipeline.analysis import SharedArrays
+from .schemas import XPSRawFrame, XPSStart, XPSStop
+
+"""
+    A shared memory transport for frames, so the listener and the processor
+    can run in different processes without pickling frames.
+
+    Frames are copied into the fixed slots of a ring in shared memory, sized
+    from the XPSStart rectangle and data type. Only small control messages go
+    through queues: the start and stop messages, and for each frame its
+    sequence number, slot and frame number. The consumer hands each slot back
+    once the frame has been processed, and the producer only writes to slots
+    that have been handed back, so a slot is never reused while it is read.
+    When the consumer lags and every slot is in use, the producer waits.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class RingChannel(NamedTuple):
+    """The queues shared by the two ends of a frame ring"""
+
+    control: multiprocessing.Queue  # producer to consumer, in order
+    free: multiprocessing.Queue  # slots handed back, None when detached
+
+    @classmethod
+    def create(cls, context=None) -> "RingChannel":
+        context = context or multiprocessing.get_context("spawn")
+        return cls(context.Queue(), context.Queue())
+
+
+class FrameRing:
+    """
+    Fixed frame slots in one shared memory block.
+
+    Each slot also records the sequence number of the frame last written to
+    it, so the consumer can check the slot still holds the frame it was
+    told about.
+    """
+
+    def __init__(self, shared: SharedArrays):
+        self.shared = shared
+        self.frames = shared.arrays["frames"]
+        self.sequence = shared.arrays["sequence"]
+
+    @classmethod
+    def create(cls, shape: tuple, dtype: np.dtype, slots: int) -> "FrameRing":
+        if slots <= 0:
+            raise ValueError("slots must be a positive integer")
+        shared = SharedArrays.allocate(
+            {
+                "frames": ((slots, *shape), np.dtype(dtype)),
+                "sequence": ((slots,), np.int64),
+            }
+        )
+        ring = cls(shared)
+        ring.sequence.fill(-1)
+        return ring
+
+    @classmethod
+    def for_start(cls, message: XPSStart, slots: int) -> "FrameRing":
+        rectangle = message.rectangle
+        shape = (rectangle.bottom - rectangle.top, rectangle.right - rectangle.left)
+        # frames arrive native endian from the listener's FramePool
+        dtype = DATATYPE_MAP[message.data_type].newbyteorder("=")
+        return cls.create(shape, dtype, slots)
+
+    @classmethod
+    def attach(cls, name: str, layout: list) -> "FrameRing":
+        return cls(SharedArrays.attach(name, layout))
+
+    @property
+    def slots(self) -> int:
+        return len(self.frames)
+
+    def close(self) -> None:
+        self.frames = self.sequence = None
+        try:
+            self.shared.close()
+        except BufferError:
+            # a frame is still referenced, the mapping goes when it does
+            logger.warning("Frame ring closed while a frame is still in use")
+
+    def unlink(self) -> None:
+        self.frames = self.sequence = None
+        self.shared.unlink()
+
+
+class SharedMemoryForwarder(Operator):
+    """
+    Producer end of a frame ring, in place of XPSOperator in the listener
+    process.
+
+    A new ring is created at each start message. At the stop message the
+    forwarder waits for the consumer to hand back every slot before the
+    ring is unlinked, and adds the number of times it waited for a free
+    slot to the ingest counters.
+    """
+
+    def __init__(self, channel: RingChannel, slots: int = 64, timeout: float = 30):
+        self.channel = channel
+        self.slots = slots
+        self.timeout = timeout
+        self.ring: FrameRing = None
+        self.sequence = 0
+        self.waits = 0
+
+    async def process(self, message: Message) -> None:
+        if isinstance(message, XPSStart):
+            if self.ring is not None:
+                # the previous run never stopped
+                self.channel.control.put(("detach",))
+                await asyncio.to_thread(self._release_ring)
+            self.ring = FrameRing.for_start(message, self.slots)
+            self.sequence = 0
+            self.waits = 0
+            for slot in range(self.ring.slots):
+                self.channel.free.put(slot)
+            self.channel.control.put(
+                ("start", message, self.ring.shared.name, self.ring.shared.layout)
+            )
+
+        elif isinstance(message, XPSRawFrame):
+            if self.ring is None:
+                logger.error("Received XPSRawFrame without a start message")
+                return
+            try:
+                slot = self.channel.free.get_nowait()
+            except queue.Empty:
+                # the consumer is behind, wait for it to hand back a slot
+                self.waits += 1
+                slot = await asyncio.to_thread(self.channel.free.get)
+            self.ring.frames[slot] = message.image
+            self.ring.sequence[slot] = self.sequence
+            self.channel.control.put(
+                ("frame", self.sequence, slot, message.frame_number)
+            )
+            self.sequence += 1
+
+        elif isinstance(message, XPSStop):
+            counters = dict(message.ingest_counters or {})
+            counters["ring_waits"] = self.waits
+            self.channel.control.put(
+                ("stop", message.model_copy(update={"ingest_counters": counters}))
+            )
+            if self.ring is not None:
+                await asyncio.to_thread(self._release_ring)
+
+    def _release_ring(self) -> None:
+        # Wait for the consumer to detach, which it does once it has
+        # handed back every slot, then remove the block.
+        try:
+            while self.channel.free.get(timeout=self.timeout) is not None:
+                pass
+        except queue.Empty:
+            logger.warning("Frame ring consumer did not detach, unlinking anyway")
+        self.ring.unlink()
+        self.ring = None
+
+
+class RingConsumer:
+    """
+    Consumer end of a frame ring, feeding an operator such as XPSOperator in
+    another process.
+
+    Slots are handed back as soon as operator.process returns for the
+    frame, so the operator must not keep a reference to the image. That is
+    the case for XPSOperator, which reduces each frame to one line before
+    returning.
+    """
+
+    def __init__(self, channel: RingChannel, operator: Operator):
+        self.channel = channel
+        self.operator = operator
+        self.ring: FrameRing = None
+        self.expected_sequence = 0
+        self.overwritten = 0
+
+    async def start(self) -> None:
+        while True:
+            message = await asyncio.to_thread(self.channel.control.get)
+            if message is None:
+                break
+            try:
+                await self._dispatch(message)
+            except Exception as e:
+                logger.exception(f"Error dealing with ring message: {e}")
+
+    def stop(self) -> None:
+        """Ask start to return once the messages already sent are handled."""
+        self.channel.control.put(None)
+
+    async def _dispatch(self, message: tuple) -> None:
+        msg_type = message[0]
+        if msg_type == "start":
+            _, start, name, layout = message
+            self._detach()
+            self.ring = FrameRing.attach(name, layout)
+            self.expected_sequence = 0
+            self.overwritten = 0
+            await self.operator.process(start)
+
+        elif msg_type == "frame":
+            _, sequence, slot, frame_number = message
+            if self.ring is None:
+                logger.error("Received a frame without a start message")
+                return
+            try:
+                if sequence != self.expected_sequence:
+                    logger.warning(
+                        f"Expected frame sequence {self.expected_sequence}, "
+                        f"got {sequence}"
+                    )
+                self.expected_sequence = sequence + 1
+                if self.ring.sequence[slot] != sequence:
+                    # should not happen, slots are only reused once handed back
+                    self.overwritten += 1
+                    logger.error(f"Slot {slot} no longer holds frame {frame_number}")
+                    return
+                await self.operator.process(
+                    XPSRawFrame(frame_number, self.ring.frames[slot])
+                )
+            finally:
+                self.channel.free.put(slot)
+
+        elif msg_type == "stop":
+            _, stop = message
+            if self.overwritten:
+                stop.ingest_counters["ring_overwritten"] = self.overwritten
+            self._detach()
+            await self.operator.process(stop)
+
+        elif msg_type == "detach":
+            self._detach()
+
+    def _detach(self) -> None:
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+            self.channel.free.put(None)
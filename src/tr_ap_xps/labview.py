@@ -1,14 +1,23 @@
+import asyncio
 import json
 import logging
+import threading
 import uuid
+from typing import List, NamedTuple, Optional
 
 import numpy as np
 import zmq.asyncio
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from arroyo.zmq import ZMQListener
 
 from .config import settings
-from .schemas import NumpyArrayModel, XPSImageInfo, XPSRawEvent, XPSStart, XPSStop
+from .queues import FrameQueue, QueueClosed
+from .schemas import XPSImageInfo, XPSRawFrame, XPSStart, XPSStop
 
 # Maintain a map of LabView datatypes. LabView sends BigE,
 # and Numpy assumes LittleE, so adjust that too.
@@ -26,11 +35,148 @@ DATATYPE_MAP = {
     "Double Float": np.dtype(np.double).newbyteorder(">"),
 }
 
+# Control messages from LabVIEW are small JSON objects, so anything larger
+# is never handed to the JSON parser
+MAX_HEADER_BYTES = 4096
+
 app_settings = settings.xps
 
 logger = logging.getLogger(__name__)
 
 
+def parse_header(buffer) -> Optional[dict]:
+    """
+    Parse a LabVIEW JSON control message, or return None if buffer is not
+    one. Large buffers and buffers that do not start with "{" are rejected
+    without being decoded, so image payloads are never parsed as JSON.
+    """
+    if len(buffer) > MAX_HEADER_BYTES or bytes(buffer[:16]).lstrip()[:1] != b"{":
+        return None
+    try:
+        header = orjson.loads(buffer) if orjson else json.loads(bytes(buffer))
+    except ValueError:  # includes json and orjson decode errors
+        return None
+    return header if isinstance(header, dict) else None
+
+
+def payload_size(start: dict) -> Optional[int]:
+    """Size in bytes of each image payload described by a start message"""
+    try:
+        rectangle = start["Rectangle"]
+        dtype = DATATYPE_MAP[start["data_type"]]
+        height = rectangle["Bottom"] - rectangle["Top"]
+        width = rectangle["Right"] - rectangle["Left"]
+    except (KeyError, TypeError):
+        return None
+    return height * width * dtype.itemsize
+
+
+class LabviewMessage(NamedTuple):
+    msg_type: str
+    header: dict
+    payload: Optional[memoryview] = None
+    counters: Optional[dict] = None  # ingest counters, on stop messages
+
+
+class LabviewFramer:
+    """
+    Turns received ZMQ messages into LabVIEW start, stop and event messages.
+
+    LabVIEW currently sends each event as two ZMQ messages, a JSON header and
+    then the image. Events are also accepted as one multipart message
+    (header and image frames). Single-part messages are told apart cheaply:
+    while an event header is waiting for its image, a message of exactly the
+    expected image size is taken as the payload without being inspected.
+    Anything else is only parsed if it is small and looks like JSON.
+
+    If the stream gets out of step, an event header without an image is
+    dropped when the next header arrives, and an image without a header is
+    dropped; neither is ever JSON-decoded as a whole.
+    """
+
+    def __init__(self):
+        self.payload_size: Optional[int] = None
+        self.pending_event: Optional[dict] = None
+
+    def feed(self, parts: List) -> Optional[LabviewMessage]:
+        buffers = [
+            part.buffer if isinstance(part, zmq.Frame) else part for part in parts
+        ]
+        if len(buffers) > 1:
+            header = parse_header(buffers[0])
+            if header is None or header.get("msg_type") != "event":
+                logger.error("Received multipart message without an event header")
+                return None
+            self._drop_pending()
+            return LabviewMessage("event", header, buffers[1])
+
+        buffer = buffers[0]
+        if self.pending_event is not None and len(buffer) == self.payload_size:
+            header, self.pending_event = self.pending_event, None
+            return LabviewMessage("event", header, buffer)
+
+        header = parse_header(buffer)
+        if header is None:
+            if self.pending_event is not None and self.payload_size is None:
+                # No start message to check the size against
+                header, self.pending_event = self.pending_event, None
+                return LabviewMessage("event", header, buffer)
+            logger.error(f"Dropping unexpected payload of {len(buffer)} bytes")
+            self.pending_event = None
+            return None
+
+        message_type = header.get("msg_type")
+        if message_type == "event":
+            self._drop_pending()
+            self.pending_event = header
+            return None
+        self._drop_pending()
+        if message_type == "start":
+            self.payload_size = payload_size(header)
+        elif message_type == "stop":
+            self.payload_size = None
+        return LabviewMessage(message_type, header)
+
+    def _drop_pending(self):
+        if self.pending_event is not None:
+            logger.error(f"Dropping event without an image: {self.pending_event}")
+            self.pending_event = None
+
+
+class FramePool:
+    """
+    Reusable native-endian buffers for frames received from LabVIEW.
+
+    LabVIEW sends big-endian data. Rather than wrapping every buffer with a
+    byte-swapped dtype, which makes every later NumPy operation run on
+    non-native data, each frame is byte swapped once into the next buffer of
+    a small pool sized from the start message. Buffers are reused round
+    robin, so a frame must be consumed before `size` more frames arrive.
+
+    Single byte data has no byte order, so it is wrapped without a copy; the
+    array keeps the ZMQ frame alive through its memoryview.
+    """
+
+    def __init__(self, shape: tuple, wire_dtype: np.dtype, size: int = 4):
+        self.shape = shape
+        self.wire_dtype = wire_dtype
+        self.native_dtype = wire_dtype.newbyteorder("=")
+        self.zero_copy = wire_dtype.isnative
+        self._buffers = []
+        if not self.zero_copy:
+            self._buffers = [np.empty(shape, self.native_dtype) for _ in range(size)]
+        self._next = 0
+
+    def to_native(self, buffer) -> np.ndarray:
+        wire = np.frombuffer(buffer, dtype=self.wire_dtype).reshape(self.shape)
+        if self.zero_copy:
+            return wire
+        native = self._buffers[self._next]
+        self._next = (self._next + 1) % len(self._buffers)
+        np.copyto(native, wire)
+        return native
+
+
 def setup_zmq():
     ctx = zmq.asyncio.Context()
     lv_zmq_socket = ctx.socket(zmq.SUB)
@@ -45,75 +191,152 @@ def setup_zmq():
     return lv_zmq_socket
 
 
+class LabviewReceiver(threading.Thread):
+    """
+    Drains the LabVIEW SUB socket on a dedicated thread.
+
+    Messages are framed as they arrive and put on a bounded FrameQueue, so
+    the socket is emptied at line rate no matter what the asyncio loop is
+    waiting on. Events are subject to the queue's overflow policy; start
+    and stop messages never are. Producer counters are reset at each start
+    message and attached to each stop message.
+    """
+
+    def __init__(self, zmq_socket: zmq.Socket, frame_queue: FrameQueue):
+        super().__init__(name="labview-receiver", daemon=True)
+        # ZMQ sockets are not thread safe. From here on this thread is the
+        # only user of the underlying socket.
+        self.zmq_socket = zmq.Socket.shadow(zmq_socket.underlying)
+        self.frame_queue = frame_queue
+        self.framer = LabviewFramer()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.zmq_socket, zmq.POLLIN)
+        while not self._stop_event.is_set():
+            try:
+                # time out so a stop request is noticed
+                if not poller.poll(100):
+                    continue
+                parts = self.zmq_socket.recv_multipart(copy=False)
+                message = self.framer.feed(parts)
+                if message is None:
+                    continue
+                if message.msg_type == "event":
+                    self.frame_queue.put(message)
+                    continue
+                if message.msg_type == "start":
+                    self.frame_queue.reset_counters()
+                elif message.msg_type == "stop":
+                    message = message._replace(counters=self.frame_queue.counters())
+                self.frame_queue.put(message, droppable=False)
+            except zmq.ContextTerminated:
+                break
+            except Exception as e:
+                logger.exception(f"Error receiving message: {e}")
+        self.frame_queue.close()
+
+    def stop(self):
+        self._stop_event.set()
+
+
 class XPSLabviewZMQListener(ZMQListener):
     stop_signal = False
+    receiver: LabviewReceiver = None
+
+    def _build_frame_queue(self) -> FrameQueue:
+        listener_settings = app_settings.lv_zmq_listener
+        return FrameQueue(
+            maxsize=listener_settings.get("queue_size", 1000),
+            policy=listener_settings.get("overflow_policy", "block"),
+            late_after=listener_settings.get("late_after", 1.0),
+        )
 
     async def start(self):
         logger.info("Listener started")
+        self.frame_queue = self._build_frame_queue()
+        self.receiver = LabviewReceiver(self.zmq_socket, self.frame_queue)
+        self.receiver.start()
         current_image_info: XPSImageInfo = None
+        frame_pool: FramePool = None
+        late_at_start = 0
         while True:
-            json_message = None
+            message = None
             try:
                 if self.stop_signal:
                     logger.info("Stopping listener.")
                     break
-                raw_message = await self.zmq_socket.recv()
-                # print(raw_message[0:300])
                 try:
-                    json_message = json.loads(raw_message.decode("utf-8"))
-                except json.JSONDecodeError:
-                    pass
-                if json_message:
-                    message_type = json_message.get("msg_type")
-                    if message_type == "start":
-                        json_message["scan_name"] = f"temp name {uuid.uuid4()}"
-                        logger.info(
-                            f"Start message processed: {json_message['scan_name']}"
-                        )
-                        start_msg, image_info = self._build_start(json_message)
-                        current_image_info = image_info
-                        await self.operator.process(start_msg)
-                        continue
+                    message = await self.frame_queue.get()
+                except QueueClosed:
+                    break
+                if message.msg_type == "start":
+                    json_message = message.header
+                    json_message["scan_name"] = f"temp name {uuid.uuid4()}"
+                    logger.info(f"Start message processed: {json_message['scan_name']}")
+                    start_msg, image_info = self._build_start(json_message)
+                    current_image_info = image_info
+                    frame_pool = self._build_frame_pool(image_info)
+                    late_at_start = self.frame_queue.late
+                    await self.operator.process(start_msg)
+
+                elif message.msg_type == "stop":
+                    logger.info("Stop message received")
+                    current_image_info = None
+                    frame_pool = None
+                    counters = dict(message.counters or {})
+                    counters["late"] = self.frame_queue.late - late_at_start
+                    logger.info(f"Ingest counters: {counters}")
+                    await self.operator.process(
+                        self._build_stop(message.header, counters)
+                    )
 
-                    elif message_type == "stop":
-                        logger.info("Stop message received")
-                        current_image_info = None
-                        await self.operator.process(self._build_stop(json_message))
+                elif message.msg_type == "event":
+                    if current_image_info is None:
+                        logger.error("Received event without a start message")
                         continue
-                    elif message_type == "event":
-                        if current_image_info is None:
-                            logger.error("Received event without a start message")
-                            continue
-                        buffer = await self.zmq_socket.recv()
-                        # Must be an event with an image
-                        if logger.getEffectiveLevel() == logging.DEBUG:
-                            logger.debug(f"event: {json_message}")
-                        # Image should be the next thing received
-                        if not json_message or not buffer:
-                            logger.error("Received unexpected message")
-                            continue
-                        await self.operator.process(
-                            self._build_event(json_message, current_image_info, buffer)
+                    if logger.getEffectiveLevel() == logging.DEBUG:
+                        logger.debug(f"event: {message.header}")
+                    await self.operator.process(
+                        self._build_event(
+                            message.header,
+                            current_image_info,
+                            message.payload,
+                            frame_pool,
                         )
-                        logger.debug("event processed")
+                    )
+                    logger.debug("event processed")
             except Exception as e:
                 logger.error(e)
-                if json_message:
+                if message:
                     logger.exception("Error dealing with  message")
 
+    async def stop(self):
+        self.stop_signal = True
+        if self.receiver is not None:
+            self.receiver.stop()
+            await asyncio.to_thread(self.receiver.join)
+        await super().stop()
+
     @staticmethod
-    def _build_event(
-        message: dict, image_info: XPSImageInfo, buffer: bytes
-    ) -> XPSRawEvent:
-        shape = (image_info.height, image_info.width)
+    def _build_frame_pool(image_info: XPSImageInfo) -> FramePool:
         dtype = DATATYPE_MAP.get(image_info.data_type)
         if not dtype:
             logger.error(f"Received unexpected data type: {image_info}")
-        array_received = np.frombuffer(buffer, dtype=dtype).reshape(shape)
-        image_info.frame_number = message.get("Frame Number")
-        return XPSRawEvent(
-            image=NumpyArrayModel(array=array_received), image_info=image_info
-        )
+            return None
+        return FramePool((image_info.height, image_info.width), dtype)
+
+    @staticmethod
+    def _build_event(
+        message: dict,
+        image_info: XPSImageInfo,
+        buffer: memoryview,
+        frame_pool: FramePool,
+    ) -> XPSRawFrame:
+        # The pool's buffers have the geometry validated at start, and
+        # to_native fails on a payload of any other size.
+        return XPSRawFrame(message.get("Frame Number"), frame_pool.to_native(buffer))
 
     @staticmethod
     def _build_start(message: dict) -> XPSStart:
@@ -131,7 +354,7 @@ class XPSLabviewZMQListener(ZMQListener):
         return start, image_info
 
     @staticmethod
-    def _build_stop(message: dict) -> XPSStop:
+    def _build_stop(message: dict, ingest_counters: dict = None) -> XPSStop:
         if logger.getEffectiveLevel() == logging.DEBUG:
             logger.debug(f"stop: {message}")
-        return XPSStop(**message)
+        return XPSStop(**message, ingest_counters=ingest_counters)
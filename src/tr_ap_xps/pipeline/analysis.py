@@ -0,0 +1,311 @@
+import ctypes
+import logging
+import multiprocessing
+import multiprocessing.util
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from .fft import calculate_fft_items
+from .peak_fitting import peak_fit
+
+logger = logging.getLogger(__name__)
+
+
+class ShotAnalysis(NamedTuple):
+    detected_peaks: pd.DataFrame
+    vfft: np.ndarray
+    ifft: np.ndarray
+
+
+def analyze_arrays(
+    line: np.ndarray,
+    integrated_frames: np.ndarray,
+    fft_window: int = None,
+    fft_dtype: np.dtype = np.float64,
+) -> ShotAnalysis:
+    """Peak fitting on the last line of a shot and the FFTs over the history."""
+    detected_peaks = peak_fit(line)
+    # TODO: allow user to select repeat factor and width on UI
+    vfft, ifft = calculate_fft_items(
+        integrated_frames,
+        repeat_factor=20,
+        width=0,
+        window=fft_window,
+        dtype=fft_dtype,
+    )
+    return ShotAnalysis(detected_peaks, vfft, ifft)
+
+
+class SharedArrays:
+    """
+    Named arrays packed into one shared memory block.
+
+    The layout, a list of (name, shape, dtype, offset), is all another
+    process needs to map the same arrays with attach. An entry can also give
+    strides, e.g. for a newest-first view of rows.
+
+    Arrays are made over a ctypes view of the block, which holds an export
+    of it, so closing the block while arrays are still in use raises
+    BufferError rather than unmapping memory under them.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, layout: list):
+        self.shm = shm
+        self.layout = layout
+        self._memory = (ctypes.c_char * shm.size).from_buffer(shm.buf)
+        self.arrays = self.map(layout)
+
+    def map(self, layout: list) -> dict:
+        """Arrays of the block for a layout of (name, shape, dtype, offset[, strides])."""
+        return {
+            name: np.ndarray(
+                shape,
+                dtype=dtype,
+                buffer=self._memory,
+                offset=offset,
+                strides=strides[0] if strides else None,
+            )
+            for name, shape, dtype, offset, *strides in layout
+        }
+
+    def locate(self, name: str, array: np.ndarray) -> tuple:
+        """
+        The layout entry of array, a view of this block, or None if it is
+        not one.
+        """
+        if self._memory is None:
+            return None
+        start = ctypes.addressof(self._memory)
+        offset = array.ctypes.data - start
+        if not 0 <= offset < len(self._memory):
+            return None
+        return (name, array.shape, array.dtype.str, offset, array.strides)
+
+    @classmethod
+    def allocate(cls, specs: dict) -> "SharedArrays":
+        """Create a block for arrays given as {name: (shape, dtype)}."""
+        layout = []
+        size = 0
+        for name, (shape, dtype) in specs.items():
+            dtype = np.dtype(dtype)
+            # keep every array aligned for its dtype
+            size += -size % dtype.alignment
+            layout.append((name, tuple(shape), dtype.str, size))
+            size += int(np.prod(shape)) * dtype.itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        return cls(shm, layout)
+
+    @classmethod
+    def attach(cls, name: str, layout: list) -> "SharedArrays":
+        return cls(shared_memory.SharedMemory(name=name), layout)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def close(self) -> None:
+        # raises BufferError while arrays of the block are still referenced;
+        # closing can be tried again once they are gone
+        self.arrays = {}
+        self._memory = None
+        self.shm.close()
+
+    def unlink(self) -> None:
+        # the name goes at once, the memory once the block is closed
+        self.shm.unlink()
+        self.close()
+
+
+# Blocks mapped by a worker process, by name. They stay mapped from one
+# shot to the next, and are closed once the analyzer stops using them, or
+# when the worker exits.
+_attached: dict = {}
+
+
+def _close_attached(keep: set = frozenset()) -> None:
+    for name in list(_attached):
+        if name not in keep:
+            _attached.pop(name).close()
+
+
+def _analyze_shared(
+    line: np.ndarray,
+    history,
+    output: tuple,
+    fft_dtype: str,
+    live: set,
+) -> pd.DataFrame:
+    # Runs in a worker process. The history is read from, and the FFTs
+    # written to, shared blocks; only the small peaks table is pickled back.
+    # history is either an array or (block name, layout entry) for a view
+    # of a block allocated by the analyzer.
+    _close_attached(keep=live)
+
+    def arrays(name: str, layout: list) -> dict:
+        if not _attached:
+            multiprocessing.util.Finalize(None, _close_attached, exitpriority=0)
+        if name not in _attached:
+            _attached[name] = SharedArrays.attach(name, [])
+        return _attached[name].map(layout)
+
+    if isinstance(history, tuple):
+        name, entry = history
+        history = arrays(name, [entry])[entry[0]]
+    ffts = arrays(*output)
+    analysis = analyze_arrays(line, history, None, fft_dtype)
+    np.copyto(ffts["vfft"], analysis.vfft, casting="same_kind")
+    np.copyto(ffts["ifft"], analysis.ifft, casting="same_kind")
+    # views must be gone before the blocks can be closed
+    del history, ffts
+    return analysis.detected_peaks
+
+
+class ProcessPoolAnalyzer:
+    """
+    Runs analyze_arrays in a pool of worker processes.
+
+    Peak fitting holds the GIL, so analysis in a thread competes with the
+    listener and publishers. The history of integrated frames is kept in
+    shared memory given out by allocate, which XPSProcessor appends rows to
+    directly, so a shot only sends the workers where its view of the history
+    lies, and the workers map it rather than unpickling a copy. Workers write
+    the FFTs into output blocks that are reused from shot to shot. The FFTs
+    are copied out of them once, as results outlive the shot.
+
+    Blocks given out during a run are unlinked by end_run. Published results
+    may still hold views of them, so each is closed once nothing uses it.
+    Calls block, so they are meant to be made from a worker thread, as the
+    scheduler does.
+    """
+
+    def __init__(self, workers: int = 2):
+        self.workers = workers
+        # spawn rather than fork, as the listener process runs threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._lock = threading.Lock()
+        self._history: list[SharedArrays] = []  # given out by allocate this run
+        self._retired: list[SharedArrays] = []  # unlinked, not yet closed
+        self._outputs: list[SharedArrays] = []  # free output blocks
+        self._output_names: set = set()  # free or in use
+
+    def allocate(self, shape: tuple, dtype: np.dtype) -> np.ndarray:
+        """
+        An uninitialized array in shared memory, which workers read without
+        a copy. Has the signature of np.empty, for WaterfallBuffer.
+        """
+        shared = SharedArrays.allocate({"rows": (shape, dtype)})
+        with self._lock:
+            self._history.append(shared)
+        return shared.arrays["rows"]
+
+    def _locate(self, integrated_frames: np.ndarray):
+        with self._lock:
+            for shared in self._history:
+                entry = shared.locate("integrated_frames", integrated_frames)
+                if entry is not None:
+                    return shared.name, entry
+        # not from allocate, so sent along with the call
+        return integrated_frames
+
+    def _take_output(self, shape: tuple, dtype: np.dtype) -> SharedArrays:
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        offset = nbytes + -nbytes % 64
+        with self._lock:
+            shared = self._outputs.pop() if self._outputs else None
+        if shared is None or shared.shm.size < offset + nbytes:
+            if shared is not None:
+                with self._lock:
+                    self._output_names.discard(shared.name)
+                shared.unlink()
+            # room for the history to double before it is outgrown
+            shared = SharedArrays.allocate({"ffts": ((4 * offset,), np.uint8)})
+            with self._lock:
+                self._output_names.add(shared.name)
+        shared.layout = [
+            ("vfft", tuple(shape), dtype.str, 0),
+            ("ifft", tuple(shape), dtype.str, offset),
+        ]
+        return shared
+
+    def __call__(
+        self,
+        line: np.ndarray,
+        integrated_frames: np.ndarray,
+        fft_window: int = None,
+        fft_dtype: np.dtype = np.float64,
+    ) -> ShotAnalysis:
+        if fft_window is not None:
+            integrated_frames = integrated_frames[:fft_window]
+        fft_dtype = np.dtype(fft_dtype)
+        history = self._locate(integrated_frames)
+        output = self._take_output(integrated_frames.shape, fft_dtype)
+        try:
+            with self._lock:
+                live = {shared.name for shared in self._history}
+                live |= self._output_names
+            future = self.executor.submit(
+                _analyze_shared,
+                line,
+                history,
+                (output.name, output.layout),
+                fft_dtype.str,
+                live,
+            )
+            detected_peaks = future.result()
+            ffts = output.map(output.layout)
+            return ShotAnalysis(
+                detected_peaks, ffts["vfft"].copy(), ffts["ifft"].copy()
+            )
+        finally:
+            with self._lock:
+                self._outputs.append(output)
+
+    def end_run(self) -> None:
+        """Unlink the shared memory given out during the run."""
+        with self._lock:
+            history, self._history = self._history, []
+        for shared in history:
+            shared.shm.unlink()
+            self._retired.append(shared)
+        self._close_retired()
+
+    def _close_retired(self) -> None:
+        retired, self._retired = self._retired, []
+        for shared in retired:
+            try:
+                shared.close()
+            except BufferError:
+                # e.g. a result waiting in a publisher queue, try next run
+                self._retired.append(shared)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
+        self.end_run()
+        with self._lock:
+            outputs, self._outputs = self._outputs, []
+            self._output_names = set()
+        for shared in outputs:
+            shared.unlink()
+
+
+def build_analyzer(analysis_settings: dict):
+    """
+    Pick the shot analysis backend from the xps.analysis settings.
+
+    Returns the analyzer and the number of shots it can analyze at once.
+    """
+    backend = analysis_settings.get("backend", "thread")
+    if backend == "process":
+        workers = analysis_settings.get("workers", 2)
+        return ProcessPoolAnalyzer(workers), workers
+    if backend != "thread":
+        logger.warning(f"Unknown analysis backend {backend}, using thread")
+    # a single thread, more would only contend for the GIL
+    return analyze_arrays, 1
@@ -0,0 +1,57 @@
+import numpy as np
+
+from ..timing import timer
+
+
+class HarmonicDemodulator:
+    """
+    Streaming lock-in demodulation of the waterfall at the pump cycle.
+
+    Keeps one complex accumulator per (harmonic, detector column). Every
+    integrated line is multiplied by the reference phasor for its phase in
+    the cycle (frame_number % frames_per_cycle) and added in, so each update
+    costs O(harmonics x columns) and nothing is recomputed over the history.
+
+    Harmonic h is the frequency h / frames_per_cycle cycles per frame. Over a
+    whole number of cycles the accumulator for h equals column fft bin
+    h * n_cycles of the waterfall, so amplitude() and phase() track what the
+    vfft shows at the cycle frequency and its harmonics.
+    """
+
+    def __init__(self, frames_per_cycle: int, width: int, harmonics=(1, 2, 3)):
+        harmonics = np.asarray(harmonics, dtype=int)
+        if harmonics.ndim != 1 or len(harmonics) == 0:
+            raise ValueError("harmonics must be a non-empty list of integers")
+        if (harmonics < 0).any() or (harmonics > frames_per_cycle // 2).any():
+            raise ValueError(
+                f"harmonics must be between 0 and {frames_per_cycle // 2} "
+                f"for {frames_per_cycle} frames per cycle"
+            )
+        self.frames_per_cycle = frames_per_cycle
+        self.harmonics = harmonics
+        # reference phasors for every phase in the cycle, (phase, harmonic)
+        phase = np.outer(np.arange(frames_per_cycle), harmonics)
+        self._reference = np.exp(-2j * np.pi * phase / frames_per_cycle)
+        self._accumulators = np.zeros((len(harmonics), width), dtype=complex)
+        self._scratch = np.empty_like(self._accumulators)
+        # DC and Nyquist have no negative frequency partner to fold in
+        one_sided = (harmonics == 0) | (2 * harmonics == frames_per_cycle)
+        self._scale = np.where(one_sided, 1.0, 2.0)[:, None]
+        self.count = 0
+
+    @timer
+    def update(self, frame_number: int, line: np.ndarray) -> None:
+        reference = self._reference[frame_number % self.frames_per_cycle]
+        np.multiply.outer(reference, line, out=self._scratch)
+        self._accumulators += self._scratch
+        self.count += 1
+
+    def amplitude(self) -> np.ndarray:
+        """Amplitude of each harmonic per column, shape (harmonics, columns)."""
+        if self.count == 0:
+            return np.zeros(self._accumulators.shape)
+        return self._scale * np.abs(self._accumulators) / self.count
+
+    def phase(self) -> np.ndarray:
+        """Phase in radians of each harmonic per column."""
+        return np.angle(self._accumulators)
@@ -0,0 +1,495 @@
+import asyncio
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Awaitable, Callable
+
+import msgpack
+import numpy as np
+import pandas as pd
+import zmq
+import zmq.asyncio
+
+from ..schemas import DataFrameModel, NumpyArrayModel, XPSResult
+from .analysis import analyze_arrays
+from .statistics import RunningStatistics
+from .xps_processor import ShotSnapshot, shot_result
+
+"""
+    Shot analysis spread over worker processes or hosts.
+
+    ShotDispatcher PUSHes each completed shot to the workers, which PUSH their
+    results back to it. Each worker keeps running statistics over the shots it
+    analyzed and sends them along with every result. The dispatcher puts the
+    results back in shot order, merges the statistics of all workers as of
+    each shot and hands the results on to the publishers.
+
+    Messages are a msgpack header followed by one ZMQ frame per array, so
+    arrays are sent without being copied into the header. Only plain values,
+    arrays of numeric dtypes and the fields of the messages below are
+    decoded, never code, but the ports still carry unauthenticated data: the
+    dispatcher binds to localhost unless configured to listen for workers on
+    other hosts, which should then be on a trusted network.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def _pack_array(array: np.ndarray, frames: list) -> dict:
+    """Header entry for array, which is sent as the next frame"""
+    array = np.ascontiguousarray(array)
+    if array.dtype.hasobject:
+        raise TypeError(f"Can't send arrays of {array.dtype}")
+    frames.append(array)
+    return {"dtype": array.dtype.str, "shape": list(array.shape), "frame": len(frames)}
+
+
+def _unpack_array(packed: dict, frames: list) -> np.ndarray:
+    if packed is None:
+        return None
+    dtype = np.dtype(packed["dtype"])
+    if dtype.hasobject:
+        raise TypeError(f"Can't receive arrays of {dtype}")
+    # zmq frames, or anything else with the buffer protocol
+    return np.frombuffer(frames[packed["frame"]], dtype=dtype).reshape(packed["shape"])
+
+
+def _pack_optional(array: np.ndarray, frames: list) -> dict:
+    return None if array is None else _pack_array(array, frames)
+
+
+def _pack_statistics(statistics: RunningStatistics, frames: list) -> dict:
+    state = statistics.state()
+    return {
+        "alpha": state["alpha"],
+        "count": state["count"],
+        "mean": _pack_array(state["mean"], frames),
+        "m2": _pack_array(state["m2"], frames),
+    }
+
+
+def _unpack_statistics(packed: dict, frames: list) -> RunningStatistics:
+    return RunningStatistics.from_state(
+        {
+            "alpha": packed["alpha"],
+            "count": packed["count"],
+            "mean": _unpack_array(packed["mean"], frames),
+            "m2": _unpack_array(packed["m2"], frames),
+        }
+    )
+
+
+def _pack_dataframe(df: pd.DataFrame, frames: list) -> dict:
+    return {
+        "columns": df.columns.tolist(),
+        "data": [
+            _pack_array(df.iloc[:, position].to_numpy(), frames)
+            for position in range(df.shape[1])
+        ],
+    }
+
+
+def _unpack_dataframe(packed: dict, frames: list) -> pd.DataFrame:
+    df = pd.DataFrame(
+        {
+            position: _unpack_array(column, frames)
+            for position, column in enumerate(packed["data"])
+        }
+    )
+    df.columns = packed["columns"]
+    return df
+
+
+def _pack_result(result: XPSResult, frames: list) -> dict:
+    packed = {}
+    for name, value in result:
+        if isinstance(value, NumpyArrayModel):
+            packed[name] = _pack_array(value.array, frames)
+        elif isinstance(value, DataFrameModel):
+            packed[name] = {"dataframe": _pack_dataframe(value.df, frames)}
+        elif value is None or isinstance(value, (int, float, str)):
+            packed[name] = value
+        else:
+            raise TypeError(f"Can't send {name} of type {type(value)}")
+    return packed
+
+
+def _unpack_result(packed: dict, frames: list) -> XPSResult:
+    fields = {}
+    for name, value in packed.items():
+        if name not in XPSResult.model_fields:
+            raise ValueError(f"Unexpected result field {name}")
+        if isinstance(value, dict) and "dataframe" in value:
+            value = DataFrameModel(df=_unpack_dataframe(value["dataframe"], frames))
+        elif isinstance(value, dict):
+            value = NumpyArrayModel(array=_unpack_array(value, frames))
+        fields[name] = value
+    return XPSResult(**fields)
+
+
+def encode_task(
+    run_id: str, shape: tuple, fft_window: int, fft_dtype: str, shot: ShotSnapshot
+) -> list:
+    frames = []
+    header = {
+        "run_id": run_id,
+        "shape": list(shape),
+        "fft_window": fft_window,
+        "fft_dtype": fft_dtype,
+        "frame_number": int(shot.frame_number),
+        "shot_num": int(shot.shot_num),
+        "line": _pack_array(shot.line, frames),
+        "integrated_frames": _pack_array(shot.integrated_frames, frames),
+        "shot_recent": _pack_array(shot.shot_recent, frames),
+        "shot_mean": _pack_optional(shot.shot_mean, frames),
+        "shot_std": _pack_optional(shot.shot_std, frames),
+        "products": {
+            name: _pack_array(product.array, frames)
+            for name, product in shot.products.items()
+        },
+    }
+    return [msgpack.packb(header), *frames]
+
+
+def decode_task(frames: list) -> tuple:
+    """(run id, statistics shape, fft window, fft dtype, shot)"""
+    header = msgpack.unpackb(frames[0])
+    products = {}
+    for name, product in header["products"].items():
+        if name not in XPSResult.model_fields:
+            raise ValueError(f"Unexpected shot product {name}")
+        products[name] = NumpyArrayModel(array=_unpack_array(product, frames))
+    shot = ShotSnapshot(
+        frame_number=header["frame_number"],
+        shot_num=header["shot_num"],
+        line=_unpack_array(header["line"], frames),
+        integrated_frames=_unpack_array(header["integrated_frames"], frames),
+        shot_recent=_unpack_array(header["shot_recent"], frames),
+        shot_mean=_unpack_array(header["shot_mean"], frames),
+        shot_std=_unpack_array(header["shot_std"], frames),
+        products=products,
+    )
+    return (
+        header["run_id"],
+        tuple(header["shape"]),
+        header["fft_window"],
+        np.dtype(header["fft_dtype"]),
+        shot,
+    )
+
+
+def encode_result(
+    run_id: str,
+    worker_id: str,
+    shot_num: int,
+    result: XPSResult,
+    statistics: RunningStatistics,
+) -> list:
+    frames = []
+    header = {
+        "run_id": run_id,
+        "worker_id": worker_id,
+        "shot_num": int(shot_num),
+        "result": None if result is None else _pack_result(result, frames),
+        "statistics": _pack_statistics(statistics, frames),
+    }
+    return [msgpack.packb(header), *frames]
+
+
+def decode_result(frames: list) -> tuple:
+    """(run id, worker id, shot number, result or None, statistics)"""
+    header = msgpack.unpackb(frames[0])
+    result = header["result"]
+    return (
+        header["run_id"],
+        header["worker_id"],
+        header["shot_num"],
+        None if result is None else _unpack_result(result, frames),
+        _unpack_statistics(header["statistics"], frames),
+    )
+
+
+def run_worker(
+    dispatch_address: str,
+    collect_address: str,
+    stop_event: threading.Event = None,
+) -> None:
+    """
+    Analyze shots from a ShotDispatcher until stop_event is set.
+
+    Shot statistics are kept per run and reset when a shot of a new run
+    arrives.
+    """
+    worker_id = uuid.uuid4().hex
+    context = zmq.Context.instance()
+    tasks = context.socket(zmq.PULL)
+    tasks.connect(dispatch_address)
+    results = context.socket(zmq.PUSH)
+    results.connect(collect_address)
+    run_id = None
+    statistics: RunningStatistics = None
+    logger.info(f"Shot worker {worker_id} connected to {dispatch_address}")
+    try:
+        while stop_event is None or not stop_event.is_set():
+            if not tasks.poll(100):
+                continue
+            task_run_id, shape, fft_window, fft_dtype, shot = decode_task(
+                tasks.recv_multipart(copy=False)
+            )
+            if task_run_id != run_id:
+                run_id = task_run_id
+                statistics = RunningStatistics(shape)
+            result = None
+            try:
+                # partial shots are left out, as in XPSProcessor
+                if shot.shot_recent.shape == statistics.shape:
+                    statistics.update(shot.shot_recent)
+                analysis = analyze_arrays(
+                    shot.line, shot.integrated_frames, fft_window, fft_dtype
+                )
+                # The dispatcher puts back the full history and the merged
+                # statistics, so don't send them back.
+                shot = shot._replace(
+                    integrated_frames=shot.integrated_frames[:0],
+                    shot_mean=statistics.mean,
+                    shot_std=statistics.std(),
+                )
+                result = shot_result(shot, analysis)
+            except Exception as e:
+                logger.exception(f"Error analyzing shot {shot.shot_num}: {e}")
+            results.send_multipart(
+                encode_result(run_id, worker_id, shot.shot_num, result, statistics),
+                copy=False,
+            )
+    finally:
+        tasks.close(linger=0)
+        results.close(linger=0)
+
+
+class ShotDispatcher:
+    """
+    Sends completed shots to shot workers and publishes their results in
+    shot order.
+
+    Has the submit/drain/counters interface of LatestWinsScheduler, so the
+    operator can use either. Shots are not coalesced here: each one goes to
+    the next worker, and ZMQ queues them if all workers are busy.
+
+    Counters:
+
+    - submitted: shots sent to the workers
+    - completed: results published
+    - failed: shots a worker could not analyze
+    - skipped: shots given up on, when later results piled up behind them
+      or a run ended without them
+    - reordered: results that arrived before an earlier shot's result
+
+    Shots are encoded and sent from a sender thread, so copying the
+    history does not hold up frame processing. Only the rows the FFTs need
+    are sent, so use the fft window mode to keep the traffic per shot
+    constant; start_run warns without it. Worker statistics are cumulative,
+    as exponentially weighted statistics cannot be merged.
+    """
+
+    def __init__(
+        self,
+        dispatch_address: str,
+        collect_address: str,
+        max_reorder: int = 32,
+        drain_timeout: float = 60,
+    ):
+        # a blocking socket for tasks, so a send that would block raises. It
+        # is only used from the one sender thread.
+        self._sender = ThreadPoolExecutor(max_workers=1)
+        self.tasks = zmq.Context.instance().socket(zmq.PUSH)
+        self.tasks.bind(dispatch_address)
+        self.results = zmq.asyncio.Context.instance().socket(zmq.PULL)
+        self.results.bind(collect_address)
+        self.max_reorder = max_reorder
+        self.drain_timeout = drain_timeout
+        self.publish: Callable[[Any], Awaitable[None]] = None
+        self.run_id = None
+        self._receive_task: asyncio.Task = None
+        self._release_lock = asyncio.Lock()  # keeps results in shot order
+        self._start_counters()
+
+    def _start_counters(self) -> None:
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.reordered = 0
+        self._outstanding = []  # shot numbers sent, in order
+        self._arrived = {}  # shot number: (worker id, result, statistics)
+        self._histories = {}  # shot number: integrated frames, newest first
+        self._released_statistics = {}  # worker id: statistics
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def counters(self) -> dict:
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "reordered": self.reordered,
+        }
+
+    def start_run(
+        self,
+        publish: Callable[[Any], Awaitable[None]],
+        statistics_shape: tuple,
+        fft_window: int = None,
+        fft_dtype: np.dtype = np.float64,
+    ) -> None:
+        self.publish = publish
+        self.statistics_shape = tuple(statistics_shape)
+        self.fft_window = fft_window
+        self.fft_dtype = np.dtype(fft_dtype).str
+        if fft_window is None:
+            logger.warning(
+                "fft mode full sends the whole history to a worker every shot, "
+                "use fft mode window with the distributed backend"
+            )
+        self.run_id = uuid.uuid4().hex
+        self._start_counters()
+        if self._receive_task is None or self._receive_task.done():
+            self._receive_task = asyncio.create_task(self._receive())
+
+    def submit(self, shot: ShotSnapshot) -> None:
+        history = shot.integrated_frames
+        if self.fft_window is not None:
+            shot = shot._replace(integrated_frames=history[: self.fft_window])
+        self._outstanding.append(shot.shot_num)
+        self._histories[shot.shot_num] = history
+        self._idle.clear()
+        future = asyncio.get_running_loop().run_in_executor(
+            self._sender,
+            self._send,
+            self.run_id,
+            self.statistics_shape,
+            self.fft_window,
+            self.fft_dtype,
+            shot,
+        )
+        future.add_done_callback(partial(self._sent, self.run_id, shot.shot_num))
+
+    def _send(
+        self,
+        run_id: str,
+        shape: tuple,
+        fft_window: int,
+        fft_dtype: str,
+        shot: ShotSnapshot,
+    ) -> bool:
+        # runs in the sender thread
+        try:
+            task = encode_task(run_id, shape, fft_window, fft_dtype, shot)
+            self.tasks.send_multipart(task, flags=zmq.NOBLOCK, copy=False)
+            return True
+        except zmq.Again:
+            # no worker connected, or all of their queues are full
+            logger.warning(f"No shot worker available for shot {shot.shot_num}")
+        except Exception as e:
+            logger.exception(f"Error sending shot {shot.shot_num}: {e}")
+        return False
+
+    def _sent(self, run_id: str, shot_num: int, future: asyncio.Future) -> None:
+        if future.cancelled() or run_id != self.run_id:
+            return  # closed, or the run ended meanwhile
+        if future.result():
+            self.submitted += 1
+            return
+        if shot_num not in self._histories:
+            return  # given up on meanwhile
+        self.skipped += 1
+        self._outstanding.remove(shot_num)
+        del self._histories[shot_num]
+        # results waiting behind it can go
+        asyncio.ensure_future(self._release())
+
+    async def _receive(self) -> None:
+        while True:
+            try:
+                frames = await self.results.recv_multipart(copy=False)
+                run_id, worker_id, shot_num, result, statistics = decode_result(frames)
+                if run_id != self.run_id:
+                    continue  # left over from an earlier run
+                if shot_num not in self._histories:
+                    continue  # given up on, or a duplicate
+                if self._outstanding and shot_num != self._outstanding[0]:
+                    self.reordered += 1
+                self._arrived[shot_num] = (worker_id, result, statistics)
+                await self._release()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Error collecting shot result: {e}")
+
+    async def _release(self) -> None:
+        async with self._release_lock:
+            await self._release_in_order()
+
+    async def _release_in_order(self) -> None:
+        while self._outstanding:
+            shot_num = self._outstanding[0]
+            if shot_num not in self._arrived:
+                if len(self._arrived) < self.max_reorder:
+                    return
+                logger.warning(f"Giving up on shot {shot_num}")
+                self.skipped += 1
+                self._outstanding.pop(0)
+                self._histories.pop(shot_num)
+                continue
+            self._outstanding.pop(0)
+            history = self._histories.pop(shot_num)
+            worker_id, result, statistics = self._arrived.pop(shot_num)
+            # Each worker analyzes its shots in order, so its statistics as
+            # of this shot cover exactly its shots up to this one.
+            self._released_statistics[worker_id] = statistics
+            if result is None:
+                self.failed += 1
+                continue
+            merged = self._merged_statistics()
+            result = result.model_copy(
+                update={
+                    "integrated_frames": NumpyArrayModel(array=history),
+                    "shot_mean": NumpyArrayModel(array=merged.mean),
+                    "shot_std": NumpyArrayModel(array=merged.std()),
+                }
+            )
+            self.completed += 1
+            try:
+                await self.publish(result)
+            except Exception as e:
+                logger.exception(f"Error publishing result: {e}")
+        self._idle.set()
+
+    def _merged_statistics(self) -> RunningStatistics:
+        merged = None
+        for statistics in self._released_statistics.values():
+            if merged is None:
+                merged = RunningStatistics(statistics.shape)
+            merged.merge(statistics)
+        return merged
+
+    async def drain(self) -> None:
+        """Wait for the results of every submitted shot, or give up on them."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shot workers did not return {self._outstanding}")
+            self.skipped += len(self._outstanding)
+            self._outstanding = []
+            self._arrived = {}
+            self._histories = {}
+            self._idle.set()
+
+    def close(self) -> None:
+        if self._receive_task is not None:
+            self._receive_task.cancel()
+        self._sender.shutdown(cancel_futures=True)
+        self.tasks.close(linger=0)
+        self.results.close(linger=0)
@@ -1,15 +1,161 @@
+import functools
+from typing import NamedTuple
+
 import numpy as np
 
 from ..timing import timer
 
+EPSILON = 1e-5
+
+
+@timer
+def get_spectrum(array: np.array, dtype: np.dtype = np.float64):
+    """
+    Perform a real-input fft along columns.
+
+    The waterfall is real, so only the non-negative frequency half of the
+    spectrum is computed. vfft and ifft are both derived from this one
+    transform. Pass dtype=np.float32 for a single precision transform.
+    """
+    return np.fft.rfft(np.asarray(array, dtype=dtype), axis=0)
+
+
+@timer
+def vfft_from_spectrum(spectrum: np.array, n_rows: int):
+    """
+    Log-magnitude of the full column fft, rebuilt from the half spectrum.
+    For real input |X[k]| == |X[n - k]|, so the upper half is a mirror.
+    """
+    magnitude = np.abs(spectrum)
+    half = spectrum.shape[0]
+    vfft = np.empty((n_rows, spectrum.shape[1]), dtype=magnitude.dtype)
+    vfft[:half] = magnitude
+    vfft[half:] = magnitude[1 : n_rows - half + 1][::-1]
+    vfft += EPSILON
+    np.log(vfft, out=vfft)
+    return np.abs(vfft, out=vfft)
+
+
+def _comb_mask(n_rows: int, repeat_factor: int, width: int):
+    """
+    Comb filter over the full spectrum: every n_rows / repeat_factor-th
+    frequency is kept, along with `width` neighbours on each side.
+    """
+    # Calculate the step size for sampling
+    dummy = int(n_rows / repeat_factor)
+    # TODO what do do if dummy rounds down to zero?
+    if dummy == 0:
+        dummy = 1
+    centers = np.arange(0, n_rows, dummy)
+    indices = (centers[:, None] + np.arange(-width, width + 1)).ravel()
+    indices = indices[(indices >= 0) & (indices < n_rows)]
+    mask = np.zeros(n_rows)
+    mask[indices] = 1
+    return mask
+
+
+# Below this many anti-symmetric rows, the imaginary part of the filtered
+# ifft is cheaper to synthesize directly than with a second inverse fft
+SYNTHESIS_MAX_ROWS = 8
+
+
+class CombFilter(NamedTuple):
+    """
+    A comb filter restricted to the rfft half of the spectrum.
+
+    The full-spectrum mask is split into the parts that are symmetric and
+    anti-symmetric under k -> n - k. rows are the half-spectrum indices the
+    symmetric part keeps, and symmetric holds its weights there.
+    antisymmetric_rows and antisymmetric do the same for the anti-symmetric
+    part, which is empty when the comb lines up with n_rows.
+    """
+
+    rows: np.ndarray
+    symmetric: np.ndarray
+    antisymmetric_rows: np.ndarray
+    antisymmetric: np.ndarray
+
+
+@functools.lru_cache(maxsize=16)
+def comb_filter(n_rows: int, repeat_factor: int, width: int, dtype: np.dtype):
+    """
+    Build the comb filter for a waterfall of n_rows rows.
+
+    Cached, so a fixed-height analysis window reuses the same filter every
+    shot; the returned arrays are read-only.
+    """
+    mask = _comb_mask(n_rows, repeat_factor, width)
+    mirrored = np.roll(mask[::-1], 1)  # mirrored[k] == mask[(n - k) % n]
+    half = n_rows // 2 + 1
+    symmetric = ((mask + mirrored) / 2)[:half]
+    # Folds in the -1j that makes the anti-symmetric product Hermitian
+    antisymmetric = (-0.5j * (mask - mirrored))[:half]
+    rows = np.flatnonzero(symmetric)
+    antisymmetric_rows = np.flatnonzero(antisymmetric)
+    comb = CombFilter(
+        rows,
+        symmetric[rows, None].astype(dtype),
+        antisymmetric_rows,
+        antisymmetric[antisymmetric_rows, None].astype(
+            np.result_type(dtype, np.complex64)
+        ),
+    )
+    for array in comb:
+        array.flags.writeable = False
+    return comb
+
+
+def _synthesize(coefficients: np.array, rows: np.array, n_rows: int, dtype):
+    """
+    irfft of a half spectrum that is zero everywhere except at rows, none of
+    which is the DC or Nyquist row, evaluated as a sum of sinusoids.
+    """
+    phase = (2 * np.pi / n_rows) * np.outer(np.arange(n_rows), rows)
+    basis = np.hstack((np.cos(phase), np.sin(phase))).astype(dtype)
+    weights = (2 / n_rows) * np.vstack((coefficients.real, -coefficients.imag))
+    return basis @ weights.astype(dtype)
+
+
+@timer
+def ifft_from_spectrum(
+    spectrum: np.array, n_rows: int, repeat_factor: int = 25, width: int = 0
+):
+    """
+    Comb-filter the half spectrum and return the magnitude of the inverse fft.
+
+    The result matches filtering the full complex spectrum with np.fft.ifft.
+    Filtering with the symmetric part of the mask gives the real part of the
+    inverse transform; the anti-symmetric part (non-zero only when the comb
+    does not line up with n_rows) gives the imaginary part.
+    """
+    dtype = spectrum.real.dtype
+    comb = comb_filter(n_rows, repeat_factor, width, dtype)
+    filtered = np.zeros(spectrum.shape, dtype=spectrum.dtype)
+    filtered[comb.rows] = spectrum[comb.rows] * comb.symmetric
+    ifft = np.fft.irfft(filtered, n=n_rows, axis=0)
+    if not len(comb.antisymmetric_rows):
+        return np.abs(ifft, out=ifft)
+
+    coefficients = spectrum[comb.antisymmetric_rows] * comb.antisymmetric
+    if len(comb.antisymmetric_rows) <= SYNTHESIS_MAX_ROWS:
+        imaginary = _synthesize(coefficients, comb.antisymmetric_rows, n_rows, dtype)
+    else:
+        filtered[comb.rows] = 0
+        filtered[comb.antisymmetric_rows] = coefficients
+        imaginary = np.fft.irfft(filtered, n=n_rows, axis=0)
+    # Magnitude of the complex result; cheaper than np.hypot
+    np.square(ifft, out=ifft)
+    np.square(imaginary, out=imaginary)
+    ifft += imaginary
+    return np.sqrt(ifft, out=ifft)
+
 
 @timer
 def get_vfft(array: np.array):
     """
     Perform fft along colmns
     """
-    epsilon = 1e-5
-    return np.abs(np.log(np.abs(np.fft.fft(array[:, :], axis=0)) + epsilon))
+    return vfft_from_spectrum(get_spectrum(array), array.shape[0])
 
 
 @timer
@@ -28,37 +174,39 @@ def get_ifft(array: np.array, repeat_factor: int = 25, width: int = 0):
     Returns:
     np.array: Filtered array after inverse FFT.
     """
-    # Perform FFT along the columns
-    fcarray = np.fft.fft(array, axis=0)
-    # Initialize a zero array of the same shape and dtype complex
-    array2 = np.zeros(fcarray.shape, dtype=complex)
-    # Calculate the step size for sampling
-    dummy = int(fcarray.shape[0] / repeat_factor)
-    # Sample every 'dummy'-th row and also copy 'width' rows before and after each sampled index
+    return ifft_from_spectrum(get_spectrum(array), array.shape[0], repeat_factor, width)
 
-    # TODO what do do if dummy rounds down to zero?
-    if dummy == 0:
-        dummy = 1
-    for i in range(0, fcarray.shape[0], dummy):
-        start = max(0, i - width)
-        end = min(fcarray.shape[0], i + width + 1)
-        array2[start:end] = fcarray[start:end]
 
-    # Perform inverse FFT
-    ifcarray = np.fft.ifft(array2, axis=0)
-
-    return np.abs(ifcarray)
+@timer
+def calculate_fft_items(
+    array: np.array,
+    repeat_factor: int = 20,
+    width: int = 0,
+    dtype: np.dtype = np.float64,
+    window: int = None,
+):
+    """
+    Compute vfft and ifft from a single shared column fft.
 
+    dtype selects the precision of the transform: np.float64 (default) or
+    np.float32, which roughly halves memory traffic on large waterfalls.
 
-@timer
-def calculate_fft_items(array: np.array, repeat_factor: int = 20, width: int = 0):
+    If window is given, only the first window rows of array are analyzed,
+    so the cost per call stops growing once the array is taller than the
+    window. Pass the waterfall newest row first to analyze the most recent
+    rows.
+    """
     assert (
         isinstance(repeat_factor, int) and repeat_factor > 0
     ), "Repeat factor is a positive integer."
 
-    array = np.array(array)
-    vfft = get_vfft(array)
+    if window is not None:
+        array = array[:window]
+
+    n_rows = array.shape[0]
+    spectrum = get_spectrum(array, dtype)
+    vfft = vfft_from_spectrum(spectrum, n_rows)
     # sum = get_sum(vfft)
-    ifft = get_ifft(array, repeat_factor, width)
+    ifft = ifft_from_spectrum(spectrum, n_rows, repeat_factor, width)
 
     return vfft, ifft
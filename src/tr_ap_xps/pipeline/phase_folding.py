@@ -0,0 +1,78 @@
+import numpy as np
+
+from ..timing import timer
+
+
+class PhaseFoldedAccumulator:
+    """
+    Running phase-folded average of the waterfall.
+
+    Each integrated line has a phase in the pump cycle, frame_number %
+    frames_per_cycle. Lines are summed into a preallocated (phase, column)
+    cube alongside a count per phase, so each update costs O(columns).
+
+    The trigger timing from the start message splits the cycle into windows:
+
+    - pumped: phases f_trigger up to f_untrigger
+    - unpumped: phases before f_trigger, the reference before the pump
+    - dead: phases from f_dead to the end of the cycle, excluded from both
+
+    Sums for the pumped and unpumped windows are kept as well, so the
+    pumped-minus-unpumped difference spectrum is also O(columns).
+    """
+
+    def __init__(
+        self,
+        frames_per_cycle: int,
+        width: int,
+        f_trigger: int,
+        f_untrigger: int,
+        f_dead: int,
+    ):
+        if not 0 <= f_trigger <= f_untrigger <= f_dead <= frames_per_cycle:
+            raise ValueError(
+                "Expected 0 <= F_Trigger <= F_Un-Trigger <= F_Dead <= F_Reset, got "
+                f"{f_trigger}, {f_untrigger}, {f_dead}, {frames_per_cycle}"
+            )
+        self.frames_per_cycle = frames_per_cycle
+        self.f_trigger = f_trigger
+        self.f_untrigger = f_untrigger
+        self.f_dead = f_dead
+        self.sums = np.zeros((frames_per_cycle, width))
+        self.counts = np.zeros(frames_per_cycle, dtype=np.int64)
+        self.pumped_sum = np.zeros(width)
+        self.pumped_count = 0
+        self.unpumped_sum = np.zeros(width)
+        self.unpumped_count = 0
+
+    @timer
+    def update(self, frame_number: int, line: np.ndarray) -> None:
+        phase = frame_number % self.frames_per_cycle
+        self.sums[phase] += line
+        self.counts[phase] += 1
+        if self.f_trigger <= phase < self.f_untrigger:
+            self.pumped_sum += line
+            self.pumped_count += 1
+        elif phase < self.f_trigger:
+            self.unpumped_sum += line
+            self.unpumped_count += 1
+
+    def folded_mean(self) -> np.ndarray:
+        """Mean line at each phase of the cycle, zero where nothing was seen yet."""
+        mean = np.zeros_like(self.sums)
+        np.divide(
+            self.sums,
+            self.counts[:, None],
+            out=mean,
+            where=self.counts[:, None] > 0,
+        )
+        return mean
+
+    def difference(self) -> np.ndarray:
+        """Mean pumped line minus mean unpumped line, zero until both are seen."""
+        if self.pumped_count == 0 or self.unpumped_count == 0:
+            return np.zeros_like(self.pumped_sum)
+        return (
+            self.pumped_sum / self.pumped_count
+            - self.unpumped_sum / self.unpumped_count
+        )
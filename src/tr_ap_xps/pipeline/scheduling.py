@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class LatestWinsScheduler:
+    """
+    Runs jobs in worker threads, at most max_concurrency at a time, keeping
+    only the newest waiting job.
+
+    submit never waits. If a job is submitted while all workers are busy, it
+    waits for one; if another job arrives first, the waiting one is stale
+    and is replaced. Results that are not None are handed to publish, in
+    submission order.
+
+    Counters:
+
+    - submitted: jobs handed to submit
+    - completed: jobs that ran and produced a result
+    - superseded: jobs replaced by a newer one before they started
+    - failed: jobs that raised or produced no result
+    """
+
+    def __init__(
+        self,
+        analyze: Callable[[Any], Any],
+        publish: Callable[[Any], Awaitable[None]],
+        max_concurrency: int = 1,
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.analyze = analyze
+        self.publish = publish
+        self.max_concurrency = max_concurrency
+        self._pending = None
+        self._has_pending = False
+        self._running = deque()  # futures, oldest first
+        self._active = 0
+        self._task: asyncio.Task = None
+        self.submitted = 0
+        self.completed = 0
+        self.superseded = 0
+        self.failed = 0
+
+    def counters(self) -> dict:
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "superseded": self.superseded,
+            "failed": self.failed,
+        }
+
+    def submit(self, job: Any) -> None:
+        """Schedule job, replacing any job still waiting to run."""
+        self.submitted += 1
+        if self._has_pending:
+            self.superseded += 1
+        self._pending = job
+        self._has_pending = True
+        self._start_pending()
+
+    def _start_pending(self) -> None:
+        if self._has_pending and self._active < self.max_concurrency:
+            job = self._pending
+            self._pending = None
+            self._has_pending = False
+            self._active += 1
+            future = asyncio.ensure_future(asyncio.to_thread(self.analyze, job))
+            future.add_done_callback(self._job_done)
+            self._running.append(future)
+        if self._running and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._publish_in_order())
+
+    def _job_done(self, future: asyncio.Future) -> None:
+        self._active -= 1
+        self._start_pending()
+
+    async def _publish_in_order(self) -> None:
+        while self._running:
+            try:
+                result = await self._running[0]
+            except Exception as e:
+                logger.exception(f"Error running scheduled job: {e}")
+                result = None
+            self._running.popleft()
+            if result is None:
+                self.failed += 1
+                continue
+            self.completed += 1
+            try:
+                await self.publish(result)
+            except Exception as e:
+                logger.exception(f"Error publishing result: {e}")
+
+    async def drain(self) -> None:
+        """Wait for running and waiting jobs to finish and be published."""
+        while self._task is not None and not self._task.done():
+            await self._task
@@ -0,0 +1,121 @@
+import numpy as np
+
+from ..timing import timer
+
+
+class RunningStatistics:
+    """
+    Element-wise running mean and variance of equally shaped samples.
+
+    Updates are done in place in float64 into buffers allocated once, using
+    Welford's algorithm, so no temporaries are created per sample and the
+    result does not depend on the dtype of the first sample.
+
+    With ``alpha`` set, statistics are exponentially weighted instead: each
+    new sample gets weight alpha and older ones decay by (1 - alpha), so the
+    mean and variance follow drift over a long run.
+
+    Cumulative (not exponentially weighted) accumulators can be combined
+    with ``merge``, so statistics gathered in parallel over different
+    samples can be reduced to the statistics of all of them.
+    """
+
+    def __init__(self, shape: tuple, alpha: float = None):
+        if alpha is not None and not 0 < alpha <= 1:
+            raise ValueError(f"alpha must be in (0, 1], got {alpha}")
+        self.shape = tuple(shape)
+        self.alpha = alpha
+        self.count = 0
+        self.mean = np.zeros(self.shape)
+        # Cumulative mode: sum of squared deviations from the mean.
+        # Exponentially weighted mode: the variance itself.
+        self._m2 = np.zeros(self.shape)
+        self._delta = np.empty(self.shape)
+        self._scratch = np.empty(self.shape)
+
+    @timer
+    def update(self, sample: np.ndarray) -> None:
+        if sample.shape != self.shape:
+            raise ValueError(f"Expected shape {self.shape}, got {sample.shape}")
+        self.count += 1
+        if self.count == 1:
+            np.copyto(self.mean, sample)
+            return
+        delta = np.subtract(sample, self.mean, out=self._delta)
+        if self.alpha is None:
+            # mean += delta / n; m2 += delta * (sample - new mean)
+            self.mean += np.multiply(delta, 1 / self.count, out=self._scratch)
+            np.subtract(sample, self.mean, out=self._scratch)
+            self._scratch *= delta
+            self._m2 += self._scratch
+        else:
+            # mean += alpha * delta; var = (1 - alpha) * (var + alpha * delta**2)
+            increment = np.multiply(delta, self.alpha, out=self._scratch)
+            self.mean += increment
+            increment *= delta
+            self._m2 += increment
+            self._m2 *= 1 - self.alpha
+
+    def merge(self, other: "RunningStatistics") -> None:
+        """Combine the samples seen by ``other`` into this accumulator."""
+        if self.alpha is not None or other.alpha is not None:
+            raise ValueError("Exponentially weighted statistics cannot be merged")
+        if other.shape != self.shape:
+            raise ValueError(f"Expected shape {self.shape}, got {other.shape}")
+        if other.count == 0:
+            return
+        if self.count == 0:
+            np.copyto(self.mean, other.mean)
+            np.copyto(self._m2, other._m2)
+            self.count = other.count
+            return
+        count = self.count + other.count
+        delta = np.subtract(other.mean, self.mean, out=self._delta)
+        # m2 += m2_other + delta**2 * n_self * n_other / n
+        np.multiply(delta, delta, out=self._scratch)
+        self._scratch *= self.count * other.count / count
+        self._m2 += self._scratch
+        self._m2 += other._m2
+        # mean += delta * n_other / n
+        delta *= other.count / count
+        self.mean += delta
+        self.count = count
+
+    def variance(self, out: np.ndarray = None) -> np.ndarray:
+        """Population variance of the samples seen so far."""
+        if out is None:
+            out = np.empty(self.shape)
+        if self.alpha is not None:
+            np.copyto(out, self._m2)
+        elif self.count == 0:
+            out.fill(0)
+        else:
+            np.divide(self._m2, self.count, out=out)
+        return out
+
+    def std(self, out: np.ndarray = None) -> np.ndarray:
+        """Population standard deviation of the samples seen so far."""
+        out = self.variance(out=out)
+        return np.sqrt(out, out=out)
+
+    def state(self) -> dict:
+        """The accumulated arrays and count, for from_state in another process."""
+        return {
+            "alpha": self.alpha,
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self._m2,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "RunningStatistics":
+        statistics = cls(state["mean"].shape, alpha=state["alpha"])
+        statistics.count = state["count"]
+        np.copyto(statistics.mean, state["mean"])
+        np.copyto(statistics._m2, state["m2"])
+        return statistics
+
+    def reset(self) -> None:
+        self.count = 0
+        self.mean.fill(0)
+        self._m2.fill(0)
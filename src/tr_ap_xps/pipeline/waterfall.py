@@ -0,0 +1,108 @@
+from typing import Callable
+
+import numpy as np
+
+
+class WaterfallBuffer:
+    """
+    A preallocated store of integrated lines (rows), appended to one at a time.
+
+    Appending is amortized O(1): rows are written into preallocated storage
+    instead of stacking a new array each frame. Two modes are supported:
+
+    - growable (``max_rows=None``): storage doubles when full, so the
+      complete history is kept. Rows already written are never modified,
+      which means views handed out earlier stay valid after later appends.
+    - fixed-capacity ring (``max_rows=N``): only the most recent N rows are
+      kept. Each row is written twice (at ``i`` and ``i + N``) so the current
+      window is always one contiguous slice of storage. Views handed out
+      earlier are overwritten as the ring wraps; copy them if they need to
+      outlive the next append.
+
+    Both ``oldest_first`` and ``newest_first`` return views, never copies.
+
+    Storage comes from ``allocate``, called like ``np.empty``, e.g. to keep
+    the rows in shared memory that other processes read them from.
+    """
+
+    def __init__(
+        self,
+        width: int,
+        capacity: int = 1024,
+        max_rows: int = None,
+        dtype: np.dtype = np.float64,
+        allocate: Callable[[tuple, np.dtype], np.ndarray] = np.empty,
+    ):
+        if max_rows is not None and max_rows <= 0:
+            raise ValueError("max_rows must be a positive integer")
+        self.width = width
+        self.max_rows = max_rows
+        self.dtype = np.dtype(dtype)
+        self._allocate = allocate
+        if max_rows is not None:
+            self._storage = allocate((2 * max_rows, width), self.dtype)
+        else:
+            self._storage = allocate((max(capacity, 1), width), self.dtype)
+        self._start = 0  # index of the oldest row in storage
+        self._length = 0
+        # rows appended since the last clear, including any evicted from a ring
+        self.total_appended = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def shape(self) -> tuple:
+        return (self._length, self.width)
+
+    @property
+    def capacity(self) -> int:
+        if self.max_rows is not None:
+            return self.max_rows
+        return self._storage.shape[0]
+
+    def append(self, row: np.ndarray) -> None:
+        if self.max_rows is not None:
+            self._append_ring(row)
+        else:
+            self._append_growable(row)
+        self.total_appended += 1
+
+    def _append_growable(self, row: np.ndarray) -> None:
+        if self._length == self._storage.shape[0]:
+            # Allocate new storage rather than resizing in place, so views of
+            # the old storage remain valid
+            storage = self._allocate((2 * self._length, self.width), self.dtype)
+            storage[: self._length] = self._storage[: self._length]
+            self._storage = storage
+        self._storage[self._length] = row
+        self._length += 1
+
+    def _append_ring(self, row: np.ndarray) -> None:
+        capacity = self.max_rows
+        if self._length < capacity:
+            index = self._length
+            self._length += 1
+        else:
+            index = self._start
+            self._start = (self._start + 1) % capacity
+        self._storage[index] = row
+        self._storage[index + capacity] = row
+
+    def oldest_first(self) -> np.ndarray:
+        """View of the stored rows, oldest row first."""
+        return self._storage[self._start : self._start + self._length]
+
+    def newest_first(self) -> np.ndarray:
+        """View of the stored rows, newest row first."""
+        return self.oldest_first()[::-1]
+
+    def newest(self, num_rows: int) -> np.ndarray:
+        """View of the newest ``num_rows`` rows, newest row first."""
+        return self.newest_first()[:num_rows]
+
+    def clear(self) -> None:
+        """Forget all rows, keeping the allocated storage for reuse."""
+        self._start = 0
+        self._length = 0
+        self.total_appended = 0
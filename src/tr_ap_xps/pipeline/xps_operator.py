@@ -4,10 +4,16 @@ import logging
 from arroyo.operator import Operator
 from arroyo.schemas import Message
 
-from ..schemas import DataFrameModel, XPSRawEvent, XPSResultStop, XPSStart, XPSStop
+from ..config import settings
+from ..schemas import DataFrameModel, XPSRawFrame, XPSResultStop, XPSStart, XPSStop
 from ..timing import timer
+from .analysis import ProcessPoolAnalyzer, analyze_arrays, build_analyzer
+from .distributed import ShotDispatcher
+from .scheduling import LatestWinsScheduler
 from .xps_processor import XPSProcessor
 
+app_settings = settings.xps
+
 logger = logging.getLogger(__name__)
 
 
@@ -15,10 +21,32 @@ class XPSOperator(Operator):
     """
     XPSOperator is responsible for handling XPS-related messages and processing frames.
 
+    Each frame is reduced inline. When a frame completes a shot, its analysis
+    is handed to a latest-wins scheduler, so ingesting frames never waits on
+    peak fitting or the FFTs, and a shot that completes while the previous
+    analysis is still running replaces any shot still waiting for analysis.
+
+    With the process analysis backend, analysis runs in a pool of worker
+    processes shared by all runs, and up to one shot per worker is analyzed
+    at once. With the distributed backend, every completed shot is sent to
+    shot workers, possibly on other hosts, which also keep the shot
+    statistics.
+
     """
 
     def __init__(self) -> None:
         self.xps_processor = None
+        self.scheduler: LatestWinsScheduler | ShotDispatcher = None
+        analysis_settings = app_settings.get("analysis", {})
+        self.dispatcher: ShotDispatcher = None
+        if analysis_settings.get("backend") == "distributed":
+            self.dispatcher = ShotDispatcher(
+                analysis_settings.get("dispatch_address", "tcp://127.0.0.1:5560"),
+                analysis_settings.get("collect_address", "tcp://127.0.0.1:5561"),
+            )
+            self.analyzer, self.max_concurrent_shots = analyze_arrays, 1
+        else:
+            self.analyzer, self.max_concurrent_shots = build_analyzer(analysis_settings)
 
     async def process(self, message: Message) -> None:
         """
@@ -28,31 +56,80 @@ class XPSOperator(Operator):
         Args:
             message (Message): The message to be processed. It can be one of the following types:
                 - XPSStart: Initializes the XPSProcessor and publishes the start message.
-                - XPSRawEvent: Processes a frame using the XPSProcessor and publishes the result.
-                - XPSStop: Finalizes the XPSProcessor and publishes the stop message.
+                - XPSRawFrame: Reduces the frame and schedules analysis of completed shots.
+                - XPSStop: Waits for scheduled analysis and publishes the stop message.
 
         Returns:
             None
         """
         if isinstance(message, XPSStart):
+            if self.scheduler is not None:
+                # a run that never saw its stop message
+                await self.scheduler.drain()
+                self.scheduler = None
+                self.xps_processor = None
+                self._end_run()
             timer.reset()
-            self.xps_processor = XPSProcessor(message)
+            self.xps_processor = XPSProcessor(
+                message,
+                analyzer=self.analyzer,
+                shot_statistics=self.dispatcher is None,
+            )
+            if self.dispatcher is not None:
+                width = message.rectangle.right - message.rectangle.left
+                self.dispatcher.start_run(
+                    self.publish,
+                    (message.f_reset, width),
+                    self.xps_processor.fft_window,
+                    self.xps_processor.fft_dtype,
+                )
+                self.scheduler = self.dispatcher
+            else:
+                self.scheduler = LatestWinsScheduler(
+                    self.xps_processor.analyze_shot,
+                    self.publish,
+                    max_concurrency=self.max_concurrent_shots,
+                )
             await self.publish(message)
 
-        elif isinstance(message, XPSRawEvent):
+        elif isinstance(message, XPSRawFrame):
             if not self.xps_processor:
                 logger.error(
-                    "Received XPSRawEvent without an active XPSProcessor. Started after labview started?"
+                    "Received XPSRawFrame without an active XPSProcessor. Started after labview started?"
                 )
                 return
-            result: XPSRawEvent = await asyncio.to_thread(
-                self.xps_processor.process_frame, message
-            )
-            if result:
-                await self.publish(result)
+            shot = await asyncio.to_thread(self.xps_processor.process_frame, message)
+            if shot is not None:
+                self.scheduler.submit(shot)
 
         elif isinstance(message, XPSStop):
+            run_summary = {}
+            if self.scheduler is not None:
+                await self.scheduler.drain()
+                run_summary["analysis"] = self.scheduler.counters()
+                logger.info(f"Shot analysis: {run_summary['analysis']}")
+                self.scheduler = None
+            if message.ingest_counters is not None:
+                run_summary["ingest"] = message.ingest_counters
             data_frame_model = DataFrameModel(df=timer.timing_dataframe)
-            new_msg = XPSResultStop(function_timings=data_frame_model)
+            new_msg = XPSResultStop(
+                function_timings=data_frame_model, run_summary=run_summary
+            )
             await self.publish(new_msg)
             self.xps_processor = None
+            self._end_run()
+
+    def _end_run(self) -> None:
+        if isinstance(self.analyzer, ProcessPoolAnalyzer):
+            # the run's history in shared memory
+            self.analyzer.end_run()
+
+    async def stop(self) -> None:
+        """Stop the analysis workers and release what they share, when the app stops."""
+        if self.scheduler is not None:
+            await self.scheduler.drain()
+            self.scheduler = None
+        if isinstance(self.analyzer, ProcessPoolAnalyzer):
+            await asyncio.to_thread(self.analyzer.shutdown)
+        if self.dispatcher is not None:
+            self.dispatcher.close()
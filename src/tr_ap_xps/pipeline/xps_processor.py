@@ -1,107 +1,225 @@
 import logging
+from typing import NamedTuple, Optional
 
 import numpy as np
 
-from ..schemas import DataFrameModel, NumpyArrayModel, XPSRawEvent, XPSResult, XPSStart
+from ..config import settings
+from ..schemas import DataFrameModel, NumpyArrayModel, XPSRawFrame, XPSResult, XPSStart
 from ..timing import timer
-from .fft import calculate_fft_items
-from .peak_fitting import peak_fit
+from .analysis import ShotAnalysis, analyze_arrays
+from .demodulation import HarmonicDemodulator
+from .phase_folding import PhaseFoldedAccumulator
+from .statistics import RunningStatistics
+from .waterfall import WaterfallBuffer
+
+app_settings = settings.xps
 
 logger = logging.getLogger("tr_ap_xps.processor")
 
 
+class ShotSnapshot(NamedTuple):
+    """Everything analyze_shot needs from a completed shot"""
+
+    frame_number: int
+    shot_num: int
+    line: np.ndarray  # last integrated frame of the shot
+    integrated_frames: np.ndarray  # newest first
+    shot_recent: np.ndarray
+    shot_mean: Optional[np.ndarray]  # None when shot statistics are kept elsewhere
+    shot_std: Optional[np.ndarray]
+    products: dict  # optional XPSResult fields, already wrapped
+
+
+def shot_result(shot: ShotSnapshot, analysis: ShotAnalysis) -> XPSResult:
+    return XPSResult(
+        frame_number=shot.frame_number,
+        integrated_frames=NumpyArrayModel(array=shot.integrated_frames),
+        detected_peaks=DataFrameModel(df=analysis.detected_peaks),
+        vfft=NumpyArrayModel(array=analysis.vfft),
+        ifft=NumpyArrayModel(array=analysis.ifft),
+        shot_num=shot.shot_num,
+        shot_recent=NumpyArrayModel(array=shot.shot_recent),
+        shot_mean=NumpyArrayModel(array=shot.shot_mean),
+        shot_std=NumpyArrayModel(array=shot.shot_std),
+        **shot.products,
+    )
+
+
 class XPSProcessor:
     """
     A class to process XPS (X-ray Photoelectron Spectroscopy) data.
 
     """
 
-    def __init__(self, message: XPSStart):
+    def __init__(
+        self, message: XPSStart, analyzer=analyze_arrays, shot_statistics: bool = True
+    ):
+        # runs peak fitting and the FFTs for analyze_shot, in this process
+        # or in a ProcessPoolAnalyzer
+        self.analyzer = analyzer
         self.frames_per_cycle = message.f_reset
-        self.integrated_frames: np.ndarray = None
-        self.shot_num = 0
-        self.shot_cache = (
-            None  # built up with each integrated frame, reset at the end of each shot
+        width = message.rectangle.right - message.rectangle.left
+        # A ProcessPoolAnalyzer gives out shared memory for the history, so
+        # its workers read the rows appended here without a copy
+        self.integrated_frames = WaterfallBuffer(
+            width, allocate=getattr(analyzer, "allocate", np.empty)
         )
+        self.shot_num = 0
+        # built up with each integrated frame, reset at the end of each shot
+        self.shot_cache = WaterfallBuffer(width, max_rows=self.frames_per_cycle)
+        # With fft mode "window", vfft and ifft only cover the most recent
+        # window_shots shots, so their cost stays constant as the run grows.
+        fft_settings = app_settings.get("fft", {})
+        fft_mode = fft_settings.get("mode", "full")
+        self.fft_window = None
+        if fft_mode == "window":
+            self.fft_window = fft_settings.get("window_shots", 20) * message.f_reset
+        elif fft_mode != "full":
+            logger.warning(f"Unknown fft mode {fft_mode}, using full history")
+        self.fft_dtype = np.dtype(fft_settings.get("precision", "float64"))
+        # Optional lock-in demodulation at the cycle frequency and harmonics
+        self.demodulator = None
+        harmonics = app_settings.get("demodulation", {}).get("harmonics") or []
+        max_harmonic = self.frames_per_cycle // 2
+        if any(h < 0 or h > max_harmonic for h in harmonics):
+            logger.warning(
+                f"Ignoring harmonics outside 0..{max_harmonic} for F_Reset "
+                f"{self.frames_per_cycle}"
+            )
+            harmonics = [h for h in harmonics if 0 <= h <= max_harmonic]
+        if harmonics:
+            self.demodulator = HarmonicDemodulator(
+                self.frames_per_cycle, width, harmonics
+            )
+        # Optional mean line per phase of the cycle and pumped difference
+        self.phase_folding = None
+        if app_settings.get("phase_folding", {}).get("enabled", True):
+            try:
+                self.phase_folding = PhaseFoldedAccumulator(
+                    self.frames_per_cycle,
+                    width,
+                    message.f_trigger,
+                    message.f_untrigger,
+                    message.f_dead,
+                )
+            except ValueError as e:
+                logger.warning(f"Phase folding disabled: {e}")
         self.shot_recent = None  # updated at the completion of each shot
-        self.shot_rolling_mean = None
-        self.shot_rolling_variance = None
-        self.shot_rolling_std = None
+        # Per element statistics over completed shots, (f_reset, width). Off
+        # when shot workers keep them and they are merged afterwards.
+        self.shot_statistics = None
+        if shot_statistics:
+            self.shot_statistics = RunningStatistics(
+                (self.frames_per_cycle, width),
+                alpha=app_settings.get("shot_statistics", {}).get("alpha"),
+            )
 
     @timer
     def _compute_mean(self, curr_frame: np.array):
         return np.mean(curr_frame, axis=0)
 
-    @timer
-    def _compute_rolling_values(self, curr_frame: np.array):
-        if self.shot_rolling_mean is None:
-            self.shot_rolling_mean = curr_frame
-            self.shot_rolling_std = np.zeros_like(curr_frame)
-            self.shot_rolling_variance = self.shot_rolling_std
-        else:
-            new_mean = self.shot_rolling_mean + (curr_frame - self.shot_rolling_mean) / self.shot_num
-            self.shot_rolling_variance += (curr_frame - self.shot_rolling_mean) * (curr_frame - new_mean)
-            self.shot_rolling_mean = new_mean
-            self.shot_rolling_std = np.sqrt(self.shot_rolling_variance / self.shot_num)
+    def _demodulation_products(self) -> dict:
+        if self.demodulator is None:
+            return {}
+        return {
+            "harmonic_amplitude": NumpyArrayModel(array=self.demodulator.amplitude()),
+            "harmonic_phase": NumpyArrayModel(array=self.demodulator.phase()),
+        }
+
+    def _phase_folding_products(self) -> dict:
+        if self.phase_folding is None:
+            return {}
+        return {
+            "phase_folded": NumpyArrayModel(array=self.phase_folding.folded_mean()),
+            "pumped_difference": NumpyArrayModel(array=self.phase_folding.difference()),
+        }
 
     @timer
-    def process_frame(self, message: XPSRawEvent) -> None:
+    def process_frame(self, message: XPSRawFrame) -> Optional[ShotSnapshot]:
+        """
+        Cheap per-frame reduction, run for every frame.
+
+        Returns a snapshot for analyze_shot when the frame completes a shot.
+        """
         try:
             # Compute horizontally-integrated frame
-            new_integrated_frame = self._compute_mean(message.image.array)
+            new_integrated_frame = self._compute_mean(message.image)
 
             # Update the local cached arrays
-            if self.integrated_frames is None:
-                self.integrated_frames = new_integrated_frame[None, :]
-            else:
-                # self.integrated_frames = np.vstack(
-                #     (self.integrated_frames, new_integrated_frame)
-                # )
-                self.integrated_frames = np.vstack(
-                    (new_integrated_frame, self.integrated_frames)
-                )
-
-            if self.shot_cache is None:
-                self.shot_cache = new_integrated_frame[
-                    np.newaxis, :
-                ]  # add a new axis frame number
-            else:
-                self.shot_cache = np.vstack((self.shot_cache, new_integrated_frame))
+            self.integrated_frames.append(new_integrated_frame)
+            self.shot_cache.append(new_integrated_frame)
+            if self.demodulator is not None:
+                self.demodulator.update(message.frame_number, new_integrated_frame)
+            if self.phase_folding is not None:
+                self.phase_folding.update(message.frame_number, new_integrated_frame)
 
             # Things to do with every shot (a "shot" is a complete cycle of frames)
             if (
-                message.image_info.frame_number != 0
-                and message.image_info.frame_number % self.frames_per_cycle == 0
+                message.frame_number != 0
+                and message.frame_number % self.frames_per_cycle == 0
             ):
-                self.shot_num += 1
- 
-                self.shot_recent = self.shot_cache
+                return self._complete_shot(message.frame_number, new_integrated_frame)
+        except Exception as e:
+            logger.exception(f"Error processing frame: {e}")
+            return None
+        finally:
+            timer.end_frame()
 
-                self._compute_rolling_values(self.shot_cache)
+    def _complete_shot(self, frame_number: int, line: np.ndarray) -> ShotSnapshot:
+        self.shot_num += 1
 
+        # The shot cache is reused for the next shot, so keep a copy
+        self.shot_recent = self.shot_cache.oldest_first().copy()
+        self.shot_cache.clear()
 
-                logger.info(f"Processing frame {message.image_info.frame_number}")
-                # Peak detection on new_integrated_frame
-                detected_peaks_df = peak_fit(new_integrated_frame)
-                # TODO: allow user to select repeat factor and width on UI
-                vfft_np, ifft_np = calculate_fft_items(
-                    self.integrated_frames, repeat_factor=20, width=0
+        shot_mean = shot_std = None
+        if self.shot_statistics is not None:
+            if len(self.shot_recent) == self.frames_per_cycle:
+                self.shot_statistics.update(self.shot_recent)
+            else:
+                # e.g. the first shot of a run joined part way through
+                logger.info(
+                    f"Shot {self.shot_num} has {len(self.shot_recent)} frames, "
+                    "leaving it out of shot statistics"
                 )
+            # copies, as the statistics are updated in place next shot
+            shot_mean = self.shot_statistics.mean.copy()
+            shot_std = self.shot_statistics.std()
+
+        return ShotSnapshot(
+            frame_number=frame_number,
+            shot_num=self.shot_num,
+            line=line,
+            # Newest line first. Rows already appended are never rewritten,
+            # so this view is safe to analyze while more frames arrive.
+            integrated_frames=self.integrated_frames.newest_first(),
+            shot_recent=self.shot_recent,
+            shot_mean=shot_mean,
+            shot_std=shot_std,
+            products={
+                **self._demodulation_products(),
+                **self._phase_folding_products(),
+            },
+        )
 
-                result = XPSResult(
-                    frame_number=message.image_info.frame_number,
-                    integrated_frames=NumpyArrayModel(array=self.integrated_frames),
-                    detected_peaks=DataFrameModel(df=detected_peaks_df),
-                    vfft=NumpyArrayModel(array=vfft_np),
-                    ifft=NumpyArrayModel(array=ifft_np),
-                    shot_num=self.shot_num,
-                    shot_recent=NumpyArrayModel(array=self.shot_recent),
-                    shot_mean=NumpyArrayModel(array=self.shot_rolling_mean),
-                    shot_std=NumpyArrayModel(array=self.shot_rolling_std),
-                )
-                self.shot_cache = None
-                return result 
+    @timer
+    def analyze_shot(self, shot: ShotSnapshot) -> Optional[XPSResult]:
+        """
+        Heavy per-shot analysis, peak fitting and the FFTs over the history.
+
+        Only reads the snapshot and the processor's settings, so it can run
+        in a worker while process_frame carries on with the next frames.
+        Shot statistics are not part of it: they are cheap, updated in place
+        and needed in order, so process_frame keeps them current.
+        """
+        try:
+            logger.info(f"Processing frame {shot.frame_number}")
+            # Peak detection on the last line, FFTs over the history
+            analysis = self.analyzer(
+                shot.line, shot.integrated_frames, self.fft_window, self.fft_dtype
+            )
+
+            return shot_result(shot, analysis)
         except Exception as e:
-            logger.exception(f"Error processing frame: {e}")
+            logger.exception(f"Error analyzing shot {shot.shot_num}: {e}")
             return None
-        timer.end_frame()
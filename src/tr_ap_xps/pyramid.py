@@ -0,0 +1,142 @@
+from typing import NamedTuple
+
+import numpy as np
+
+"""
+    Multi-resolution copies of a waterfall, so viewers are sent about as many
+    rows as they can show rather than the whole run.
+
+    Level 0 holds the waterfall rows, oldest first, and each row of level k
+    stands for 2**k rows of level 0, reduced by mean or max. Rows are
+    appended as shots arrive and each level is extended from the one below,
+    so an update costs the size of the new rows, not of the run. Rows of a
+    level are only stored once complete; the newest, partial row of a level
+    is reduced from level 0 when asked for.
+"""
+
+REDUCERS = {"mean": np.mean, "max": np.max}
+
+
+def decimate(rows: np.ndarray, level: int, reduce: str = "mean") -> np.ndarray:
+    """Reduce each 2**level rows to one, the last from what is left over."""
+    factor = 1 << level
+    if factor == 1 or len(rows) == 0:
+        return rows
+    reducer = REDUCERS[reduce]
+    complete = len(rows) // factor * factor
+    reduced = reducer(
+        rows[:complete].reshape(-1, factor, *rows.shape[1:]), axis=1
+    ).astype(rows.dtype, copy=False)
+    if complete < len(rows):
+        tail = reducer(rows[complete:], axis=0, keepdims=True).astype(rows.dtype)
+        reduced = np.concatenate((reduced, tail))
+    return reduced
+
+
+def level_for(num_rows: int, max_rows: int = None) -> int:
+    """The lowest level at which num_rows rows fit in max_rows."""
+    if not max_rows or num_rows <= max_rows:
+        return 0
+    return int(np.ceil(np.log2(num_rows / max_rows)))
+
+
+class _Rows:
+    """A growable array of rows"""
+
+    def __init__(self, width: int, dtype: np.dtype):
+        self.data = np.empty((16, width), dtype=dtype)
+        self.count = 0
+
+    @property
+    def rows(self) -> np.ndarray:
+        return self.data[: self.count]
+
+    def extend(self, rows: np.ndarray) -> None:
+        needed = self.count + len(rows)
+        if needed > len(self.data):
+            # Rows already handed out stay valid, as they are never written
+            # again, whether or not they were copied.
+            grown = np.empty(
+                (max(needed, 2 * len(self.data)), self.data.shape[1]),
+                dtype=self.data.dtype,
+            )
+            grown[: self.count] = self.rows
+            self.data = grown
+        self.data[self.count : needed] = rows
+        self.count = needed
+
+
+class Section(NamedTuple):
+    """Rows of one level of a pyramid, starting at row first of that level"""
+
+    level: int
+    first: int
+    rows: np.ndarray  # oldest first, the last one partial unless complete
+    complete: int  # rows that will not change
+
+
+class WaterfallPyramid:
+    """The rows of a waterfall at every level of detail"""
+
+    def __init__(self, reduce: str = "mean", dtype: np.dtype = np.float32):
+        if reduce not in REDUCERS:
+            raise ValueError(f"reduce must be one of {list(REDUCERS)}")
+        self.reduce = reduce
+        self.dtype = np.dtype(dtype)
+        self.reset()
+
+    def reset(self) -> None:
+        self.levels: list[_Rows] = []
+
+    @property
+    def num_rows(self) -> int:
+        return self.levels[0].count if self.levels else 0
+
+    def append(self, rows: np.ndarray) -> None:
+        """Add rows, oldest first, to every level."""
+        if len(rows) == 0:
+            return
+        if not self.levels:
+            self.levels.append(_Rows(rows.shape[1], self.dtype))
+        self.levels[0].extend(rows)
+        level = 0
+        while self.levels[level].count >= 2:
+            below = self.levels[level]
+            if level + 1 == len(self.levels):
+                self.levels.append(_Rows(below.data.shape[1], self.dtype))
+            above = self.levels[level + 1]
+            pairs = below.count // 2
+            if pairs > above.count:
+                new = below.rows[2 * above.count : 2 * pairs]
+                above.extend(decimate(new, 1, self.reduce))
+            level += 1
+
+    def section(
+        self, max_rows: int = None, first: int = 0, last: int = None
+    ) -> Section:
+        """
+        Rows of level 0 from first up to, not including, last, or up to the
+        newest if last is None, at the lowest level that fits in max_rows.
+        """
+        num_rows = self.num_rows
+        last = num_rows if last is None else min(last, num_rows)
+        first = min(max(first, 0), last)
+        level = level_for(last - first, max_rows)
+        factor = 1 << level
+        first_row = first // factor
+        if not self.levels:
+            return Section(level, first_row, np.empty((0, 0), self.dtype), 0)
+        if level < len(self.levels):
+            stored = self.levels[level].rows
+        else:
+            # more rows to a level row than there are rows
+            stored = self.levels[0].rows[:0]
+        end = min(-(-last // factor), len(stored))
+        rows = stored[first_row:end]
+        complete = len(rows)
+        tail_start = max(end, first_row) * factor
+        if last > tail_start:
+            # the newest row of this level is still being filled
+            tail = decimate(self.levels[0].rows[tail_start:last], level, self.reduce)
+            rows = np.concatenate((rows, tail))
+        return Section(level, first_row, rows, complete)
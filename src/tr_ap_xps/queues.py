@@ -0,0 +1,376 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from enum import Enum
+from typing import Any
+
+from arroyo.publisher import Publisher
+from arroyo.schemas import Event, Message, Stop
+
+logger = logging.getLogger(__name__)
+
+
+class OverflowPolicy(str, Enum):
+    """What a bounded queue does with a new item when it is full"""
+
+    block = "block"  # wait for the consumer to make room
+    drop_oldest = "drop_oldest"  # evict the oldest droppable item
+    drop_newest = "drop_newest"  # discard the new item
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class FrameQueue:
+    """
+    A bounded queue from a producer thread to an asyncio consumer.
+
+    Only droppable items (frames) count against maxsize and are subject to
+    the overflow policy. Other items (control messages) are always queued,
+    in order, and never dropped.
+
+    Counters cover droppable items:
+
+    - received: offered to the queue
+    - queued: accepted into the queue
+    - dropped: discarded by the overflow policy
+    - late: waited longer than late_after seconds before being consumed
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1000,
+        policy: OverflowPolicy = OverflowPolicy.block,
+        late_after: float = None,
+    ):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be a positive integer")
+        self.maxsize = maxsize
+        self.policy = OverflowPolicy(policy)
+        self.late_after = late_after
+        self._items = deque()  # (enqueue time, droppable, item)
+        self._num_droppable = 0
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._loop: asyncio.AbstractEventLoop = None
+        self._ready = None
+        self._closed = False
+        self.received = 0
+        self.queued = 0
+        self.dropped = 0
+        self.late = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    def counters(self) -> dict:
+        with self._lock:
+            return {
+                "received": self.received,
+                "queued": self.queued,
+                "dropped": self.dropped,
+                "late": self.late,
+                "depth": len(self._items),
+            }
+
+    def reset_counters(self) -> None:
+        """
+        Reset the producer side counters. late is counted by the consumer as
+        items are taken, so it is left for the consumer to track.
+        """
+        with self._lock:
+            self.received = self.queued = self.dropped = 0
+
+    def put(self, item: Any, droppable: bool = True) -> bool:
+        """
+        Add an item from the producer thread. Returns False if the item was
+        dropped. With the block policy, waits until there is room.
+        """
+        with self._lock:
+            if droppable:
+                self.received += 1
+                if not self._make_room():
+                    self.dropped += 1
+                    return False
+                self.queued += 1
+                self._num_droppable += 1
+            self._items.append((time.monotonic(), droppable, item))
+            loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._ready.set)
+        return True
+
+    def _make_room(self) -> bool:
+        # called holding the lock
+        while self._num_droppable >= self.maxsize and not self._closed:
+            if self.policy == OverflowPolicy.drop_newest:
+                return False
+            if self.policy == OverflowPolicy.drop_oldest:
+                for index, (_, droppable, _) in enumerate(self._items):
+                    if droppable:
+                        del self._items[index]
+                        self._num_droppable -= 1
+                        self.dropped += 1
+                        break
+                continue
+            self._not_full.wait(timeout=0.1)
+        return not self._closed
+
+    async def get(self) -> Any:
+        """Wait for the next item. Raises QueueClosed once closed and empty."""
+        if self._loop is None:
+            self._ready = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._items:
+                    enqueued, droppable, item = self._items.popleft()
+                    if droppable:
+                        self._num_droppable -= 1
+                        self._not_full.notify()
+                        if (
+                            self.late_after is not None
+                            and time.monotonic() - enqueued > self.late_after
+                        ):
+                            self.late += 1
+                    return item
+                if self._closed:
+                    raise QueueClosed()
+                self._ready.clear()
+            await self._ready.wait()
+
+    def close(self) -> None:
+        """Wake up the consumer and any blocked producer."""
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+            loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._ready.set)
+
+
+class QueuedPublisher(Publisher):
+    """
+    Puts a publisher behind its own bounded queue and consumer task, so a
+    slow publisher does not hold up the operator or the other publishers.
+
+    Events (results) are subject to the overflow policy. Start and stop
+    messages are always queued, in order, and never dropped. With the block
+    policy, publish waits for room. The operator publishes to its publishers
+    one after another, so that stalls frame processing and every other
+    publisher. A publisher that must get every result should rather have an
+    unbounded queue (maxsize None), which logs a warning each time its depth
+    reaches warn_depth, twice that, and so on.
+
+    Besides the FrameQueue counters (received, queued, dropped), counters
+    reports the current and largest queue depth and the lag, the time from
+    publish until the wrapped publisher was handed the message. They are
+    logged and reset after each stop message is published.
+    """
+
+    def __init__(
+        self,
+        publisher: Publisher,
+        maxsize: int = 100,
+        policy: OverflowPolicy = OverflowPolicy.block,
+        name: str = None,
+        warn_depth: int = None,
+    ):
+        if maxsize is not None and maxsize <= 0:
+            raise ValueError("maxsize must be a positive integer or None")
+        if warn_depth is not None and warn_depth <= 0:
+            raise ValueError("warn_depth must be a positive integer or None")
+        self.publisher = publisher
+        self.maxsize = maxsize
+        self.policy = OverflowPolicy(policy)
+        self.name = name or type(publisher).__name__
+        self.warn_depth = warn_depth
+        self._next_warning = warn_depth
+        self._items = deque()  # (enqueue time, droppable, message)
+        self._num_droppable = 0
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._idle = asyncio.Event()  # nothing queued or being published
+        self._idle.set()
+        self._task: asyncio.Task = None
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        self.received = 0
+        self.queued = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def counters(self) -> dict:
+        return {
+            "received": self.received,
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "depth": len(self._items),
+            "max_depth": self.max_depth,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
+
+    async def publish(self, message: Message) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._consume())
+        droppable = isinstance(message, Event)
+        if droppable:
+            self.received += 1
+            while self.maxsize is not None and self._num_droppable >= self.maxsize:
+                if self.policy == OverflowPolicy.drop_newest:
+                    self.dropped += 1
+                    return
+                if self.policy == OverflowPolicy.drop_oldest:
+                    self._drop_oldest()
+                    continue
+                self._not_full.clear()
+                await self._not_full.wait()
+            self.queued += 1
+            self._num_droppable += 1
+            if (
+                self.warn_depth is not None
+                and self._num_droppable >= self._next_warning
+            ):
+                logger.warning(
+                    f"{self.name} queue holds {self._num_droppable} results, "
+                    f"waiting {time.monotonic() - self._items[0][0]:.1f} s"
+                )
+                self._next_warning *= 2
+        self._items.append((time.monotonic(), droppable, message))
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._idle.clear()
+        self._not_empty.set()
+
+    def _drop_oldest(self) -> None:
+        for index, (_, droppable, _) in enumerate(self._items):
+            if droppable:
+                del self._items[index]
+                self._num_droppable -= 1
+                self.dropped += 1
+                return
+
+    async def _consume(self) -> None:
+        while True:
+            while not self._items:
+                self._idle.set()
+                self._not_empty.clear()
+                await self._not_empty.wait()
+            enqueued, droppable, message = self._items.popleft()
+            if droppable:
+                self._num_droppable -= 1
+                self._not_full.set()
+                if (
+                    self.warn_depth is not None
+                    and self._num_droppable < self.warn_depth
+                ):
+                    self._next_warning = self.warn_depth
+            self.last_lag = time.monotonic() - enqueued
+            self.max_lag = max(self.max_lag, self.last_lag)
+            try:
+                await self.publisher.publish(message)
+            except Exception as e:
+                logger.exception(f"Error publishing with {self.name}: {e}")
+            if isinstance(message, Stop):
+                logger.info(f"{self.name} queue: {self.counters()}")
+                self.reset_counters()
+
+    async def drain(self) -> None:
+        """Wait until every queued message has been published."""
+        await self._idle.wait()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+
+class CoalescingPublisher(Publisher):
+    """
+    Hands at most max_rate events (results) a second to a publisher.
+
+    An event that comes sooner is held until the rate allows, and a newer
+    event replaces a held one, so only the newest state is published when
+    the window opens. Start and stop messages are published at once, after
+    any held event.
+
+    Counters:
+
+    - received: events handed to publish
+    - published: events handed on to the publisher
+    - coalesced: held events replaced by a newer one before being published
+
+    They are logged and reset after each stop message is published.
+    """
+
+    def __init__(self, publisher: Publisher, max_rate: float, name: str = None):
+        if max_rate <= 0:
+            raise ValueError("max_rate must be positive")
+        self.publisher = publisher
+        self.interval = 1 / max_rate
+        self.name = name or type(publisher).__name__
+        self._pending: Message = None
+        self._last = -float("inf")  # when an event was last published
+        self._lock = asyncio.Lock()  # keeps publishing in order
+        self._task: asyncio.Task = None
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        self.received = 0
+        self.published = 0
+        self.coalesced = 0
+
+    def counters(self) -> dict:
+        return {
+            "received": self.received,
+            "published": self.published,
+            "coalesced": self.coalesced,
+        }
+
+    async def publish(self, message: Message) -> None:
+        if not isinstance(message, Event):
+            await self._publish_pending()
+            async with self._lock:
+                await self._publish(message)
+            if isinstance(message, Stop):
+                logger.info(f"{self.name} rate limit: {self.counters()}")
+                self.reset_counters()
+            return
+        self.received += 1
+        if self._pending is not None:
+            self.coalesced += 1
+        self._pending = message
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._publish_when_open())
+
+    async def _publish_when_open(self) -> None:
+        wait = self._last + self.interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self._publish_pending()
+
+    async def _publish_pending(self) -> None:
+        async with self._lock:
+            message, self._pending = self._pending, None
+            if message is None:
+                return
+            self._last = time.monotonic()
+            self.published += 1
+            await self._publish(message)
+
+    async def _publish(self, message: Message) -> None:
+        try:
+            await self.publisher.publish(message)
+        except Exception as e:
+            logger.exception(f"Error publishing with {self.name}: {e}")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
@@ -1,6 +1,8 @@
-from typing import Literal
+from dataclasses import dataclass
+from typing import Literal, Optional
 
-from pydantic import BaseModel, Field
+import numpy as np
+from pydantic import BaseModel, Field, field_validator
 
 from arroyo.schemas import DataFrameModel, Event, Message, NumpyArrayModel, Start, Stop
 
@@ -19,6 +21,10 @@ from arroyo.schemas import DataFrameModel, Event, Message, NumpyArrayModel, Star
     Three of these models define the incoming message from LabView, one defines the outgoing message
     from our Operators.
 
+    Frames are the exception. XPSRawFrame is sent once per frame, so it is a plain
+    dataclass that is not validated. Its geometry is validated once per run, when the XPSImageInfo
+    is built from the start message.
+
 """
 
 
@@ -100,8 +106,16 @@ class XPSImageInfo(BaseModel):
     height: int
     data_type: str
 
+    @field_validator("width", "height")
+    @classmethod
+    def validate_positive(cls, v):
+        if v <= 0:
+            raise ValueError(f"Expected a positive frame dimension, got {v}")
+        return v
+
 
-class XPSRawEvent(Event, XPSMessage):
+@dataclass
+class XPSRawFrame(XPSMessage):
     """
 
     LabVIEW Message:
@@ -109,11 +123,12 @@ class XPSRawEvent(Event, XPSMessage):
         "msg_type": "event",
         "Frame Number": 1
     }
+
+    followed by the image, of the (height, width) geometry of the run's XPSImageInfo.
     """
 
-    msg_type: str = Literal["event"]
-    image: NumpyArrayModel
-    image_info: XPSImageInfo
+    frame_number: int
+    image: np.ndarray
 
 
 class XPSStop(Stop, XPSMessage):
@@ -125,8 +140,9 @@ class XPSStop(Stop, XPSMessage):
 
     """
 
-    pass
     # num_frames: int = Field(..., alias="Num Frames")
+    # received/queued/dropped/late frame counts from the listener
+    ingest_counters: Optional[dict] = None
 
 
 class XPSResult(Event, XPSMessage):
@@ -144,8 +160,17 @@ class XPSResult(Event, XPSMessage):
     shot_recent: NumpyArrayModel
     shot_mean: NumpyArrayModel
     shot_std: NumpyArrayModel
+    # lock-in amplitude and phase at the cycle harmonics, (harmonics, width)
+    harmonic_amplitude: Optional[NumpyArrayModel] = None
+    harmonic_phase: Optional[NumpyArrayModel] = None
+    # mean line at each phase of the cycle, (f_reset, width)
+    phase_folded: Optional[NumpyArrayModel] = None
+    # mean pumped line minus mean unpumped line, (width,)
+    pumped_difference: Optional[NumpyArrayModel] = None
 
 
 class XPSResultStop(Stop, XPSMessage):
     msg_type: str = Literal["result_stop"]
     function_timings: DataFrameModel
+    # counters describing the run, e.g. {"ingest": {...}}
+    run_summary: dict = Field(default_factory=dict)
@@ -1,7 +1,11 @@
 import asyncio
 import json
 import logging
-from typing import Union
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Union
 
 import msgpack
 import numpy as np
@@ -10,25 +14,338 @@ import websockets
 
 from arroyo.publisher import Publisher
 
+from .compression import choose_codec, compress
+from .pyramid import Section, WaterfallPyramid, decimate, level_for
 from .schemas import XPSResult, XPSResultStop, XPSStart
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass(frozen=True)
+class Viewport:
+    """
+    The waterfall rows a client shows: rows first up to last, or up to the
+    newest if last is None, in at most max_rows rows, or all of them if
+    max_rows is None
+    """
+
+    max_rows: int = None
+    first: int = 0
+    last: int = None
+
+    def __post_init__(self):
+        if self.max_rows is not None and not (
+            isinstance(self.max_rows, int) and self.max_rows > 0
+        ):
+            raise ValueError("rows must be a positive integer")
+        if not (isinstance(self.first, int) and self.first >= 0):
+            raise ValueError("first must be a non-negative integer")
+        if self.last is not None and not (
+            isinstance(self.last, int) and self.last > self.first
+        ):
+            raise ValueError("last must be an integer greater than first")
+
+    @classmethod
+    def from_request(cls, request: dict) -> "Viewport":
+        return cls(request.get("rows"), request.get("first", 0), request.get("last"))
+
+
+# Products a client can subscribe to. The optional ones are only sent for
+# results that have them.
+PRODUCTS = (
+    "raw",
+    "vfft",
+    "ifft",
+    "shot_recent",
+    "shot_mean",
+    "shot_std",
+    "peaks",
+    "harmonic_amplitude",
+    "harmonic_phase",
+    "phase_folded",
+    "pumped_difference",
+)
+# optional products sent as float32, as they are not images to log stretch
+FLOAT_PRODUCTS = (
+    "harmonic_amplitude",
+    "harmonic_phase",
+    "phase_folded",
+    "pumped_difference",
+)
+
+
+@dataclass(frozen=True)
+class Subscription:
+    """
+    What a client is sent: products, at most max_rate results a second, or
+    every result if None, and the waterfall and FFTs at the resolution of
+    viewport
+    """
+
+    products: frozenset = frozenset(PRODUCTS)
+    max_rate: float = None
+    viewport: Viewport = Viewport()
+
+    def __post_init__(self):
+        unknown = self.products - set(PRODUCTS)
+        if unknown:
+            raise ValueError(f"unknown products {sorted(unknown)}")
+        if self.max_rate is not None and not (
+            isinstance(self.max_rate, (int, float)) and self.max_rate > 0
+        ):
+            raise ValueError("max_rate must be a positive number")
+
+    @classmethod
+    def from_request(cls, request: dict) -> "Subscription":
+        products = request.get("products", PRODUCTS)
+        if not isinstance(products, list | tuple):
+            raise ValueError("products must be a list")
+        return cls(
+            frozenset(products),
+            request.get("max_rate"),
+            Viewport.from_request(request),
+        )
+
+
+class ClientSender:
+    """
+    Sends messages to one websocket client from its own bounded queue, so a
+    slow client only holds up itself.
+
+    Start messages are always sent. Results are latest wins: once
+    max_queued are waiting, the waiting results are replaced by a single
+    snapshot, encoded when its turn comes, so a slow client skips ahead to
+    the newest state rather than falling further behind. Results are
+    deltas, so a client that misses one needs a snapshot anyway.
+
+    A client that takes more than stall_timeout seconds to take one message
+    is disconnected.
+
+    The sender also keeps the client's subscription, when it was last sent a
+    result, the sequence number of that result and which waterfall rows the
+    client has: the pyramid level and first row of what it was last sent,
+    and how many of the rows sent are complete.
+
+    Counters:
+
+    - queued_bytes: size of the results waiting to be sent
+    - sent: results and snapshots sent
+    - dropped: results skipped
+    - coalesced: results held back to keep to the subscription's max_rate
+      and replaced by a newer one before the client was updated
+    - last_latency, max_latency: seconds from queuing a result until it was
+      sent
+    """
+
+    def __init__(
+        self,
+        websocket,
+        snapshot: Callable[["ClientSender"], Awaitable[list]],
+        max_queued: int = 2,
+        stall_timeout: float = 10.0,
+    ):
+        if max_queued <= 0:
+            raise ValueError("max_queued must be a positive integer")
+        self.websocket = websocket
+        self.snapshot = snapshot
+        self.max_queued = max_queued
+        self.stall_timeout = stall_timeout
+        self._items = deque()  # (kind, enqueue time, frames)
+        self._num_results = 0
+        self._snapshot_queued = False
+        self._ready = asyncio.Event()
+        self._task: asyncio.Task = None
+        self.subscription = Subscription()
+        self.last_update = -float("inf")  # time the last result was queued
+        self.deferred: asyncio.TimerHandle = None  # update held for max_rate
+        self.seq = None  # of the last result queued
+        self.view = None  # (level, first row) of the rows the client has
+        self.codec = None  # bundles are compressed with
+        self.complete = 0  # complete rows the client has
+        self.queued_bytes = 0
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+
+    def counters(self) -> dict:
+        return {
+            "queued_bytes": self.queued_bytes,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+        }
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._send())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def send_start(self, start_message: str) -> None:
+        """Queue a start message. Anything still queued is for the last run."""
+        # the client starts the new run with an empty waterfall
+        self.view = None
+        self.seq = None
+        self.complete = 0
+        self._drop_results()
+        if self._snapshot_queued:
+            self._items.pop()  # always last
+            self._snapshot_queued = False
+        self._append("start", start_message)
+
+    def send_result(self, frames: list) -> None:
+        if self._snapshot_queued:
+            # the snapshot is encoded when sent, so it includes this result
+            self.dropped += 1
+        elif self._num_results >= self.max_queued:
+            self.dropped += 1
+            self.send_snapshot()
+        else:
+            self._num_results += 1
+            self.queued_bytes += _size(frames)
+            self._append("result", frames)
+
+    @property
+    def snapshot_queued(self) -> bool:
+        return self._snapshot_queued
+
+    def send_snapshot(self) -> None:
+        """Queue a snapshot in place of the results waiting to be sent."""
+        if self._snapshot_queued:
+            return
+        self._drop_results()
+        self._snapshot_queued = True
+        self._append("snapshot", None)
+
+    def _append(self, kind: str, frames) -> None:
+        self._items.append((kind, time.monotonic(), frames))
+        self._ready.set()
+
+    def _drop_results(self) -> None:
+        # Results are only queued after the last start message, so they are
+        # at the end, with no snapshot queued.
+        while self._num_results:
+            _, _, frames = self._items.pop()
+            self._num_results -= 1
+            self.queued_bytes -= _size(frames)
+            self.dropped += 1
+
+    async def _send(self) -> None:
+        while True:
+            while not self._items:
+                self._ready.clear()
+                await self._ready.wait()
+            kind, enqueued, frames = self._items.popleft()
+            if kind == "result":
+                self._num_results -= 1
+                self.queued_bytes -= _size(frames)
+            elif kind == "snapshot":
+                # Later results are deltas on this snapshot. The snapshot is
+                # taken before this task yields, so none can be missed.
+                self._snapshot_queued = False
+                frames = await self.snapshot(self)
+                if frames is None:
+                    continue
+            elif kind == "start":
+                frames = [frames]
+            try:
+                await asyncio.wait_for(self._send_frames(frames), self.stall_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Disconnecting {self.websocket.remote_address}, stalled for "
+                    f"{self.stall_timeout}s with {self.counters()}"
+                )
+                await self.websocket.close(1013, "Client too slow")
+                return
+            except websockets.ConnectionClosed:
+                return
+            if kind != "start":
+                self.sent += 1
+                self.last_latency = time.monotonic() - enqueued
+                self.max_latency = max(self.max_latency, self.last_latency)
+
+    async def _send_frames(self, frames: list) -> None:
+        for frame in frames:
+            await self.websocket.send(frame)
+
+
+def _size(frames: list) -> int:
+    return sum(len(frame) for frame in frames)
+
+
 class XPSWSResultPublisher(Publisher):
     """
     A publisher class for sending XPSResult messages over a web sockets.
 
+    Each result is encoded once and the same bytes are sent to every
+    connected client, so the cost of encoding does not grow with the number
+    of clients.
+
+    The waterfall only grows, so results are sent as deltas: the waterfall
+    rows appended since the previous result, along with the products that
+    are recomputed every shot (vfft, ifft, peaks and shot arrays). Each
+    delta has a sequence number. A client gets a snapshot, the full latest
+    result, when it connects and whenever it asks for one by sending
+    {"type": "resync"}, e.g. after it sees a gap in the sequence.
+
+    Each client is sent to from its own ClientSender, which bounds what is
+    buffered for it and skips a slow client ahead to the latest result.
+    Client counters are logged and reset at the end of each run.
+
+    Bundles are sent uncompressed unless a client sends
+    {"type": "codecs", "accept": [...]}, the codecs it can decompress in
+    order of preference. Each result is compressed once for each codec in
+    use, by compress_frames.
+
+    A client chooses what it is sent with a Subscription, by sending
+    {"type": "subscribe", "products": [...], "max_rate": ..., "rows": ...,
+    "first": ..., "last": ...}; fields left out take their defaults, every
+    product at every result at full resolution. Products not subscribed to
+    are not encoded for the client. A result that would exceed max_rate
+    results a second is held back, and the client is sent the newest result
+    once the rate allows, so deltas say which sequence number they apply
+    to, base_seq. The waterfall is kept as a WaterfallPyramid,
+    and a client is sent the waterfall rows first to last at the level of
+    detail that fits in rows, and vfft and ifft decimated to fit in rows, so
+    what it is sent depends on its screen rather than the length of the
+    run. Clients with the same products and viewport share encoded results.
+
     """
 
     websocket_server = None
-    connected_clients = set()
     current_start_message = None
 
-    def __init__(self, host: str = "localhost", port: int = 8001):
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 8001,
+        max_queued: int = 2,
+        stall_timeout: float = 10.0,
+        decimation: str = "mean",
+        codecs: list = None,
+    ):
         super().__init__()
         self.host = host
         self.port = port
+        self.max_queued = max_queued
+        self.stall_timeout = stall_timeout
+        self.clients = {}  # websocket: ClientSender
+        self.seq = 0  # of the latest result
+        self.rows = 0  # waterfall rows in the latest result
+        self.current_result: XPSResult = None
+        self.pyramid = WaterfallPyramid(decimation)
+        self.codecs = codecs  # allowed, None for all that are available
+        # (content key, codec): future of the frames, of the latest result
+        self._encoded = {}
+        self._snapshots = {}
 
     async def start(
         self,
@@ -38,44 +355,175 @@ class XPSWSResultPublisher(Publisher):
             self.websocket_handler,
             self.host,
             self.port,
+            # bundles are compressed once per codec rather than per client
+            compression=None,
         )
         logger.info(f"Websocket server started at ws://{self.host}:{self.port}")
         await server.wait_closed()
 
-    async def publish(self, message: XPSResult) -> None:
-        if self.connected_clients:  # Only send if there are clients connected
-            asyncio.gather(
-                *(self.publish_ws(client, message) for client in self.connected_clients)
-            )
-
-    async def publish_ws(
-        self,
-        #  client: websockets.client.ClientConnection,
-        client,
-        message: Union[XPSResult | XPSStart | XPSResultStop],
+    async def publish(
+        self, message: Union[XPSResult | XPSStart | XPSResultStop]
     ) -> None:
         if isinstance(message, XPSResultStop):
             self.current_start_message = None
+            self._reset_stream()
+            for client in self.clients.values():
+                logger.info(
+                    f"Client {client.websocket.remote_address}: {client.counters()}"
+                )
+                client.reset_counters()
             return
 
         if isinstance(message, XPSStart):
-            self.current_start_message = message
-            await client.send(json.dumps(message.model_dump()))
+            self.current_start_message = json.dumps(message.model_dump())
+            self._reset_stream()
+            for client in self.clients.values():
+                client.send_start(self.current_start_message)
+            return
+
+        waterfall = message.integrated_frames.array  # newest row first
+        rows = waterfall.shape[0]
+        if rows < self.rows:
+            # a shorter waterfall can only be resent
+            self.pyramid.reset()
+            self.rows = 0
+        self.pyramid.append(waterfall[: rows - self.rows][::-1])
+        self.seq += 1
+        self.rows = rows
+        self.current_result = message
+        self._snapshots = {}
+        self._encoded = {}
+        for client in list(self.clients.values()):
+            await self._update(client)
+
+    async def _update(self, client: ClientSender) -> None:
+        """
+        Queue the latest result for the client, unless it has to wait to keep
+        to its max_rate, in which case it is updated when the wait is over.
+        """
+        if client.snapshot_queued:
+            client.send_result(None)  # covered by the snapshot
             return
+        subscription = client.subscription
+        now = time.monotonic()
+        if subscription.max_rate is not None:
+            wait = client.last_update + 1 / subscription.max_rate - now
+            if wait > 0:
+                if client.deferred is None:
+                    client.deferred = asyncio.get_running_loop().call_later(
+                        wait, self._deferred_update, client
+                    )
+                else:
+                    client.coalesced += 1
+                return
+        viewport = subscription.viewport
+        section = None
+        start = 0
+        base_seq = None
+        if "raw" in subscription.products:
+            section = self.pyramid.section(
+                viewport.max_rows, viewport.first, viewport.last
+            )
+            if client.view != (section.level, section.first):
+                # e.g. the waterfall outgrew the client's level
+                client.send_snapshot()
+                return
+            start = client.complete
+            base_seq = client.seq
+            client.complete = section.complete
+        client.seq = self.seq
+        client.last_update = now
+        key = (subscription.products, viewport, start, base_seq)
+        new = (key, client.codec) not in self._encoded
+        frames = await self._encode(
+            self._encoded,
+            key,
+            client.codec,
+            self.current_result,
+            self.seq,
+            start,
+            section,
+            viewport.max_rows,
+            self.pyramid.reduce,
+            subscription.products,
+            base_seq,
+        )
+        if new:
+            logger.info(
+                f"Sending image bundle of size {len(frames[-1])} with "
+                f"{sorted(subscription.products)}, compressed with {client.codec}"
+            )
+        client.send_result(frames)
+
+    def _deferred_update(self, client: ClientSender) -> None:
+        client.deferred = None
+        if (
+            self.clients.get(client.websocket) is client
+            and self.current_result is not None
+            and client.seq != self.seq
+        ):
+            asyncio.create_task(self._update(client))
+
+    def _encode(self, cache: dict, key: tuple, codec: str, *args) -> Awaitable[list]:
+        """
+        The frames encode_result(*args) makes, compressed with codec, encoded
+        and compressed once for everyone asking for the same key and codec
+        """
+        if (key, None) not in cache:
+            cache[key, None] = asyncio.ensure_future(
+                asyncio.to_thread(encode_result, *args)
+            )
+        if (key, codec) not in cache:
+            cache[key, codec] = asyncio.ensure_future(
+                _compress_later(cache[key, None], codec)
+            )
+        return cache[key, codec]
 
-        # send basic info
-        await client.send(
-            json.dumps(
-                {
-                    # "result_info": message.result_info,
-                    "frame_number": message.frame_number,
-                }
+    def client_counters(self) -> dict:
+        return {
+            str(client.websocket.remote_address): client.counters()
+            for client in self.clients.values()
+        }
+
+    def _reset_stream(self) -> None:
+        self.seq = 0
+        self.rows = 0
+        self.current_result = None
+        self.pyramid.reset()
+        self._encoded = {}
+        self._snapshots = {}
+
+    async def snapshot(self, client: ClientSender) -> list:
+        """
+        Encoded frames of the latest result for the client's subscription,
+        None before the first.
+        """
+        if self.current_result is None:
+            return None
+        subscription = client.subscription
+        viewport = subscription.viewport
+        section = None
+        if "raw" in subscription.products:
+            section = self.pyramid.section(
+                viewport.max_rows, viewport.first, viewport.last
             )
+            client.view = (section.level, section.first)
+            client.complete = section.complete
+        client.seq = self.seq
+        client.last_update = time.monotonic()
+        # clients that ask at the same time share the encoding
+        return await self._encode(
+            self._snapshots,
+            (self.seq, subscription.products, viewport),
+            client.codec,
+            self.current_result,
+            self.seq,
+            0,
+            section,
+            viewport.max_rows,
+            self.pyramid.reduce,
+            subscription.products,
         )
-        # send image data separately to client memory issues
-        image_bundle = await asyncio.to_thread(pack_images, message)
-        logger.info(f"Sending image bundle to client of size {len(image_bundle)}")
-        await client.send(image_bundle)
 
     async def websocket_handler(self, websocket):
         logger.info(f"New connection from {websocket.remote_address}")
@@ -84,66 +532,259 @@ class XPSWSResultPublisher(Publisher):
                 f"Invalid path: {websocket.request.path}, we only support /simImages"
             )
             return
-        self.connected_clients.add(websocket)
+        client = ClientSender(
+            websocket, self.snapshot, self.max_queued, self.stall_timeout
+        )
+        # catch the client up before it gets new results
+        if self.current_start_message is not None:
+            client.send_start(self.current_start_message)
+        client.send_snapshot()
+        client.start()
+        self.clients[websocket] = client
         try:
-            # Keep the connection open and do nothing until the client disconnects
-            await websocket.wait_closed()
+            # Listen for resync, codecs and subscribe requests until the
+            # client disconnects
+            async for raw_request in websocket:
+                try:
+                    request = json.loads(raw_request)
+                    request_type = request.get("type")
+                except (ValueError, AttributeError):
+                    request_type = None
+                if request_type == "resync":
+                    client.send_snapshot()
+                elif request_type == "codecs":
+                    client.codec = choose_codec(request.get("accept"), self.codecs)
+                    logger.info(
+                        f"Compressing bundles for {websocket.remote_address} "
+                        f"with {client.codec}"
+                    )
+                elif request_type == "subscribe":
+                    try:
+                        client.subscription = Subscription.from_request(request)
+                    except ValueError as e:
+                        logger.info(f"Ignoring subscription {request}: {e}")
+                        continue
+                    client.send_snapshot()
+                else:
+                    logger.info(f"Ignoring unexpected client message: {raw_request!r}")
         finally:
             # Remove the client when it disconnects
-            self.connected_clients.remove(websocket)
-            logger.info("Client disconnected")
+            del self.clients[websocket]
+            if client.deferred is not None:
+                client.deferred.cancel()
+            client.stop()
+            logger.info(f"Client disconnected: {client.counters()}")
 
 
-def convert_to_uint8(image: np.ndarray) -> bytes:
+class LogStretch:
     """
-    Convert an image to uint8, scaling image
+    Maps images to uint8 for display with a log stretch,
+    255 * log2(1 + (x - min) / (max - min)), which is the min-max normalized
+    log1p of the min-max normalized image.
+
+    The mapping is computed in float32, in place in buffers kept from call to
+    call, one set per thread, as results are encoded in worker threads.
+    uint8 and uint16 images are mapped through a lookup table instead. A
+    constant image maps to zeros.
     """
-    # scaled = (image - image.min()) / (image.max() - image.min()) * 255
-    # return scaled.astype(np.uint8).tobytes()
 
-    image_normalized = (image - image.min()) / (image.max() - image.min())
+    scale = np.float32(255 / np.log(2))
 
-    # Apply logarithmic stretch
-    log_stretched = np.log1p(image_normalized)  # log(1 + x) to handle near-zero values
+    def __init__(self):
+        self._local = threading.local()
 
-    # Normalize the log-stretched image to [0, 1] again
-    log_stretched_normalized = (log_stretched - log_stretched.min()) / (
-        log_stretched.max() - log_stretched.min()
-    )
+    def __call__(self, image: np.ndarray) -> bytes:
+        return self.stretch(image).tobytes()
 
-    # Convert to uint8 (range [0, 255])
-    image_uint8 = (log_stretched_normalized * 255).astype(np.uint8)
-    return image_uint8.tobytes()
-    # def convert_to_uint8(image: np.ndarray) -> bytes:
-    #     image = image.astype(np.float64)
-    #     scaled = np.interp(image, (image.min(), image.max()), (0, 255))
-    #     return scaled.astype(np.uint8).tobytes()
+    def stretch(self, image: np.ndarray) -> np.ndarray:
+        """
+        The uint8 image, in a buffer that the next call from the same thread
+        reuses
+        """
+        image = np.asarray(image)
+        out = self._buffer("out", image.size, np.uint8).reshape(image.shape)
+        if image.size == 0:
+            return out
+        lo = image.min()
+        hi = image.max()
+        if not hi > lo:  # constant, or NaN
+            out.fill(0)
+            return out
+        if image.dtype.kind == "u" and image.dtype.itemsize <= 2:
+            # one table entry per possible value up to the max
+            values = np.arange(int(hi) + 1, dtype=np.float32)
+            lut = np.empty(values.shape, dtype=np.uint8)
+            self._map(values, float(lo), float(hi), lut, values)
+            np.take(lut, image, out=out)
+            return out
+        scratch = self._buffer("scratch", image.size, np.float32)
+        self._map(image, float(lo), float(hi), out, scratch.reshape(image.shape))
+        return out
 
+    def _map(self, image, lo: float, hi: float, out, scratch) -> None:
+        np.subtract(image, lo, out=scratch, casting="unsafe")
+        np.multiply(scratch, np.float32(1 / (hi - lo)), out=scratch)
+        np.log1p(scratch, out=scratch)
+        np.multiply(scratch, self.scale, out=scratch)
+        np.copyto(out, scratch, casting="unsafe")
 
-def peaks_output(peaks: pd.DataFrame):
-    #     [
-    # {"x": 235, "h": 433.3: "fwhm": 4334},
-    # {"x": 235, "h": 433.3: "f whm": 4334}
-    # ]
-    peaks.columns = ["x", "h", "fwhm"]
-    return peaks.to_dict(orient="records")
+    def _buffer(self, name: str, size: int, dtype) -> np.ndarray:
+        buffer = getattr(self._local, name, None)
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype=dtype)
+            setattr(self._local, name, buffer)
+        return buffer[:size]
 
 
-def pack_images(message: XPSResult) -> bytes:
+convert_to_uint8 = LogStretch()
+
+
+# Version of the layout of the bundle made by pack_images
+BUNDLE_VERSION = 2
+
+# Names sent for the columns of the detected peaks table (location,
+# amplitude, FWHM), in the order peak_fit makes them
+PEAK_COLUMNS = ("x", "h", "fwhm")
+
+
+def pack_array(array: np.ndarray, dtype: np.dtype = None) -> dict:
+    """An array as its dtype string, shape and C ordered bytes"""
+    array = np.ascontiguousarray(array, dtype=dtype)
+    return {
+        "dtype": array.dtype.str,
+        "shape": list(array.shape),
+        "data": array.tobytes(),
+    }
+
+
+def pack_peaks(peaks: pd.DataFrame) -> dict:
+    """The peaks table as one float32 array per column, without changing it"""
+    packed = {}
+    for position, name in enumerate(PEAK_COLUMNS):
+        if position < peaks.shape[1]:
+            column = peaks.iloc[:, position].to_numpy()
+        else:
+            column = np.empty(0)  # no peaks were found
+        packed[name] = pack_array(column, "<f4")
+    return packed
+
+
+def encode_result(
+    message: XPSResult,
+    seq: int = 0,
+    start: int = 0,
+    section: Section = None,
+    max_rows: int = None,
+    reduce: str = "mean",
+    products: frozenset = frozenset(PRODUCTS),
+    base_seq: int = None,
+) -> list:
     """
-    Pack all the images into a single msgpack message
+    Encode a result as the websocket messages sent for it: basic info, then
+    the image data separately to avoid client memory issues
     """
-    return msgpack.packb(
+    info = json.dumps(
         {
-            "raw": convert_to_uint8(message.integrated_frames.array),
-            "vfft": convert_to_uint8(message.vfft.array),
-            "ifft": convert_to_uint8(message.ifft.array),
-            "width": message.integrated_frames.array.shape[0],
-            "height": message.integrated_frames.array.shape[1],
-            "fitted": json.dumps(peaks_output(message.detected_peaks.df)),
-            "shot_num": message.shot_num,
-            "shot_recent": convert_to_uint8(message.shot_recent.array),
-            "shot_mean": convert_to_uint8(message.shot_mean.array),
-            "shot_std": convert_to_uint8(message.shot_std.array),
+            # "result_info": message.result_info,
+            "frame_number": message.frame_number,
         }
     )
+    bundle = pack_images(
+        message, seq, start, section, max_rows, reduce, products, base_seq
+    )
+    return [info, bundle]
+
+
+def compress_frames(frames: list, codec: str = None) -> list:
+    """
+    The messages for a result, with the bundle compressed with codec and
+    wrapped in a bundle that names the codec, {version, codec, payload}
+    """
+    if codec is None:
+        return frames
+    info, bundle = frames
+    payload = compress(bundle, codec)
+    return [
+        info,
+        msgpack.packb({"version": BUNDLE_VERSION, "codec": codec, "payload": payload}),
+    ]
+
+
+async def _compress_later(frames: Awaitable[list], codec: str) -> list:
+    frames = await frames
+    if codec is None:
+        return frames
+    return await asyncio.to_thread(compress_frames, frames, codec)
+
+
+def pack_images(
+    message: XPSResult,
+    seq: int = 0,
+    start: int = 0,
+    section: Section = None,
+    max_rows: int = None,
+    reduce: str = "mean",
+    products: frozenset = frozenset(PRODUCTS),
+    base_seq: int = None,
+) -> bytes:
+    """
+    Pack the images of the products asked for into a single msgpack message
+
+    Arrays are packed with pack_array, and each image is sent as uint8,
+    log stretched, except for the waterfall rows. Peaks are packed by
+    pack_peaks. The layout is given by version, BUNDLE_VERSION.
+
+    Waterfall rows are taken from section, rows of a WaterfallPyramid level,
+    or the full waterfall if it is None. Rows from start on are sent oldest
+    first as float32, raw_rows, for the client to put after the first start
+    rows it has and scale for display itself, as the scaling depends on the
+    whole waterfall. The last row may be partial and is sent again until
+    complete. With start 0 the message is a snapshot that replaces what the
+    client has, otherwise a delta that applies to sequence number base_seq.
+
+    vfft and ifft are decimated to fit in max_rows. Lock-in amplitude and
+    phase, (harmonics, width), the phase folded lines, (f_reset, width), and
+    the pumped difference, (width,), are sent as float32 when the result has
+    them.
+    """
+    waterfall = message.integrated_frames.array  # newest row first
+    bundle = {
+        "version": BUNDLE_VERSION,
+        "kind": "delta" if start else "snapshot",
+        "seq": seq,
+        "width": waterfall.shape[0],
+        "height": waterfall.shape[1],
+        "shot_num": message.shot_num,
+    }
+    if "raw" in products:
+        if section is None:
+            section = Section(0, 0, waterfall[::-1], waterfall.shape[0])
+        bundle.update(
+            {
+                "base_seq": base_seq,
+                "raw_start": start,
+                "raw_rows": pack_array(section.rows[start:], "<f4"),
+                # pyramid level, and the waterfall row the client's first row
+                # starts at
+                "level": section.level,
+                "row_first": section.first << section.level,
+            }
+        )
+    if "vfft" in products or "ifft" in products:
+        fft_level = level_for(message.vfft.array.shape[0], max_rows)
+        bundle["fft_level"] = fft_level
+        for name in ("vfft", "ifft"):
+            if name in products:
+                fft = decimate(getattr(message, name).array, fft_level, reduce)
+                bundle[name] = pack_array(convert_to_uint8.stretch(fft))
+    for name in ("shot_recent", "shot_mean", "shot_std"):
+        if name in products:
+            image = getattr(message, name).array
+            bundle[name] = pack_array(convert_to_uint8.stretch(image))
+    if "peaks" in products:
+        bundle["peaks"] = pack_peaks(message.detected_peaks.df)
+    for name in FLOAT_PRODUCTS:
+        product = getattr(message, name)
+        if name in products and product is not None:
+            bundle[name] = pack_array(product.array, "<f4")
+    return msgpack.packb(bundle)